@@ -1,929 +1,1210 @@
-import asyncio
-import json
-import os
-import uvicorn
-from fastapi import FastAPI, Form, HTTPException, Request
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.staticfiles import StaticFiles
-from fastapi.templating import Jinja2Templates
-from pydantic import BaseModel
-from typing import Dict, List, Optional
-import threading
-
-# 导入我们的MQTT服务器模块
-from mqtt_server import mqtt_config, clients, topics, start_mqtt_server
-
-# 创建FastAPI应用
-app = FastAPI(title="MQTT服务器管理API")
-
-# 配置模型
-class MQTTConfigModel(BaseModel):
-    host: str
-    port: int
-    allow_anonymous: bool
-    max_connections: int
-    max_keepalive: int
-
-# 用户模型
-class User(BaseModel):
-    username: str
-    password: str
-
-# 路由
-@app.get("/", response_class=HTMLResponse)
-async def get_index():
-    """返回简单的HTML页面，显示MQTT服务器配置表单"""
-    html_content = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>MQTT服务器配置</title>
-        <style>
-            body {
-                font-family: Arial, sans-serif;
-                max-width: 800px;
-                margin: 0 auto;
-                padding: 20px;
-            }
-            .container {
-                background-color: #f5f5f5;
-                border-radius: 5px;
-                padding: 20px;
-                margin-bottom: 20px;
-            }
-            h1 {
-                color: #333;
-            }
-            label {
-                display: block;
-                margin-bottom: 5px;
-                font-weight: bold;
-            }
-            input, select {
-                width: 100%;
-                padding: 8px;
-                margin-bottom: 15px;
-                border: 1px solid #ddd;
-                border-radius: 4px;
-                box-sizing: border-box;
-            }
-            button {
-                background-color: #4CAF50;
-                color: white;
-                padding: 10px 15px;
-                border: none;
-                border-radius: 4px;
-                cursor: pointer;
-            }
-            button:hover {
-                background-color: #45a049;
-            }
-            .tabs {
-                overflow: hidden;
-                border: 1px solid #ccc;
-                background-color: #f1f1f1;
-                border-radius: 4px 4px 0 0;
-            }
-            .tab {
-                background-color: inherit;
-                float: left;
-                border: none;
-                outline: none;
-                cursor: pointer;
-                padding: 14px 16px;
-                transition: 0.3s;
-                font-size: 17px;
-            }
-            .tab:hover {
-                background-color: #ddd;
-            }
-            .tab.active {
-                background-color: #ccc;
-            }
-            .tabcontent {
-                display: none;
-                padding: 20px;
-                border: 1px solid #ccc;
-                border-top: none;
-                border-radius: 0 0 4px 4px;
-                animation: fadeEffect 1s;
-            }
-            @keyframes fadeEffect {
-                from {opacity: 0;}
-                to {opacity: 1;}
-            }
-            table {
-                width: 100%;
-                border-collapse: collapse;
-            }
-            table, th, td {
-                border: 1px solid #ddd;
-            }
-            th, td {
-                padding: 10px;
-                text-align: left;
-            }
-            th {
-                background-color: #f2f2f2;
-            }
-            tr:nth-child(even) {
-                background-color: #f9f9f9;
-            }
-        </style>
-    </head>
-    <body>
-        <h1>MQTT服务器配置</h1>
-        
-        <div class="tabs">
-            <button class="tab active" onclick="openTab(event, 'config')">服务器配置</button>
-            <button class="tab" onclick="openTab(event, 'users')">用户管理</button>
-            <button class="tab" onclick="openTab(event, 'clients')">客户端连接</button>
-            <button class="tab" onclick="openTab(event, 'topics')">主题订阅</button>
-            <button class="tab" onclick="openTab(event, 'mqtt_client')">MQTT客户端测试</button>
-        </div>
-
-        <div id="config" class="tabcontent" style="display: block;">
-            <h2>服务器配置</h2>
-            <form id="configForm">
-                <label for="host">主机地址:</label>
-                <input type="text" id="host" name="host" required>
-                
-                <label for="port">端口:</label>
-                <input type="number" id="port" name="port" required>
-                
-                <label for="allow_anonymous">允许匿名连接:</label>
-                <select id="allow_anonymous" name="allow_anonymous">
-                    <option value="true">是</option>
-                    <option value="false">否</option>
-                </select>
-                
-                <label for="max_connections">最大连接数:</label>
-                <input type="number" id="max_connections" name="max_connections" required>
-                
-                <label for="max_keepalive">最大保持连接时间(秒):</label>
-                <input type="number" id="max_keepalive" name="max_keepalive" required>
-                
-                <button type="button" onclick="updateConfig()">更新配置</button>
-            </form>
-        </div>
-
-        <div id="users" class="tabcontent">
-            <h2>用户管理</h2>
-            <form id="userForm">
-                <label for="username">用户名:</label>
-                <input type="text" id="username" name="username" required>
-                
-                <label for="password">密码:</label>
-                <input type="password" id="password" name="password" required>
-                
-                <button type="button" onclick="addUser()">添加用户</button>
-            </form>
-            
-            <h3>用户列表</h3>
-            <div id="userList">
-                <table id="userTable">
-                    <tr>
-                        <th>用户名</th>
-                        <th>操作</th>
-                    </tr>
-                </table>
-            </div>
-        </div>
-
-        <div id="clients" class="tabcontent">
-            <h2>客户端连接</h2>
-            <div id="clientList">
-                <table id="clientTable">
-                    <tr>
-                        <th>客户端ID</th>
-                        <th>用户名</th>
-                        <th>订阅主题数</th>
-                        <th>状态</th>
-                    </tr>
-                </table>
-            </div>
-            <button type="button" onclick="refreshClients()">刷新</button>
-        </div>
-
-        <div id="topics" class="tabcontent">
-            <h2>主题订阅</h2>
-            <div id="topicList">
-                <table id="topicTable">
-                    <tr>
-                        <th>主题</th>
-                        <th>订阅客户端数</th>
-                        <th>操作</th>
-                    </tr>
-                </table>
-            </div>
-            <button type="button" onclick="refreshTopics()">刷新</button>
-        </div>
-
-        <div id="mqtt_client" class="tabcontent">
-            <h2>MQTT客户端测试</h2>
-            <div class="container">
-                <h3>连接</h3>
-                <form id="connectForm">
-                    <label for="clientId">客户端ID:</label>
-                    <input type="text" id="clientId" name="clientId" value="webclient-" required>
-                    
-                    <label for="clientUsername">用户名 (可选):</label>
-                    <input type="text" id="clientUsername" name="clientUsername">
-                    
-                    <label for="clientPassword">密码 (可选):</label>
-                    <input type="password" id="clientPassword" name="clientPassword">
-                    
-                    <button type="button" id="connectBtn" onclick="connectClient()">连接</button>
-                    <button type="button" id="disconnectBtn" onclick="disconnectClient()" disabled>断开连接</button>
-                </form>
-            </div>
-            
-            <div class="container">
-                <h3>订阅</h3>
-                <form id="subscribeForm">
-                    <label for="subscribeTopic">主题:</label>
-                    <input type="text" id="subscribeTopic" name="subscribeTopic" required>
-                    
-                    <label for="subscribeQos">QoS:</label>
-                    <select id="subscribeQos" name="subscribeQos">
-                        <option value="0">0</option>
-                        <option value="1">1</option>
-                    </select>
-                    
-                    <button type="button" id="subscribeBtn" onclick="subscribeTopic()" disabled>订阅</button>
-                    <button type="button" id="unsubscribeBtn" onclick="unsubscribeTopic()" disabled>取消订阅</button>
-                </form>
-            </div>
-            
-            <div class="container">
-                <h3>发布</h3>
-                <form id="publishForm">
-                    <label for="publishTopic">主题:</label>
-                    <input type="text" id="publishTopic" name="publishTopic" required>
-                    
-                    <label for="publishPayload">消息内容:</label>
-                    <input type="text" id="publishPayload" name="publishPayload" required>
-                    
-                    <label for="publishQos">QoS:</label>
-                    <select id="publishQos" name="publishQos">
-                        <option value="0">0</option>
-                        <option value="1">1</option>
-                    </select>
-                    
-                    <button type="button" id="publishBtn" onclick="publishMessage()" disabled>发布</button>
-                </form>
-            </div>
-            
-            <div class="container">
-                <h3>消息记录</h3>
-                <div id="messageLog" style="height: 200px; overflow-y: auto; border: 1px solid #ddd; padding: 10px; background-color: #fff;">
-                </div>
-                <button type="button" onclick="clearMessages()">清除</button>
-            </div>
-        </div>
-
-        <script>
-            // 获取并填充当前配置
-            window.onload = function() {
-                getConfig();
-                getUsers();
-                refreshClients();
-                refreshTopics();
-                
-                // 添加随机数到客户端ID
-                document.getElementById('clientId').value += Math.floor(Math.random() * 10000);
-            };
-            
-            // 选项卡功能
-            function openTab(evt, tabName) {
-                var i, tabcontent, tablinks;
-                tabcontent = document.getElementsByClassName("tabcontent");
-                for (i = 0; i < tabcontent.length; i++) {
-                    tabcontent[i].style.display = "none";
-                }
-                tablinks = document.getElementsByClassName("tab");
-                for (i = 0; i < tablinks.length; i++) {
-                    tablinks[i].className = tablinks[i].className.replace(" active", "");
-                }
-                document.getElementById(tabName).style.display = "block";
-                evt.currentTarget.className += " active";
-            }
-            
-            // 获取MQTT配置
-            function getConfig() {
-                fetch('/config')
-                    .then(response => response.json())
-                    .then(data => {
-                        document.getElementById('host').value = data.host;
-                        document.getElementById('port').value = data.port;
-                        document.getElementById('allow_anonymous').value = data.allow_anonymous.toString();
-                        document.getElementById('max_connections').value = data.max_connections;
-                        document.getElementById('max_keepalive').value = data.max_keepalive;
-                    })
-                    .catch(error => console.error('获取配置失败:', error));
-            }
-            
-            // 更新MQTT配置
-            function updateConfig() {
-                const formData = {
-                    host: document.getElementById('host').value,
-                    port: parseInt(document.getElementById('port').value),
-                    allow_anonymous: document.getElementById('allow_anonymous').value === 'true',
-                    max_connections: parseInt(document.getElementById('max_connections').value),
-                    max_keepalive: parseInt(document.getElementById('max_keepalive').value)
-                };
-                
-                fetch('/config', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify(formData)
-                })
-                .then(response => response.json())
-                .then(data => {
-                    alert('配置已更新');
-                })
-                .catch(error => console.error('更新配置失败:', error));
-            }
-            
-            // 获取用户列表
-            function getUsers() {
-                fetch('/users')
-                    .then(response => response.json())
-                    .then(data => {
-                        const userTable = document.getElementById('userTable');
-                        // 清除现有行，保留表头
-                        while (userTable.rows.length > 1) {
-                            userTable.deleteRow(1);
-                        }
-                        
-                        // 添加用户行
-                        data.forEach(username => {
-                            const row = userTable.insertRow();
-                            const cell1 = row.insertCell(0);
-                            const cell2 = row.insertCell(1);
-                            
-                            cell1.textContent = username;
-                            cell2.innerHTML = `<button onclick="deleteUser('${username}')">删除</button>`;
-                        });
-                    })
-                    .catch(error => console.error('获取用户失败:', error));
-            }
-            
-            // 添加用户
-            function addUser() {
-                const username = document.getElementById('username').value;
-                const password = document.getElementById('password').value;
-                
-                fetch('/users', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({
-                        username: username,
-                        password: password
-                    })
-                })
-                .then(response => response.json())
-                .then(data => {
-                    alert('用户已添加');
-                    getUsers();
-                    document.getElementById('username').value = '';
-                    document.getElementById('password').value = '';
-                })
-                .catch(error => console.error('添加用户失败:', error));
-            }
-            
-            // 删除用户
-            function deleteUser(username) {
-                fetch(`/users/${username}`, {
-                    method: 'DELETE'
-                })
-                .then(response => response.json())
-                .then(data => {
-                    alert('用户已删除');
-                    getUsers();
-                })
-                .catch(error => console.error('删除用户失败:', error));
-            }
-            
-            // 刷新客户端列表
-            function refreshClients() {
-                fetch('/clients')
-                    .then(response => response.json())
-                    .then(data => {
-                        const clientTable = document.getElementById('clientTable');
-                        // 清除现有行，保留表头
-                        while (clientTable.rows.length > 1) {
-                            clientTable.deleteRow(1);
-                        }
-                        
-                        // 添加客户端行
-                        Object.keys(data).forEach(clientId => {
-                            const client = data[clientId];
-                            const row = clientTable.insertRow();
-                            const cell1 = row.insertCell(0);
-                            const cell2 = row.insertCell(1);
-                            const cell3 = row.insertCell(2);
-                            const cell4 = row.insertCell(3);
-                            
-                            cell1.textContent = clientId;
-                            cell2.textContent = client.username || '匿名';
-                            cell3.textContent = client.subscriptions.length;
-                            cell4.textContent = client.connected ? '已连接' : '已断开';
-                        });
-                    })
-                    .catch(error => console.error('获取客户端失败:', error));
-            }
-            
-            // 刷新主题列表
-            function refreshTopics() {
-                fetch('/topics')
-                    .then(response => response.json())
-                    .then(data => {
-                        const topicTable = document.getElementById('topicTable');
-                        // 清除现有行，保留表头
-                        while (topicTable.rows.length > 1) {
-                            topicTable.deleteRow(1);
-                        }
-                        
-                        // 添加主题行
-                        Object.keys(data).forEach(topic => {
-                            const subscribers = data[topic];
-                            const row = topicTable.insertRow();
-                            const cell1 = row.insertCell(0);
-                            const cell2 = row.insertCell(1);
-                            const cell3 = row.insertCell(2);
-                            
-                            cell1.textContent = topic;
-                            cell2.textContent = subscribers.length;
-                            cell3.innerHTML = `<button onclick="publishToTopic('${topic}')">发布消息</button>`;
-                        });
-                    })
-                    .catch(error => console.error('获取主题失败:', error));
-            }
-            
-            // 弹出对话框发布消息到主题
-            function publishToTopic(topic) {
-                const message = prompt(`发送消息到主题 ${topic}:`, '');
-                if (message === null) return;
-                
-                fetch('/publish', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({
-                        topic: topic,
-                        message: message,
-                        qos: 0
-                    })
-                })
-                .then(response => response.json())
-                .then(data => {
-                    alert('消息已发布');
-                })
-                .catch(error => console.error('发布消息失败:', error));
-            }
-            
-            // ==== MQTT 客户端测试 ====
-            
-            // 添加消息到日志
-            function addMessageToLog(message, type) {
-                const logDiv = document.getElementById('messageLog');
-                const now = new Date();
-                const timeStr = now.toLocaleTimeString();
-                const msgSpan = document.createElement('div');
-                msgSpan.style.marginBottom = '5px';
-                
-                if (type === 'info') {
-                    msgSpan.style.color = 'blue';
-                } else if (type === 'error') {
-                    msgSpan.style.color = 'red';
-                } else if (type === 'success') {
-                    msgSpan.style.color = 'green';
-                } else if (type === 'received') {
-                    msgSpan.style.color = 'purple';
-                }
-                
-                msgSpan.innerHTML = `<strong>[${timeStr}]</strong> ${message}`;
-                logDiv.appendChild(msgSpan);
-                logDiv.scrollTop = logDiv.scrollHeight;
-            }
-            
-            // 清除消息日志
-            function clearMessages() {
-                document.getElementById('messageLog').innerHTML = '';
-            }
-            
-            // 连接MQTT客户端
-            function connectClient() {
-                const clientId = document.getElementById('clientId').value;
-                const username = document.getElementById('clientUsername').value;
-                const password = document.getElementById('clientPassword').value;
-                
-                fetch('/mqtt/connect', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({
-                        client_id: clientId,
-                        username: username || null,
-                        password: password || null
-                    })
-                })
-                .then(response => response.json())
-                .then(data => {
-                    if (data.success) {
-                        addMessageToLog('已连接到MQTT服务器', 'success');
-                        document.getElementById('connectBtn').disabled = true;
-                        document.getElementById('disconnectBtn').disabled = false;
-                        document.getElementById('subscribeBtn').disabled = false;
-                        document.getElementById('publishBtn').disabled = false;
-                        
-                        // 开始长轮询接收消息
-                        pollMessages(clientId);
-                    } else {
-                        addMessageToLog(`连接失败: ${data.message}`, 'error');
-                    }
-                })
-                .catch(error => {
-                    console.error('连接失败:', error);
-                    addMessageToLog(`连接错误: ${error.message}`, 'error');
-                });
-            }
-            
-            // 断开MQTT客户端连接
-            function disconnectClient() {
-                const clientId = document.getElementById('clientId').value;
-                
-                fetch('/mqtt/disconnect', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({
-                        client_id: clientId
-                    })
-                })
-                .then(response => response.json())
-                .then(data => {
-                    addMessageToLog('已断开连接', 'info');
-                    document.getElementById('connectBtn').disabled = false;
-                    document.getElementById('disconnectBtn').disabled = true;
-                    document.getElementById('subscribeBtn').disabled = true;
-                    document.getElementById('unsubscribeBtn').disabled = true;
-                    document.getElementById('publishBtn').disabled = true;
-                })
-                .catch(error => {
-                    console.error('断开连接失败:', error);
-                    addMessageToLog(`断开连接错误: ${error.message}`, 'error');
-                });
-            }
-            
-            // 订阅主题
-            function subscribeTopic() {
-                const clientId = document.getElementById('clientId').value;
-                const topic = document.getElementById('subscribeTopic').value;
-                const qos = parseInt(document.getElementById('subscribeQos').value);
-                
-                fetch('/mqtt/subscribe', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({
-                        client_id: clientId,
-                        topic: topic,
-                        qos: qos
-                    })
-                })
-                .then(response => response.json())
-                .then(data => {
-                    if (data.success) {
-                        addMessageToLog(`已订阅主题: ${topic}, QoS=${qos}`, 'success');
-                        document.getElementById('unsubscribeBtn').disabled = false;
-                    } else {
-                        addMessageToLog(`订阅失败: ${data.message}`, 'error');
-                    }
-                })
-                .catch(error => {
-                    console.error('订阅失败:', error);
-                    addMessageToLog(`订阅错误: ${error.message}`, 'error');
-                });
-            }
-            
-            // 取消订阅主题
-            function unsubscribeTopic() {
-                const clientId = document.getElementById('clientId').value;
-                const topic = document.getElementById('subscribeTopic').value;
-                
-                fetch('/mqtt/unsubscribe', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({
-                        client_id: clientId,
-                        topic: topic
-                    })
-                })
-                .then(response => response.json())
-                .then(data => {
-                    addMessageToLog(`已取消订阅主题: ${topic}`, 'info');
-                    document.getElementById('unsubscribeBtn').disabled = true;
-                })
-                .catch(error => {
-                    console.error('取消订阅失败:', error);
-                    addMessageToLog(`取消订阅错误: ${error.message}`, 'error');
-                });
-            }
-            
-            // 发布消息
-            function publishMessage() {
-                const clientId = document.getElementById('clientId').value;
-                const topic = document.getElementById('publishTopic').value;
-                const payload = document.getElementById('publishPayload').value;
-                const qos = parseInt(document.getElementById('publishQos').value);
-                
-                fetch('/mqtt/publish', {
-                    method: 'POST',
-                    headers: {
-                        'Content-Type': 'application/json'
-                    },
-                    body: JSON.stringify({
-                        client_id: clientId,
-                        topic: topic,
-                        message: payload,
-                        qos: qos
-                    })
-                })
-                .then(response => response.json())
-                .then(data => {
-                    if (data.success) {
-                        addMessageToLog(`已发布消息到主题: ${topic}, 消息: ${payload}`, 'success');
-                    } else {
-                        addMessageToLog(`发布失败: ${data.message}`, 'error');
-                    }
-                })
-                .catch(error => {
-                    console.error('发布失败:', error);
-                    addMessageToLog(`发布错误: ${error.message}`, 'error');
-                });
-            }
-            
-            // 长轮询接收消息
-            function pollMessages(clientId) {
-                if (!document.getElementById('disconnectBtn').disabled) {
-                    fetch(`/mqtt/messages/${clientId}`)
-                        .then(response => response.json())
-                        .then(data => {
-                            if (data.messages && data.messages.length > 0) {
-                                data.messages.forEach(msg => {
-                                    addMessageToLog(`接收到消息: 主题=${msg.topic}, 内容=${msg.payload}`, 'received');
-                                });
-                            }
-                            
-                            // 继续轮询
-                            setTimeout(() => pollMessages(clientId), 1000);
-                        })
-                        .catch(error => {
-                            console.error('获取消息失败:', error);
-                            setTimeout(() => pollMessages(clientId), 5000);
-                        });
-                }
-            }
-        </script>
-    </body>
-    </html>
-    """
-    return html_content
-
-# 获取配置
-@app.get("/config")
-async def get_config():
-    """获取MQTT服务器配置"""
-    return {
-        "host": mqtt_config.host,
-        "port": mqtt_config.port,
-        "allow_anonymous": mqtt_config.allow_anonymous,
-        "max_connections": mqtt_config.max_connections,
-        "max_keepalive": mqtt_config.max_keepalive
-    }
-
-# 更新配置
-@app.post("/config")
-async def update_config(config: MQTTConfigModel):
-    """更新MQTT服务器配置"""
-    mqtt_config.host = config.host
-    mqtt_config.port = config.port
-    mqtt_config.allow_anonymous = config.allow_anonymous
-    mqtt_config.max_connections = config.max_connections
-    mqtt_config.max_keepalive = config.max_keepalive
-    
-    return {"success": True, "message": "配置已更新"}
-
-# 获取用户列表
-@app.get("/users")
-async def get_users():
-    """获取MQTT用户列表"""
-    return list(mqtt_config.users.keys())
-
-# 添加用户
-@app.post("/users")
-async def add_user(user: User):
-    """添加MQTT用户"""
-    mqtt_config.users[user.username] = user.password
-    return {"success": True, "message": "用户已添加"}
-
-# 删除用户
-@app.delete("/users/{username}")
-async def delete_user(username: str):
-    """删除MQTT用户"""
-    if username in mqtt_config.users:
-        del mqtt_config.users[username]
-        return {"success": True, "message": "用户已删除"}
-    else:
-        raise HTTPException(status_code=404, detail="用户不存在")
-
-# 获取客户端列表
-@app.get("/clients")
-async def get_clients():
-    """获取已连接客户端列表"""
-    result = {}
-    for client_id, client in clients.items():
-        result[client_id] = {
-            "username": client.username,
-            "connected": client.connected,
-            "subscriptions": list(client.subscriptions)
-        }
-    return result
-
-# 获取主题订阅列表
-@app.get("/topics")
-async def get_topics():
-    """获取主题订阅列表"""
-    return topics
-
-# 向主题发布消息
-@app.post("/publish")
-async def publish_message(data: dict):
-    """向主题发布消息"""
-    topic = data.get("topic")
-    message = data.get("message")
-    qos = data.get("qos", 0)
-    
-    if not topic or message is None:
-        raise HTTPException(status_code=400, detail="主题和消息不能为空")
-    
-    # 导入必要的函数
-    from mqtt_server import publish_message as mqtt_publish
-    
-    # 发布消息
-    await mqtt_publish("admin", topic, message.encode('utf-8'), qos)
-    
-    return {"success": True, "message": "消息已发布"}
-
-# ==== Web MQTT客户端API ====
-
-# 存储Web客户端的消息队列
-web_client_messages = {}
-
-# 连接MQTT客户端
-@app.post("/mqtt/connect")
-async def connect_mqtt_client(data: dict):
-    """连接MQTT客户端"""
-    client_id = data.get("client_id")
-    username = data.get("username")
-    password = data.get("password")
-    
-    if not client_id:
-        raise HTTPException(status_code=400, detail="客户端ID不能为空")
-    
-    # 检查是否已经存在此客户端
-    if client_id in clients:
-        return {"success": False, "message": "客户端已存在"}
-    
-    # 初始化消息队列
-    web_client_messages[client_id] = []
-    
-    # 这里我们模拟客户端连接到服务器
-    # 在实际情况下，应该使用MQTT协议连接
-    # 由于我们的MQTT服务器和API服务器在同一个进程中，
-    # 我们可以直接在服务器端模拟一个客户端
-    
-    # 返回成功
-    return {"success": True, "message": "连接成功"}
-
-# 断开MQTT客户端连接
-@app.post("/mqtt/disconnect")
-async def disconnect_mqtt_client(data: dict):
-    """断开MQTT客户端连接"""
-    client_id = data.get("client_id")
-    
-    if not client_id:
-        raise HTTPException(status_code=400, detail="客户端ID不能为空")
-    
-    # 清理消息队列
-    if client_id in web_client_messages:
-        del web_client_messages[client_id]
-    
-    return {"success": True, "message": "已断开连接"}
-
-# 订阅主题
-@app.post("/mqtt/subscribe")
-async def subscribe_topic(data: dict):
-    """订阅主题"""
-    client_id = data.get("client_id")
-    topic = data.get("topic")
-    qos = data.get("qos", 0)
-    
-    if not client_id or not topic:
-        raise HTTPException(status_code=400, detail="客户端ID和主题不能为空")
-    
-    # 添加订阅
-    if topic not in topics:
-        topics[topic] = []
-    if client_id not in topics[topic]:
-        topics[topic].append(client_id)
-    
-    return {"success": True, "message": "订阅成功"}
-
-# 取消订阅主题
-@app.post("/mqtt/unsubscribe")
-async def unsubscribe_topic(data: dict):
-    """取消订阅主题"""
-    client_id = data.get("client_id")
-    topic = data.get("topic")
-    
-    if not client_id or not topic:
-        raise HTTPException(status_code=400, detail="客户端ID和主题不能为空")
-    
-    # 移除订阅
-    if topic in topics and client_id in topics[topic]:
-        topics[topic].remove(client_id)
-        if not topics[topic]:
-            del topics[topic]
-    
-    return {"success": True, "message": "取消订阅成功"}
-
-# 发布消息
-@app.post("/mqtt/publish")
-async def publish_mqtt_message(data: dict):
-    """发布MQTT消息"""
-    client_id = data.get("client_id")
-    topic = data.get("topic")
-    message = data.get("message")
-    qos = data.get("qos", 0)
-    
-    if not client_id or not topic or message is None:
-        raise HTTPException(status_code=400, detail="客户端ID、主题和消息不能为空")
-    
-    # 导入必要的函数
-    from mqtt_server import publish_message as mqtt_publish
-    
-    # 发布消息
-    await mqtt_publish(client_id, topic, message.encode('utf-8'), qos)
-    
-    return {"success": True, "message": "消息已发布"}
-
-# 获取消息
-@app.get("/mqtt/messages/{client_id}")
-async def get_mqtt_messages(client_id: str):
-    """获取MQTT消息"""
-    if client_id not in web_client_messages:
-        web_client_messages[client_id] = []
-    
-    messages = web_client_messages[client_id].copy()
-    web_client_messages[client_id] = []
-    
-    return {"success": True, "messages": messages}
-
-# 添加消息到Web客户端
-async def add_message_to_web_client(client_id, topic, payload):
-    """添加消息到Web客户端的消息队列"""
-    if client_id in web_client_messages:
-        web_client_messages[client_id].append({
-            "topic": topic,
-            "payload": payload
-        })
-
-# 启动MQTT服务器的函数
-def start_mqtt_server_thread():
-    """在单独的线程中启动MQTT服务器"""
-    asyncio.run(start_mqtt_server())
-
-# 主程序
-def main():
-    # 在单独的线程中启动MQTT服务器
-    mqtt_thread = threading.Thread(target=start_mqtt_server_thread, daemon=True)
-    mqtt_thread.start()
-    
-    # 启动FastAPI服务器
-    uvicorn.run(app, host="0.0.0.0", port=8000)
-
-if __name__ == "__main__":
+import asyncio
+import json
+import os
+import uvicorn
+from fastapi import FastAPI, Form, HTTPException, Request, WebSocket
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from fastapi.templating import Jinja2Templates
+from pydantic import BaseModel
+from typing import Dict, List, Optional
+import threading
+
+# 导入我们的MQTT服务器模块
+from mqtt_server import mqtt_config, clients, topics, start_mqtt_server, SLOW_CONSUMER_POLICIES, \
+    retained_messages, sessions, run_event_loop, valid_topic_filter, metrics, shared_subscriptions, \
+    valid_shared_filter, SHARE_PREFIX, SHARED_STRATEGIES, virtual_clients, connect_virtual_client, \
+    disconnect_virtual_client, subscribe_virtual_client, call_in_server_loop, route_batch, valid_topic_name, \
+    ServerNotRunning
+from mqtt_batch import BATCH_DECODERS
+from mqtt_logging import log_event
+from mqtt_metrics import render_prometheus
+from mqtt_websocket import serve_websocket
+
+# 创建FastAPI应用
+app = FastAPI(title="MQTT服务器管理API")
+
+@app.exception_handler(ServerNotRunning)
+async def server_not_running(request: Request, exc: ServerNotRunning):
+    """MQTT服务器尚未启动或已停止"""
+    return JSONResponse(status_code=503, content={"detail": str(exc)})
+
+# 配置模型
+class MQTTConfigModel(BaseModel):
+    host: str
+    port: int
+    allow_anonymous: bool
+    max_connections: int
+    max_keepalive: int
+    max_queued_messages: Optional[int] = None
+    slow_consumer_policy: Optional[str] = None
+    max_inflight_messages: Optional[int] = None
+    retry_interval: Optional[int] = None
+    shared_subscription_strategy: Optional[str] = None
+    max_packet_size: Optional[int] = None
+    stream_threshold: Optional[int] = None
+    topic_alias_maximum: Optional[int] = None
+    write_coalesce_us: Optional[int] = None
+    virtual_client_buffer: Optional[int] = None
+    virtual_client_ttl: Optional[int] = None
+
+# 用户模型
+class User(BaseModel):
+    username: str
+    password: str
+
+# 路由
+@app.get("/", response_class=HTMLResponse)
+async def get_index():
+    """返回简单的HTML页面，显示MQTT服务器配置表单"""
+    html_content = """
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>MQTT服务器配置</title>
+        <style>
+            body {
+                font-family: Arial, sans-serif;
+                max-width: 800px;
+                margin: 0 auto;
+                padding: 20px;
+            }
+            .container {
+                background-color: #f5f5f5;
+                border-radius: 5px;
+                padding: 20px;
+                margin-bottom: 20px;
+            }
+            h1 {
+                color: #333;
+            }
+            label {
+                display: block;
+                margin-bottom: 5px;
+                font-weight: bold;
+            }
+            input, select {
+                width: 100%;
+                padding: 8px;
+                margin-bottom: 15px;
+                border: 1px solid #ddd;
+                border-radius: 4px;
+                box-sizing: border-box;
+            }
+            button {
+                background-color: #4CAF50;
+                color: white;
+                padding: 10px 15px;
+                border: none;
+                border-radius: 4px;
+                cursor: pointer;
+            }
+            button:hover {
+                background-color: #45a049;
+            }
+            .tabs {
+                overflow: hidden;
+                border: 1px solid #ccc;
+                background-color: #f1f1f1;
+                border-radius: 4px 4px 0 0;
+            }
+            .tab {
+                background-color: inherit;
+                float: left;
+                border: none;
+                outline: none;
+                cursor: pointer;
+                padding: 14px 16px;
+                transition: 0.3s;
+                font-size: 17px;
+            }
+            .tab:hover {
+                background-color: #ddd;
+            }
+            .tab.active {
+                background-color: #ccc;
+            }
+            .tabcontent {
+                display: none;
+                padding: 20px;
+                border: 1px solid #ccc;
+                border-top: none;
+                border-radius: 0 0 4px 4px;
+                animation: fadeEffect 1s;
+            }
+            @keyframes fadeEffect {
+                from {opacity: 0;}
+                to {opacity: 1;}
+            }
+            table {
+                width: 100%;
+                border-collapse: collapse;
+            }
+            table, th, td {
+                border: 1px solid #ddd;
+            }
+            th, td {
+                padding: 10px;
+                text-align: left;
+            }
+            th {
+                background-color: #f2f2f2;
+            }
+            tr:nth-child(even) {
+                background-color: #f9f9f9;
+            }
+        </style>
+    </head>
+    <body>
+        <h1>MQTT服务器配置</h1>
+        
+        <div class="tabs">
+            <button class="tab active" onclick="openTab(event, 'config')">服务器配置</button>
+            <button class="tab" onclick="openTab(event, 'users')">用户管理</button>
+            <button class="tab" onclick="openTab(event, 'clients')">客户端连接</button>
+            <button class="tab" onclick="openTab(event, 'topics')">主题订阅</button>
+            <button class="tab" onclick="openTab(event, 'mqtt_client')">MQTT客户端测试</button>
+        </div>
+
+        <div id="config" class="tabcontent" style="display: block;">
+            <h2>服务器配置</h2>
+            <form id="configForm">
+                <label for="host">主机地址:</label>
+                <input type="text" id="host" name="host" required>
+                
+                <label for="port">端口:</label>
+                <input type="number" id="port" name="port" required>
+                
+                <label for="allow_anonymous">允许匿名连接:</label>
+                <select id="allow_anonymous" name="allow_anonymous">
+                    <option value="true">是</option>
+                    <option value="false">否</option>
+                </select>
+                
+                <label for="max_connections">最大连接数:</label>
+                <input type="number" id="max_connections" name="max_connections" required>
+                
+                <label for="max_keepalive">最大保持连接时间(秒):</label>
+                <input type="number" id="max_keepalive" name="max_keepalive" required>
+                
+                <button type="button" onclick="updateConfig()">更新配置</button>
+            </form>
+        </div>
+
+        <div id="users" class="tabcontent">
+            <h2>用户管理</h2>
+            <form id="userForm">
+                <label for="username">用户名:</label>
+                <input type="text" id="username" name="username" required>
+                
+                <label for="password">密码:</label>
+                <input type="password" id="password" name="password" required>
+                
+                <button type="button" onclick="addUser()">添加用户</button>
+            </form>
+            
+            <h3>用户列表</h3>
+            <div id="userList">
+                <table id="userTable">
+                    <tr>
+                        <th>用户名</th>
+                        <th>操作</th>
+                    </tr>
+                </table>
+            </div>
+        </div>
+
+        <div id="clients" class="tabcontent">
+            <h2>客户端连接</h2>
+            <div id="clientList">
+                <table id="clientTable">
+                    <tr>
+                        <th>客户端ID</th>
+                        <th>用户名</th>
+                        <th>订阅主题数</th>
+                        <th>状态</th>
+                    </tr>
+                </table>
+            </div>
+            <button type="button" onclick="refreshClients()">刷新</button>
+        </div>
+
+        <div id="topics" class="tabcontent">
+            <h2>主题订阅</h2>
+            <div id="topicList">
+                <table id="topicTable">
+                    <tr>
+                        <th>主题</th>
+                        <th>订阅客户端数</th>
+                        <th>操作</th>
+                    </tr>
+                </table>
+            </div>
+            <button type="button" onclick="refreshTopics()">刷新</button>
+        </div>
+
+        <div id="mqtt_client" class="tabcontent">
+            <h2>MQTT客户端测试</h2>
+            <div class="container">
+                <h3>连接</h3>
+                <form id="connectForm">
+                    <label for="clientId">客户端ID:</label>
+                    <input type="text" id="clientId" name="clientId" value="webclient-" required>
+                    
+                    <label for="clientUsername">用户名 (可选):</label>
+                    <input type="text" id="clientUsername" name="clientUsername">
+                    
+                    <label for="clientPassword">密码 (可选):</label>
+                    <input type="password" id="clientPassword" name="clientPassword">
+                    
+                    <button type="button" id="connectBtn" onclick="connectClient()">连接</button>
+                    <button type="button" id="disconnectBtn" onclick="disconnectClient()" disabled>断开连接</button>
+                </form>
+            </div>
+            
+            <div class="container">
+                <h3>订阅</h3>
+                <form id="subscribeForm">
+                    <label for="subscribeTopic">主题:</label>
+                    <input type="text" id="subscribeTopic" name="subscribeTopic" required>
+                    
+                    <label for="subscribeQos">QoS:</label>
+                    <select id="subscribeQos" name="subscribeQos">
+                        <option value="0">0</option>
+                        <option value="1">1</option>
+                    </select>
+                    
+                    <button type="button" id="subscribeBtn" onclick="subscribeTopic()" disabled>订阅</button>
+                    <button type="button" id="unsubscribeBtn" onclick="unsubscribeTopic()" disabled>取消订阅</button>
+                </form>
+            </div>
+            
+            <div class="container">
+                <h3>发布</h3>
+                <form id="publishForm">
+                    <label for="publishTopic">主题:</label>
+                    <input type="text" id="publishTopic" name="publishTopic" required>
+                    
+                    <label for="publishPayload">消息内容:</label>
+                    <input type="text" id="publishPayload" name="publishPayload" required>
+                    
+                    <label for="publishQos">QoS:</label>
+                    <select id="publishQos" name="publishQos">
+                        <option value="0">0</option>
+                        <option value="1">1</option>
+                    </select>
+                    
+                    <button type="button" id="publishBtn" onclick="publishMessage()" disabled>发布</button>
+                </form>
+            </div>
+            
+            <div class="container">
+                <h3>消息记录</h3>
+                <div id="messageLog" style="height: 200px; overflow-y: auto; border: 1px solid #ddd; padding: 10px; background-color: #fff;">
+                </div>
+                <button type="button" onclick="clearMessages()">清除</button>
+            </div>
+        </div>
+
+        <script>
+            // 获取并填充当前配置
+            window.onload = function() {
+                getConfig();
+                getUsers();
+                refreshClients();
+                refreshTopics();
+                
+                // 添加随机数到客户端ID
+                document.getElementById('clientId').value += Math.floor(Math.random() * 10000);
+            };
+            
+            // 选项卡功能
+            function openTab(evt, tabName) {
+                var i, tabcontent, tablinks;
+                tabcontent = document.getElementsByClassName("tabcontent");
+                for (i = 0; i < tabcontent.length; i++) {
+                    tabcontent[i].style.display = "none";
+                }
+                tablinks = document.getElementsByClassName("tab");
+                for (i = 0; i < tablinks.length; i++) {
+                    tablinks[i].className = tablinks[i].className.replace(" active", "");
+                }
+                document.getElementById(tabName).style.display = "block";
+                evt.currentTarget.className += " active";
+            }
+            
+            // 获取MQTT配置
+            function getConfig() {
+                fetch('/config')
+                    .then(response => response.json())
+                    .then(data => {
+                        document.getElementById('host').value = data.host;
+                        document.getElementById('port').value = data.port;
+                        document.getElementById('allow_anonymous').value = data.allow_anonymous.toString();
+                        document.getElementById('max_connections').value = data.max_connections;
+                        document.getElementById('max_keepalive').value = data.max_keepalive;
+                    })
+                    .catch(error => console.error('获取配置失败:', error));
+            }
+            
+            // 更新MQTT配置
+            function updateConfig() {
+                const formData = {
+                    host: document.getElementById('host').value,
+                    port: parseInt(document.getElementById('port').value),
+                    allow_anonymous: document.getElementById('allow_anonymous').value === 'true',
+                    max_connections: parseInt(document.getElementById('max_connections').value),
+                    max_keepalive: parseInt(document.getElementById('max_keepalive').value)
+                };
+                
+                fetch('/config', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json'
+                    },
+                    body: JSON.stringify(formData)
+                })
+                .then(response => response.json())
+                .then(data => {
+                    alert('配置已更新');
+                })
+                .catch(error => console.error('更新配置失败:', error));
+            }
+            
+            // 获取用户列表
+            function getUsers() {
+                fetch('/users')
+                    .then(response => response.json())
+                    .then(data => {
+                        const userTable = document.getElementById('userTable');
+                        // 清除现有行，保留表头
+                        while (userTable.rows.length > 1) {
+                            userTable.deleteRow(1);
+                        }
+                        
+                        // 添加用户行
+                        data.forEach(username => {
+                            const row = userTable.insertRow();
+                            const cell1 = row.insertCell(0);
+                            const cell2 = row.insertCell(1);
+                            
+                            cell1.textContent = username;
+                            cell2.innerHTML = `<button onclick="deleteUser('${username}')">删除</button>`;
+                        });
+                    })
+                    .catch(error => console.error('获取用户失败:', error));
+            }
+            
+            // 添加用户
+            function addUser() {
+                const username = document.getElementById('username').value;
+                const password = document.getElementById('password').value;
+                
+                fetch('/users', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json'
+                    },
+                    body: JSON.stringify({
+                        username: username,
+                        password: password
+                    })
+                })
+                .then(response => response.json())
+                .then(data => {
+                    alert('用户已添加');
+                    getUsers();
+                    document.getElementById('username').value = '';
+                    document.getElementById('password').value = '';
+                })
+                .catch(error => console.error('添加用户失败:', error));
+            }
+            
+            // 删除用户
+            function deleteUser(username) {
+                fetch(`/users/${username}`, {
+                    method: 'DELETE'
+                })
+                .then(response => response.json())
+                .then(data => {
+                    alert('用户已删除');
+                    getUsers();
+                })
+                .catch(error => console.error('删除用户失败:', error));
+            }
+            
+            // 刷新客户端列表
+            function refreshClients() {
+                fetch('/clients')
+                    .then(response => response.json())
+                    .then(data => {
+                        const clientTable = document.getElementById('clientTable');
+                        // 清除现有行，保留表头
+                        while (clientTable.rows.length > 1) {
+                            clientTable.deleteRow(1);
+                        }
+                        
+                        // 添加客户端行
+                        Object.keys(data).forEach(clientId => {
+                            const client = data[clientId];
+                            const row = clientTable.insertRow();
+                            const cell1 = row.insertCell(0);
+                            const cell2 = row.insertCell(1);
+                            const cell3 = row.insertCell(2);
+                            const cell4 = row.insertCell(3);
+                            
+                            cell1.textContent = clientId;
+                            cell2.textContent = client.username || '匿名';
+                            cell3.textContent = client.subscriptions.length;
+                            cell4.textContent = client.connected ? '已连接' : '已断开';
+                        });
+                    })
+                    .catch(error => console.error('获取客户端失败:', error));
+            }
+            
+            // 刷新主题列表
+            function refreshTopics() {
+                fetch('/topics')
+                    .then(response => response.json())
+                    .then(data => {
+                        const topicTable = document.getElementById('topicTable');
+                        // 清除现有行，保留表头
+                        while (topicTable.rows.length > 1) {
+                            topicTable.deleteRow(1);
+                        }
+                        
+                        // 添加主题行
+                        Object.keys(data).forEach(topic => {
+                            const subscribers = data[topic];
+                            const row = topicTable.insertRow();
+                            const cell1 = row.insertCell(0);
+                            const cell2 = row.insertCell(1);
+                            const cell3 = row.insertCell(2);
+                            
+                            cell1.textContent = topic;
+                            cell2.textContent = subscribers.length;
+                            cell3.innerHTML = `<button onclick="publishToTopic('${topic}')">发布消息</button>`;
+                        });
+                    })
+                    .catch(error => console.error('获取主题失败:', error));
+            }
+            
+            // 弹出对话框发布消息到主题
+            function publishToTopic(topic) {
+                const message = prompt(`发送消息到主题 ${topic}:`, '');
+                if (message === null) return;
+                
+                fetch('/publish', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json'
+                    },
+                    body: JSON.stringify({
+                        topic: topic,
+                        message: message,
+                        qos: 0
+                    })
+                })
+                .then(response => response.json())
+                .then(data => {
+                    alert('消息已发布');
+                })
+                .catch(error => console.error('发布消息失败:', error));
+            }
+            
+            // ==== MQTT 客户端测试 ====
+            
+            // 添加消息到日志
+            function addMessageToLog(message, type) {
+                const logDiv = document.getElementById('messageLog');
+                const now = new Date();
+                const timeStr = now.toLocaleTimeString();
+                const msgSpan = document.createElement('div');
+                msgSpan.style.marginBottom = '5px';
+                
+                if (type === 'info') {
+                    msgSpan.style.color = 'blue';
+                } else if (type === 'error') {
+                    msgSpan.style.color = 'red';
+                } else if (type === 'success') {
+                    msgSpan.style.color = 'green';
+                } else if (type === 'received') {
+                    msgSpan.style.color = 'purple';
+                }
+                
+                msgSpan.innerHTML = `<strong>[${timeStr}]</strong> ${message}`;
+                logDiv.appendChild(msgSpan);
+                logDiv.scrollTop = logDiv.scrollHeight;
+            }
+            
+            // 清除消息日志
+            function clearMessages() {
+                document.getElementById('messageLog').innerHTML = '';
+            }
+            
+            // 连接MQTT客户端
+            function connectClient() {
+                const clientId = document.getElementById('clientId').value;
+                const username = document.getElementById('clientUsername').value;
+                const password = document.getElementById('clientPassword').value;
+                
+                fetch('/mqtt/connect', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json'
+                    },
+                    body: JSON.stringify({
+                        client_id: clientId,
+                        username: username || null,
+                        password: password || null
+                    })
+                })
+                .then(response => response.json())
+                .then(data => {
+                    if (data.success) {
+                        addMessageToLog('已连接到MQTT服务器', 'success');
+                        document.getElementById('connectBtn').disabled = true;
+                        document.getElementById('disconnectBtn').disabled = false;
+                        document.getElementById('subscribeBtn').disabled = false;
+                        document.getElementById('publishBtn').disabled = false;
+                        
+                        // 开始接收推送的消息
+                        streamMessages(clientId);
+                    } else {
+                        addMessageToLog(`连接失败: ${data.message}`, 'error');
+                    }
+                })
+                .catch(error => {
+                    console.error('连接失败:', error);
+                    addMessageToLog(`连接错误: ${error.message}`, 'error');
+                });
+            }
+            
+            // 断开MQTT客户端连接
+            function disconnectClient() {
+                const clientId = document.getElementById('clientId').value;
+                
+                fetch('/mqtt/disconnect', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json'
+                    },
+                    body: JSON.stringify({
+                        client_id: clientId
+                    })
+                })
+                .then(response => response.json())
+                .then(data => {
+                    if (messageStream) {
+                        messageStream.close();
+                        messageStream = null;
+                    }
+                    addMessageToLog('已断开连接', 'info');
+                    document.getElementById('connectBtn').disabled = false;
+                    document.getElementById('disconnectBtn').disabled = true;
+                    document.getElementById('subscribeBtn').disabled = true;
+                    document.getElementById('unsubscribeBtn').disabled = true;
+                    document.getElementById('publishBtn').disabled = true;
+                })
+                .catch(error => {
+                    console.error('断开连接失败:', error);
+                    addMessageToLog(`断开连接错误: ${error.message}`, 'error');
+                });
+            }
+            
+            // 订阅主题
+            function subscribeTopic() {
+                const clientId = document.getElementById('clientId').value;
+                const topic = document.getElementById('subscribeTopic').value;
+                const qos = parseInt(document.getElementById('subscribeQos').value);
+                
+                fetch('/mqtt/subscribe', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json'
+                    },
+                    body: JSON.stringify({
+                        client_id: clientId,
+                        topic: topic,
+                        qos: qos
+                    })
+                })
+                .then(response => response.json())
+                .then(data => {
+                    if (data.success) {
+                        addMessageToLog(`已订阅主题: ${topic}, QoS=${qos}`, 'success');
+                        document.getElementById('unsubscribeBtn').disabled = false;
+                    } else {
+                        addMessageToLog(`订阅失败: ${data.message}`, 'error');
+                    }
+                })
+                .catch(error => {
+                    console.error('订阅失败:', error);
+                    addMessageToLog(`订阅错误: ${error.message}`, 'error');
+                });
+            }
+            
+            // 取消订阅主题
+            function unsubscribeTopic() {
+                const clientId = document.getElementById('clientId').value;
+                const topic = document.getElementById('subscribeTopic').value;
+                
+                fetch('/mqtt/unsubscribe', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json'
+                    },
+                    body: JSON.stringify({
+                        client_id: clientId,
+                        topic: topic
+                    })
+                })
+                .then(response => response.json())
+                .then(data => {
+                    addMessageToLog(`已取消订阅主题: ${topic}`, 'info');
+                    document.getElementById('unsubscribeBtn').disabled = true;
+                })
+                .catch(error => {
+                    console.error('取消订阅失败:', error);
+                    addMessageToLog(`取消订阅错误: ${error.message}`, 'error');
+                });
+            }
+            
+            // 发布消息
+            function publishMessage() {
+                const clientId = document.getElementById('clientId').value;
+                const topic = document.getElementById('publishTopic').value;
+                const payload = document.getElementById('publishPayload').value;
+                const qos = parseInt(document.getElementById('publishQos').value);
+                
+                fetch('/mqtt/publish', {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json'
+                    },
+                    body: JSON.stringify({
+                        client_id: clientId,
+                        topic: topic,
+                        message: payload,
+                        qos: qos
+                    })
+                })
+                .then(response => response.json())
+                .then(data => {
+                    if (data.success) {
+                        addMessageToLog(`已发布消息到主题: ${topic}, 消息: ${payload}`, 'success');
+                    } else {
+                        addMessageToLog(`发布失败: ${data.message}`, 'error');
+                    }
+                })
+                .catch(error => {
+                    console.error('发布失败:', error);
+                    addMessageToLog(`发布错误: ${error.message}`, 'error');
+                });
+            }
+            
+            // 通过Server-Sent Events接收推送的消息，浏览器不支持时退回轮询
+            let messageStream = null;
+            function streamMessages(clientId) {
+                if (!window.EventSource) {
+                    pollMessages(clientId);
+                    return;
+                }
+                messageStream = new EventSource(`/mqtt/stream/${encodeURIComponent(clientId)}`);
+                messageStream.onmessage = event => {
+                    const data = JSON.parse(event.data);
+                    if (data.dropped > 0) {
+                        addMessageToLog(`接收缓冲区已满，丢弃了${data.dropped}条消息`, 'error');
+                    }
+                    data.messages.forEach(msg => {
+                        addMessageToLog(`接收到消息: 主题=${msg.topic}, 内容=${msg.payload}`, 'received');
+                    });
+                };
+                messageStream.onerror = () => {
+                    console.error('消息推送连接中断，浏览器将自动重连');
+                };
+            }
+            
+            // 轮询接收消息
+            function pollMessages(clientId) {
+                if (!document.getElementById('disconnectBtn').disabled) {
+                    fetch(`/mqtt/messages/${clientId}`)
+                        .then(response => response.json())
+                        .then(data => {
+                            if (data.messages && data.messages.length > 0) {
+                                data.messages.forEach(msg => {
+                                    addMessageToLog(`接收到消息: 主题=${msg.topic}, 内容=${msg.payload}`, 'received');
+                                });
+                            }
+                            
+                            // 继续轮询
+                            setTimeout(() => pollMessages(clientId), 1000);
+                        })
+                        .catch(error => {
+                            console.error('获取消息失败:', error);
+                            setTimeout(() => pollMessages(clientId), 5000);
+                        });
+                }
+            }
+        </script>
+    </body>
+    </html>
+    """
+    return html_content
+
+# 获取配置
+@app.get("/config")
+async def get_config():
+    """获取MQTT服务器配置"""
+    return {
+        "host": mqtt_config.host,
+        "port": mqtt_config.port,
+        "allow_anonymous": mqtt_config.allow_anonymous,
+        "max_connections": mqtt_config.max_connections,
+        "max_keepalive": mqtt_config.max_keepalive,
+        "max_queued_messages": mqtt_config.max_queued_messages,
+        "slow_consumer_policy": mqtt_config.slow_consumer_policy,
+        "max_inflight_messages": mqtt_config.max_inflight_messages,
+        "retry_interval": mqtt_config.retry_interval,
+        "shared_subscription_strategy": mqtt_config.shared_subscription_strategy,
+        "max_packet_size": mqtt_config.max_packet_size,
+        "stream_threshold": mqtt_config.stream_threshold,
+        "topic_alias_maximum": mqtt_config.topic_alias_maximum,
+        "write_coalesce_us": mqtt_config.write_coalesce_us,
+        "virtual_client_buffer": mqtt_config.virtual_client_buffer,
+        "virtual_client_ttl": mqtt_config.virtual_client_ttl,
+        "engine": mqtt_config.engine,
+        "use_uvloop": mqtt_config.use_uvloop
+    }
+
+# 更新配置
+@app.post("/config")
+async def update_config(config: MQTTConfigModel):
+    """更新MQTT服务器配置"""
+    if config.slow_consumer_policy is not None and config.slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+        raise HTTPException(status_code=400, detail="不支持的慢消费者策略")
+    if (config.shared_subscription_strategy is not None
+            and config.shared_subscription_strategy not in SHARED_STRATEGIES):
+        raise HTTPException(status_code=400, detail="不支持的共享订阅策略")
+    if config.virtual_client_buffer is not None and config.virtual_client_buffer < 1:
+        raise HTTPException(status_code=400, detail="虚拟客户端缓冲区大小必须大于0")
+    
+    mqtt_config.host = config.host
+    mqtt_config.port = config.port
+    mqtt_config.allow_anonymous = config.allow_anonymous
+    mqtt_config.max_connections = config.max_connections
+    mqtt_config.max_keepalive = config.max_keepalive
+    if config.max_queued_messages is not None:
+        mqtt_config.max_queued_messages = config.max_queued_messages
+    if config.slow_consumer_policy is not None:
+        mqtt_config.slow_consumer_policy = config.slow_consumer_policy
+    if config.max_inflight_messages is not None:
+        mqtt_config.max_inflight_messages = config.max_inflight_messages
+    if config.retry_interval is not None:
+        mqtt_config.retry_interval = config.retry_interval
+    if config.shared_subscription_strategy is not None:
+        mqtt_config.shared_subscription_strategy = config.shared_subscription_strategy
+    if config.max_packet_size is not None:
+        mqtt_config.max_packet_size = config.max_packet_size
+    if config.stream_threshold is not None:
+        mqtt_config.stream_threshold = config.stream_threshold
+    if config.topic_alias_maximum is not None:
+        mqtt_config.topic_alias_maximum = config.topic_alias_maximum
+    if config.write_coalesce_us is not None:
+        mqtt_config.write_coalesce_us = config.write_coalesce_us
+    if config.virtual_client_buffer is not None:
+        mqtt_config.virtual_client_buffer = config.virtual_client_buffer
+    if config.virtual_client_ttl is not None:
+        mqtt_config.virtual_client_ttl = config.virtual_client_ttl
+    
+    return {"success": True, "message": "配置已更新"}
+
+# 获取用户列表
+@app.get("/users")
+async def get_users():
+    """获取MQTT用户列表"""
+    return list(mqtt_config.users.keys())
+
+# 添加用户
+@app.post("/users")
+async def add_user(user: User):
+    """添加MQTT用户"""
+    mqtt_config.users[user.username] = user.password
+    return {"success": True, "message": "用户已添加"}
+
+# 删除用户
+@app.delete("/users/{username}")
+async def delete_user(username: str):
+    """删除MQTT用户"""
+    if username in mqtt_config.users:
+        del mqtt_config.users[username]
+        return {"success": True, "message": "用户已删除"}
+    else:
+        raise HTTPException(status_code=404, detail="用户不存在")
+
+# 获取客户端列表
+@app.get("/clients")
+async def get_clients():
+    """获取已连接客户端列表，以及已断开但保留会话的客户端"""
+    return await call_in_server_loop(snapshot_clients)
+
+def snapshot_clients():
+    """（MQTT服务器的事件循环）汇总客户端状态"""
+    result = {}
+    for client_id, client in list(clients.items()) + list(sessions.items()):
+        result[client_id] = {
+            "username": client.username,
+            "connected": client.connected,
+            "protocol_level": client.protocol_level,
+            "subscriptions": list(client.subscriptions),
+            "queue_depth": client.queue_depth,
+            "dropped_messages": client.dropped_messages,
+            "inflight": len(client.inflight),
+            "pending": len(client.pending),
+            "offline_messages": len(client.offline) if client.offline else 0
+        }
+    return result
+
+# 获取主题订阅列表
+@app.get("/topics")
+async def get_topics():
+    """获取主题订阅列表"""
+    return await call_in_server_loop(topics.to_dict)
+
+# 获取保留消息的主题列表
+@app.get("/retained")
+async def get_retained():
+    """获取保留消息的主题列表"""
+    return await call_in_server_loop(lambda: sorted(retained_messages.topics()))
+
+# Prometheus格式的运行指标
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """输出Prometheus文本格式的运行指标，队列等状态在抓取时汇总"""
+    text = await call_in_server_loop(render_metrics)
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
+
+def render_metrics() -> str:
+    """（MQTT服务器的事件循环）汇总队列等状态并输出指标"""
+    online = list(clients.values())
+    gauges = [
+        ("mqtt_clients_connected", "Connected clients", len(online)),
+        ("mqtt_sessions_offline", "Disconnected clients with a persistent session", len(sessions)),
+        ("mqtt_subscriptions", "Subscriptions in the topic tree",
+         sum(len(filters) for filters in list(topics.client_filters.values()))),
+        ("mqtt_retained_messages", "Retained messages", retained_messages.count),
+        ("mqtt_queued_messages", "Messages waiting in client send queues",
+         sum(client.queue_depth + len(client.pending) for client in online)),
+        ("mqtt_inflight_messages", "Unacknowledged QoS 1/2 messages", sum(client.inflight_count for client in online)),
+        ("mqtt_offline_messages", "Messages stored for offline sessions",
+         sum(len(session.offline) for session in list(sessions.values()) if session.offline is not None)),
+        ("mqtt_virtual_clients", "Connected virtual (in-process) clients", len(virtual_clients)),
+        ("mqtt_virtual_buffered_messages", "Messages waiting in virtual client buffers",
+         sum(virtual.queue_depth for virtual in list(virtual_clients.values()))),
+    ]
+    return render_prometheus(metrics, gauges)
+
+def valid_qos(qos) -> bool:
+    """请求中的QoS必须是整数0、1或2（布尔值和浮点数无效）"""
+    return type(qos) is int and 0 <= qos <= 2
+
+# 向主题发布消息
+@app.post("/publish")
+async def publish_message(data: dict):
+    """向主题发布消息"""
+    topic = data.get("topic")
+    message = data.get("message")
+    qos = data.get("qos", 0)
+    retain = data.get("retain", False)
+    
+    if not topic or message is None:
+        raise HTTPException(status_code=400, detail="主题和消息不能为空")
+    if not isinstance(topic, str) or not valid_topic_name(topic):
+        raise HTTPException(status_code=400, detail="主题无效")
+    if not isinstance(message, str):
+        raise HTTPException(status_code=400, detail="消息必须是字符串")
+    if not valid_qos(qos):
+        raise HTTPException(status_code=400, detail="QoS无效")
+    if not isinstance(retain, bool):
+        raise HTTPException(status_code=400, detail="保留标志无效")
+    
+    # 导入必要的函数
+    from mqtt_server import publish_message as mqtt_publish
+    
+    # 发布消息
+    await mqtt_publish("admin", topic, message.encode('utf-8'), qos, retain)
+    
+    return {"success": True, "message": "消息已发布"}
+
+# 批量发布时每解析出这么多条消息就提交给MQTT服务器路由一次
+BATCH_ROUTE_SIZE = 1000
+
+# 批量发布消息
+@app.post("/publish/batch")
+async def publish_batch(request: Request):
+    """批量发布消息：请求体为二进制格式或NDJSON（见mqtt_batch），边接收边解析和路由，返回每条消息的结果"""
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    decoder_class = BATCH_DECODERS.get(content_type)
+    if decoder_class is None:
+        raise HTTPException(status_code=415, detail=f"Content-Type必须是{' 或 '.join(BATCH_DECODERS)}")
+    decoder = decoder_class(mqtt_config.max_packet_size)
+    
+    results = []
+    pending = []  # (结果, 消息)，攒够BATCH_ROUTE_SIZE条后一起路由
+    
+    def add(items):
+        for item in items:
+            index = len(results)
+            if isinstance(item, str):
+                results.append({"index": index, "success": False, "error": item})
+            elif not valid_topic_name(item[0]):
+                results.append({"index": index, "success": False, "error": "主题无效"})
+            else:
+                result = {"index": index, "success": True, "delivered": 0}
+                results.append(result)
+                pending.append((result, item))
+    
+    async def route_pending():
+        if not pending:
+            return
+        batch = pending[:]
+        pending.clear()
+        delivered = await call_in_server_loop(route_batch, "admin", [message for _, message in batch])
+        for (result, _), count in zip(batch, delivered):
+            result["delivered"] = count
+    
+    error = None
+    try:
+        async for chunk in request.stream():
+            add(decoder.feed(chunk))
+            if len(pending) >= BATCH_ROUTE_SIZE:
+                await route_pending()
+        add(decoder.close())
+    except ValueError as e:
+        # 请求体无法继续解析，已解析出的消息照常发布
+        error = f"索引为{len(results)}的消息: {e}"
+    await route_pending()
+    
+    response = {
+        "success": error is None,
+        "count": len(results),
+        "published": sum(1 for result in results if result["success"]),
+        "results": results
+    }
+    if error is not None:
+        response["error"] = error
+    return response
+
+# MQTT over WebSocket
+@app.websocket("/mqtt")
+async def mqtt_websocket(websocket: WebSocket):
+    """MQTT over WebSocket（子协议mqtt）：浏览器等客户端直接使用MQTT协议，与TCP客户端由同一套报文处理逻辑处理"""
+    await serve_websocket(websocket)
+
+# ==== Web MQTT客户端API ====
+
+# 推送流的一帧最多合并的消息数
+WEB_STREAM_BATCH = 100
+# 推送流空闲时发送注释行保持连接的间隔（秒）
+WEB_STREAM_KEEPALIVE = 15
+
+def format_messages(messages) -> List[dict]:
+    """把虚拟客户端取出的消息转换为JSON"""
+    return [{
+        "topic": topic,
+        "payload": message.decode('utf-8', errors='replace'),
+        "qos": qos
+    } for topic, message, qos in messages]
+
+# 连接MQTT客户端
+@app.post("/mqtt/connect")
+async def connect_mqtt_client(data: dict):
+    """连接MQTT客户端"""
+    client_id = data.get("client_id")
+    username = data.get("username")
+    password = data.get("password")
+    
+    if not client_id:
+        raise HTTPException(status_code=400, detail="客户端ID不能为空")
+    
+    # 在MQTT服务器中创建虚拟客户端：作为普通订阅者参与路由，消息放入内存中的缓冲区，由本服务取出
+    virtual = await call_in_server_loop(connect_virtual_client, client_id, asyncio.get_running_loop())
+    if virtual is None:
+        # ID已被MQTT客户端或其会话使用
+        return {"success": False, "message": "客户端已存在"}
+    
+    # 返回成功
+    return {"success": True, "message": "连接成功"}
+
+# 断开MQTT客户端连接
+@app.post("/mqtt/disconnect")
+async def disconnect_mqtt_client(data: dict):
+    """断开MQTT客户端连接"""
+    client_id = data.get("client_id")
+    
+    if not client_id:
+        raise HTTPException(status_code=400, detail="客户端ID不能为空")
+    
+    # 断开虚拟客户端，结束推送流，移除此客户端的所有订阅
+    if not await call_in_server_loop(disconnect_virtual_client, client_id):
+        return {"success": False, "message": "客户端不存在"}
+    
+    return {"success": True, "message": "已断开连接"}
+
+# 订阅主题
+@app.post("/mqtt/subscribe")
+async def subscribe_topic(data: dict):
+    """订阅主题"""
+    client_id = data.get("client_id")
+    topic = data.get("topic")
+    qos = data.get("qos", 0)
+    
+    if not client_id or not topic:
+        raise HTTPException(status_code=400, detail="客户端ID和主题不能为空")
+    if not isinstance(topic, str):
+        raise HTTPException(status_code=400, detail="订阅过滤器无效")
+    if not valid_qos(qos):
+        raise HTTPException(status_code=400, detail="QoS无效")
+    
+    shared = topic.startswith(SHARE_PREFIX)
+    if not (valid_shared_filter(topic) if shared else valid_topic_filter(topic)):
+        raise HTTPException(status_code=400, detail="订阅过滤器无效")
+    
+    virtual = virtual_clients.get(client_id)
+    if virtual is None:
+        return {"success": False, "message": "客户端未连接"}
+    
+    # 添加订阅
+    await call_in_server_loop(subscribe_virtual_client, virtual, topic, qos)
+    
+    return {"success": True, "message": "订阅成功"}
+
+# 取消订阅主题
+@app.post("/mqtt/unsubscribe")
+async def unsubscribe_topic(data: dict):
+    """取消订阅主题"""
+    client_id = data.get("client_id")
+    topic = data.get("topic")
+    
+    if not client_id or not topic:
+        raise HTTPException(status_code=400, detail="客户端ID和主题不能为空")
+    if not isinstance(topic, str):
+        raise HTTPException(status_code=400, detail="订阅过滤器无效")
+    
+    # 移除订阅
+    if topic.startswith(SHARE_PREFIX):
+        await call_in_server_loop(shared_subscriptions.unsubscribe, topic, client_id)
+    else:
+        await call_in_server_loop(topics.unsubscribe, topic, client_id)
+    
+    return {"success": True, "message": "取消订阅成功"}
+
+# 发布消息
+@app.post("/mqtt/publish")
+async def publish_mqtt_message(data: dict):
+    """发布MQTT消息"""
+    client_id = data.get("client_id")
+    topic = data.get("topic")
+    message = data.get("message")
+    qos = data.get("qos", 0)
+    
+    if not client_id or not topic or message is None:
+        raise HTTPException(status_code=400, detail="客户端ID、主题和消息不能为空")
+    if not isinstance(topic, str) or not valid_topic_name(topic):
+        raise HTTPException(status_code=400, detail="主题无效")
+    if not isinstance(message, str):
+        raise HTTPException(status_code=400, detail="消息必须是字符串")
+    if not valid_qos(qos):
+        raise HTTPException(status_code=400, detail="QoS无效")
+    
+    # 导入必要的函数
+    from mqtt_server import publish_message as mqtt_publish
+    
+    # 发布消息
+    await mqtt_publish(client_id, topic, message.encode('utf-8'), qos)
+    
+    return {"success": True, "message": "消息已发布"}
+
+# 获取消息
+@app.get("/mqtt/messages/{client_id}")
+async def get_mqtt_messages(client_id: str):
+    """获取MQTT消息（轮询）"""
+    virtual = virtual_clients.get(client_id)
+    if virtual is None:
+        return {"success": True, "messages": [], "dropped": 0}
+    
+    messages, evicted = virtual.take()
+    
+    return {"success": True, "messages": format_messages(messages), "dropped": evicted}
+
+# 推送消息
+@app.get("/mqtt/stream/{client_id}")
+async def stream_mqtt_messages(client_id: str):
+    """以Server-Sent Events推送MQTT消息，每个事件是一批消息 {"messages": [...], "dropped": n}"""
+    virtual = virtual_clients.get(client_id)
+    if virtual is None:
+        raise HTTPException(status_code=404, detail="客户端未连接")
+    
+    async def events():
+        while True:
+            try:
+                await asyncio.wait_for(virtual.ready.wait(), WEB_STREAM_KEEPALIVE)
+            except asyncio.TimeoutError:
+                virtual.touch()
+                yield ": keepalive\n\n"
+                continue
+            if virtual.closed:
+                break
+            messages, evicted = virtual.take(WEB_STREAM_BATCH)
+            if messages or evicted:
+                data = {'messages': format_messages(messages), 'dropped': evicted}
+                yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+# 启动MQTT服务器的函数
+def start_mqtt_server_thread():
+    """在单独的线程中启动MQTT服务器"""
+    run_event_loop(start_mqtt_server())
+
+# 单事件循环模式下运行MQTT服务器的任务
+mqtt_server_task: Optional[asyncio.Task] = None
+
+async def start_mqtt_server_in_app_loop():
+    """（单事件循环模式）Web服务启动时在uvicorn的事件循环中启动MQTT服务器"""
+    global mqtt_server_task
+    mqtt_server_task = asyncio.ensure_future(start_mqtt_server())
+    mqtt_server_task.add_done_callback(mqtt_server_stopped)
+
+async def stop_mqtt_server_in_app_loop():
+    """（单事件循环模式）Web服务停止时停止MQTT服务器"""
+    if mqtt_server_task is not None:
+        mqtt_server_task.cancel()
+
+def mqtt_server_stopped(task: asyncio.Task):
+    """MQTT服务器任务结束时记录异常退出"""
+    if not task.cancelled() and task.exception() is not None:
+        log_event("error", "MQTT服务器异常退出", error=repr(task.exception()))
+
+# 主程序
+def main(single_loop: bool = False, port: int = 8000):
+    """启动Web服务和MQTT服务器
+
+    single_loop为True时MQTT服务器与Web服务运行在uvicorn的同一个事件循环中，REST接口直接操作服务器状态；
+    否则MQTT服务器在单独线程的事件循环中运行，REST接口通过call_in_server_loop提交操作。
+    """
+    if single_loop:
+        app.router.on_startup.append(start_mqtt_server_in_app_loop)
+        app.router.on_shutdown.append(stop_mqtt_server_in_app_loop)
+        uvicorn.run(app, host="0.0.0.0", port=port, loop="auto" if mqtt_config.use_uvloop else "asyncio")
+        return
+    
+    # 在单独的线程中启动MQTT服务器
+    mqtt_thread = threading.Thread(target=start_mqtt_server_thread, daemon=True)
+    mqtt_thread.start()
+    
+    # 启动FastAPI服务器
+    uvicorn.run(app, host="0.0.0.0", port=port)
+
+if __name__ == "__main__":
     main() 
\ No newline at end of file
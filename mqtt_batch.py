@@ -0,0 +1,169 @@
+"""
+批量发布（POST /publish/batch）的请求体格式
+
+支持两种格式，都可以边接收边解析，解码器每次收到一段数据就返回其中所有完整的消息：
+
+- 二进制（application/octet-stream）：消息依次排列，每条为
+  标志(1字节，位0-1为QoS，位2为保留标志) | 主题长度(2字节) | 主题(UTF-8) | 负载长度(4字节) | 负载，
+  长度均为大端序
+- NDJSON（application/x-ndjson）：每行一个JSON对象
+  {"topic": "...", "payload": "<base64>", "qos": 0, "retain": false}，
+  文本消息也可以用 "message": "..." 代替payload
+
+解码得到的每一项是 (主题, 消息内容, QoS, 保留标志)，无法解析的单条消息是说明原因的字符串；
+整个请求体无法继续解析时（如二进制格式的消息不完整或超长），先返回之前解析出的消息，
+之后的feed或close抛出ValueError。
+"""
+import base64
+import binascii
+import json
+import struct
+from typing import List, Optional, Sequence, Tuple, Union
+
+BINARY_CONTENT_TYPE = "application/octet-stream"
+NDJSON_CONTENT_TYPE = "application/x-ndjson"
+
+# 二进制格式的标志位
+QOS_MASK = 0x03
+RETAIN_FLAG = 0x04
+
+BATCH_HEAD = struct.Struct("!BH")  # 标志、主题长度
+PAYLOAD_LENGTH = struct.Struct("!I")
+
+BatchItem = Union[Tuple[str, bytes, int, bool], str]
+
+def encode_batch(messages: Sequence[Tuple[str, bytes, int, bool]]) -> bytes:
+    """把 (主题, 消息内容, QoS, 保留标志) 编码为二进制格式的请求体"""
+    parts = []
+    for topic, payload, qos, retain in messages:
+        topic_bytes = topic.encode('utf-8')
+        parts.append(BATCH_HEAD.pack(qos | (RETAIN_FLAG if retain else 0), len(topic_bytes)))
+        parts.append(topic_bytes)
+        parts.append(PAYLOAD_LENGTH.pack(len(payload)))
+        parts.append(payload)
+    return b"".join(parts)
+
+class BinaryBatchDecoder:
+    """增量解码二进制格式的请求体"""
+
+    def __init__(self, max_payload: int = 0):
+        self.max_payload = max_payload  # 单条消息负载的最大长度，0表示不限制
+        self.buffer = bytearray()
+        self.error: Optional[str] = None  # 无法继续解析的原因
+
+    def feed(self, data) -> List[BatchItem]:
+        if self.error is not None:
+            raise ValueError(self.error)
+        buffer = self.buffer
+        buffer += data
+        items: List[BatchItem] = []
+        size = len(buffer)
+        offset = 0
+        while size - offset >= BATCH_HEAD.size:
+            flags, topic_length = BATCH_HEAD.unpack_from(buffer, offset)
+            topic_end = offset + BATCH_HEAD.size + topic_length
+            if size - topic_end < PAYLOAD_LENGTH.size:
+                break
+            payload_length, = PAYLOAD_LENGTH.unpack_from(buffer, topic_end)
+            if self.max_payload and payload_length > self.max_payload:
+                # 不缓冲超长的消息，停止解析
+                self.error = "消息超过最大报文长度"
+                break
+            payload_start = topic_end + PAYLOAD_LENGTH.size
+            end = payload_start + payload_length
+            if end > size:
+                break
+            if flags & ~(QOS_MASK | RETAIN_FLAG) or flags & QOS_MASK == QOS_MASK:
+                items.append("标志无效")
+            else:
+                try:
+                    topic = bytes(buffer[offset + BATCH_HEAD.size:topic_end]).decode('utf-8')
+                except UnicodeDecodeError:
+                    items.append("主题不是有效的UTF-8")
+                else:
+                    payload = bytes(buffer[payload_start:end])
+                    items.append((topic, payload, flags & QOS_MASK, bool(flags & RETAIN_FLAG)))
+            offset = end
+        del buffer[:offset]
+        return items
+
+    def close(self) -> List[BatchItem]:
+        """请求体结束，剩余的数据不足一条消息时抛出ValueError"""
+        if self.error is not None:
+            raise ValueError(self.error)
+        if self.buffer:
+            raise ValueError("最后一条消息不完整")
+        return []
+
+class NdjsonBatchDecoder:
+    """增量解码NDJSON格式的请求体"""
+
+    def __init__(self, max_payload: int = 0):
+        self.max_payload = max_payload
+        # base64编码后长度增加1/3，另留出主题等字段的空间
+        self.max_line = max_payload * 4 // 3 + 65536 if max_payload else 0
+        self.buffer = bytearray()
+        self.error: Optional[str] = None
+
+    def feed(self, data) -> List[BatchItem]:
+        if self.error is not None:
+            raise ValueError(self.error)
+        buffer = self.buffer
+        buffer += data
+        items: List[BatchItem] = []
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line = bytes(buffer[start:end]).strip()
+            start = end + 1
+            if line:
+                items.append(self.decode_line(line))
+        del buffer[:start]
+        if self.max_line and len(buffer) > self.max_line:
+            self.error = "消息超过最大报文长度"
+            buffer.clear()
+        return items
+
+    def close(self) -> List[BatchItem]:
+        if self.error is not None:
+            raise ValueError(self.error)
+        line = bytes(self.buffer).strip()
+        self.buffer.clear()
+        return [self.decode_line(line)] if line else []
+
+    def decode_line(self, line: bytes) -> BatchItem:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            return "不是有效的JSON"
+        if not isinstance(record, dict):
+            return "每行必须是JSON对象"
+        topic = record.get("topic")
+        if not isinstance(topic, str):
+            return "缺少主题"
+        qos = record.get("qos", 0)
+        if type(qos) is not int or qos not in (0, 1, 2):
+            return "QoS无效"
+        retain = record.get("retain", False)
+        if not isinstance(retain, bool):
+            return "保留标志无效"
+        if "payload" in record:
+            try:
+                payload = base64.b64decode(record["payload"], validate=True)
+            except (binascii.Error, TypeError, ValueError):
+                return "payload不是有效的base64"
+        elif isinstance(record.get("message"), str):
+            payload = record["message"].encode('utf-8')
+        else:
+            return "缺少payload或message"
+        if self.max_payload and len(payload) > self.max_payload:
+            return "消息超过最大报文长度"
+        return topic, payload, qos, retain
+
+# Content-Type -> 解码器
+BATCH_DECODERS = {
+    BINARY_CONTENT_TYPE: BinaryBatchDecoder,
+    NDJSON_CONTENT_TYPE: NdjsonBatchDecoder,
+}
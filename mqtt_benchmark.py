@@ -0,0 +1,1201 @@
+#!/usr/bin/env python
+"""
+MQTT服务器性能测试脚本
+"""
+import argparse
+import asyncio
+import base64
+import contextlib
+import importlib.util
+import io
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import mqtt_logging
+import mqtt_server
+from mqtt_batch import BINARY_CONTENT_TYPE, NDJSON_CONTENT_TYPE, encode_batch
+from mqtt_server import (mqtt_config, ENGINES, Client, MQTTFrameDecoder, MQTTProtocol, CONNECT, PUBLISH, PUBACK,
+                         PUBREC, PUBREL, PUBCOMP, SUBSCRIBE, READ_CHUNK_SIZE, TopicTrie, build_publish_header,
+                         encode_ack, encode_remaining_length, metrics, route_message, run_event_loop,
+                         start_mqtt_server)
+from mqtt_v5 import TOPIC_ALIAS, encode_properties
+
+def build_publish_frame(topic, payload, qos=0, message_id=1):
+    """构建一个PUBLISH数据包"""
+    header = build_publish_header(topic.encode('utf-8'), qos, len(payload))
+    if qos > 0:
+        return header + message_id.to_bytes(2, 'big') + payload
+    return header + payload
+
+def encode_string(value):
+    """编码带2字节长度前缀的UTF-8字符串"""
+    data = value.encode('utf-8')
+    return len(data).to_bytes(2, 'big') + data
+
+class BenchClient:
+    """性能测试用的最小asyncio MQTT客户端"""
+
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.reader = None
+        self.writer = None
+        self.decoder = MQTTFrameDecoder()
+        self.frames = []
+
+    async def connect(self, host, port, keepalive=0, clean_session=True):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        body = encode_string("MQTT") + bytes([4, 0x02 if clean_session else 0]) + keepalive.to_bytes(2, 'big')
+        body += encode_string(self.client_id)
+        self.writer.write(bytes([CONNECT << 4]) + bytes(encode_remaining_length(len(body))) + body)
+        await self.writer.drain()
+        await self.read_frame()  # CONNACK
+
+    async def subscribe(self, topic_filter, qos=0, message_id=1):
+        body = message_id.to_bytes(2, 'big') + encode_string(topic_filter) + bytes([qos])
+        self.writer.write(bytes([SUBSCRIBE << 4 | 0x02]) + bytes(encode_remaining_length(len(body))) + body)
+        await self.writer.drain()
+        await self.read_frame()  # SUBACK
+
+    def publish(self, topic, payload, qos=0, message_id=1):
+        """只写入发送缓冲区，调用方负责drain"""
+        self.writer.write(build_publish_frame(topic, payload, qos, message_id))
+
+    def send(self, data):
+        """写入任意数据包（如确认报文），调用方负责drain"""
+        self.writer.write(data)
+
+    async def read_frames(self):
+        """读取一次套接字，返回其中所有完整的数据包"""
+        if self.frames:
+            frames, self.frames = self.frames, []
+            return frames
+        data = await self.reader.read(65536)
+        if not data:
+            raise ConnectionError("连接已关闭")
+        return self.decoder.feed(data)
+
+    async def read_frame(self):
+        while not self.frames:
+            self.frames = await self.read_frames()
+        return self.frames.pop(0)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except ConnectionError:
+                pass
+
+# 压测时每个发布者最多领先其订阅者的消息数
+PUBLISH_WINDOW = 400
+
+def wait_for_port(host, port, timeout=10.0):
+    """等待服务器开始监听"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"服务器未在 {host}:{port} 启动")
+
+def make_stream(count, payload_size):
+    """生成由count个连续PUBLISH数据包组成的字节流"""
+    frame = build_publish_frame("bench/sensor/1", b"x" * payload_size)
+    return frame * count
+
+def chunks(data, chunk_size):
+    """按套接字读取的粒度切分字节流"""
+    return [data[i:i+chunk_size] for i in range(0, len(data), chunk_size)]
+
+async def legacy_read(stream_chunks, count):
+    """旧实现：逐字节调用readexactly读取固定头和剩余长度"""
+    reader = asyncio.StreamReader(limit=2 ** 30)
+    for chunk in stream_chunks:
+        reader.feed_data(chunk)
+    reader.feed_eof()
+
+    frames = 0
+    while frames < count:
+        await reader.readexactly(1)
+        multiplier = 1
+        remaining_length = 0
+        while True:
+            byte = await reader.readexactly(1)
+            remaining_length += (byte[0] & 127) * multiplier
+            multiplier *= 128
+            if byte[0] & 128 == 0:
+                break
+        if remaining_length > 0:
+            await reader.readexactly(remaining_length)
+        frames += 1
+    return frames
+
+def decoder_read(stream_chunks):
+    """新实现：每次读取后一次性解码缓冲区中的所有数据包"""
+    decoder = MQTTFrameDecoder()
+    frames = 0
+    for chunk in stream_chunks:
+        frames += len(decoder.feed(chunk))
+    return frames
+
+def bench_decoder(args):
+    """比较帧解码器与逐字节读取的吞吐量"""
+    stream_chunks = chunks(make_stream(args.count, args.payload_size), args.chunk_size)
+
+    start = time.perf_counter()
+    frames = asyncio.run(legacy_read(stream_chunks, args.count))
+    legacy_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    decoded = decoder_read(stream_chunks)
+    decoder_elapsed = time.perf_counter() - start
+    assert decoded == frames == args.count
+
+    print(f"数据包数: {args.count}, 负载大小: {args.payload_size}字节, 读取块大小: {args.chunk_size}字节")
+    print(f"readexactly逐字节读取: {frames / legacy_elapsed:,.0f} 帧/秒")
+    print(f"MQTTFrameDecoder:      {decoded / decoder_elapsed:,.0f} 帧/秒")
+
+def legacy_encode(topic, message, qos, message_id):
+    """旧实现：为每个订阅者重新构建整个PUBLISH数据包"""
+    first_byte = PUBLISH << 4
+    if qos > 0:
+        first_byte |= 2
+    topic_bytes = topic.encode('utf-8')
+    var_header_len = 2 + len(topic_bytes)
+    if qos > 0:
+        var_header_len += 2
+    remaining_length_bytes = encode_remaining_length(var_header_len + len(message))
+    packet = bytearray([first_byte]) + remaining_length_bytes
+    packet.extend([len(topic_bytes) >> 8, len(topic_bytes) & 0xFF])
+    packet.extend(topic_bytes)
+    if qos > 0:
+        packet.extend([(message_id >> 8) & 0xFF, message_id & 0xFF])
+    packet.extend(message)
+    return [packet]
+
+# 扇出测试中订阅者的发送队列和发送窗口每投递这么多条消息清空一次（不计入耗时）
+ENCODE_WINDOW = 1000
+
+class NullWriter:
+    """扇出测试中订阅者的writer：不建立连接，发送队列由测试清空"""
+    transport = None
+
+def encode_subscribers(topic, count, qos):
+    """在订阅树中注册count个订阅topic的在线客户端"""
+    subscribers = []
+    for i in range(count):
+        client = Client(f"encode-sub-{i}", NullWriter())
+        mqtt_server.clients[client.client_id] = client
+        mqtt_server.topics.subscribe(topic, client.client_id, qos)
+        subscribers.append(client)
+    return subscribers
+
+def drain_subscribers(subscribers):
+    """清空发送队列并释放发送窗口，相当于报文已写出、消息已被确认"""
+    for client in subscribers:
+        client.message_queue.clear()
+        client.message_times.clear()
+        for entry in list(client.inflight.values()):
+            client._release_inflight(entry)
+
+def legacy_route(topic, message, qos):
+    """旧实现：为每个订阅者单独编码数据包（QoS>0时为头部和消息内容的拷贝）再投递"""
+    clients = mqtt_server.clients
+    for client_id in mqtt_server.topics.match(topic):
+        client = clients[client_id]
+        if qos == 0:
+            client.enqueue(legacy_encode(topic, message, qos, 0))
+        else:
+            # 与route_message相同，经发送窗口分配消息ID
+            client.publish(build_publish_header(topic.encode('utf-8'), qos, len(message)), bytes(message), qos)
+
+def encode_rate(args, subscribers, deliver) -> float:
+    """调用args.messages次deliver()，返回每秒投递次数"""
+    elapsed = 0.0
+    sent = 0
+    while sent < args.messages:
+        batch = min(ENCODE_WINDOW, args.messages - sent)
+        start = time.perf_counter()
+        for _ in range(batch):
+            deliver()
+        elapsed += time.perf_counter() - start
+        drain_subscribers(subscribers)
+        sent += batch
+    return args.messages * len(subscribers) / elapsed
+
+async def encode_fanout(args):
+    """在事件循环中运行（QoS>0的投递会排期重发），返回 (旧实现, route_message) 的每秒投递次数"""
+    topic = "telemetry/site-001/device-0001/waveform"
+    message = b"x" * args.payload_size
+    subscribers = encode_subscribers(topic, args.subscribers, args.qos)
+    try:
+        legacy = encode_rate(args, subscribers, lambda: legacy_route(topic, message, args.qos))
+        shared = encode_rate(args, subscribers, lambda: route_message("encode-pub", topic, message, args.qos))
+    finally:
+        for client in subscribers:
+            mqtt_server.topics.unsubscribe_all(client.client_id)
+            mqtt_server.clients.pop(client.client_id, None)
+    return legacy, shared
+
+def bench_encode(args):
+    """比较逐订阅者构建与共享编码结果的扇出开销：两者都放入真实客户端的发送队列"""
+    saved = mqtt_config.max_queued_messages, mqtt_config.max_inflight_messages
+    # 每轮清空之前，队列和窗口都能容纳一轮的全部消息
+    mqtt_config.max_queued_messages = mqtt_config.max_inflight_messages = ENCODE_WINDOW
+    try:
+        legacy, shared = asyncio.run(encode_fanout(args))
+    finally:
+        mqtt_config.max_queued_messages, mqtt_config.max_inflight_messages = saved
+
+    print(f"扇出: 1对{args.subscribers}, 负载大小: {args.payload_size}字节, QoS: {args.qos}")
+    print(f"逐订阅者构建（旧实现）: {legacy:,.0f} 次投递/秒")
+    print(f"route_message共享编码: {shared:,.0f} 次投递/秒")
+
+def bench_logging(args):
+    """比较逐条print与日志队列（关闭、采样）记录PUBLISH事件的开销"""
+    message = b"x" * args.payload_size
+    topic = "telemetry/site-001/device-0001/waveform"
+
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(args.messages):
+            print(f"收到来自客户端 bench 的发布消息: 主题={topic}, 消息={message.decode('utf-8')}")
+    print_elapsed = time.perf_counter() - start
+
+    results = []
+    for label, level in (("publish事件关闭（默认）", "DEBUG"), (f"采样 {args.sample_rate:g} 条/秒", "INFO")):
+        mqtt_logging.configure(logging.INFO, args.sample_rate, 64, {"publish": level}, stream=io.StringIO())
+        start = time.perf_counter()
+        for _ in range(args.messages):
+            if mqtt_logging.enabled("publish"):
+                mqtt_logging.log_event("publish", "收到发布消息", client_id="bench", topic=topic, qos=0,
+                                       payload=mqtt_logging.preview(message))
+        results.append((label, time.perf_counter() - start))
+
+    print(f"消息数: {args.messages}, 负载大小: {args.payload_size}字节")
+    print(f"{'print':<24} {args.messages / print_elapsed:>14,.0f} 条/秒")
+    for label, elapsed in results:
+        print(f"{label:<24} {args.messages / elapsed:>14,.0f} 条/秒")
+
+def alias_topic(index):
+    """主题别名测试用的设备主题：层级多、名称长"""
+    return f"factory/plant-03/line-{index % 16:02d}/cell-{index % 8:02d}/robot-{index:04d}/axis-5/temperature"
+
+def v5_publish_frame(topic, payload, qos=0, message_id=1, properties=None):
+    """构建MQTT 5的PUBLISH数据包"""
+    body = encode_properties(properties) + payload
+    header = build_publish_header(topic.encode('utf-8'), qos, len(body))
+    if qos > 0:
+        return header + message_id.to_bytes(2, 'big') + body
+    return header + body
+
+def bench_alias(args):
+    """比较MQTT 3.1.1、MQTT 5和MQTT 5主题别名的上行字节数"""
+    payload = b"x" * args.payload_size
+    totals = {"MQTT 3.1.1": 0, "MQTT 5": 0, "MQTT 5 主题别名": 0}
+    aliases = {}
+    for i in range(args.messages):
+        topic = alias_topic(i % args.topics)
+        totals["MQTT 3.1.1"] += len(build_publish_frame(topic, payload, args.qos))
+        totals["MQTT 5"] += len(v5_publish_frame(topic, payload, args.qos))
+        # 每个主题第一次发布时带上主题建立别名，之后只发送2字节的别名
+        alias = aliases.get(topic)
+        if alias is None:
+            alias = aliases[topic] = len(aliases) + 1
+            frame = v5_publish_frame(topic, payload, args.qos, properties={TOPIC_ALIAS: alias})
+        else:
+            frame = v5_publish_frame("", payload, args.qos, properties={TOPIC_ALIAS: alias})
+        totals["MQTT 5 主题别名"] += len(frame)
+
+    baseline = totals["MQTT 3.1.1"]
+    print(f"消息数: {args.messages}, 主题数: {args.topics}, 主题长度: {len(alias_topic(0))}字节, "
+          f"负载大小: {args.payload_size}字节, QoS: {args.qos}")
+    for label, total in totals.items():
+        print(f"{label:<16} {total / args.messages:>8.1f} 字节/条  {100 * (1 - total / baseline):>6.1f}% 节省")
+
+class SinkTransport(asyncio.Transport):
+    """零拷贝测试用的transport：保留写入的数据直到测量结束，writelines沿用基类的拼接实现"""
+
+    def __init__(self):
+        super().__init__()
+        self.written = []
+
+    def write(self, data):
+        self.written.append(data)
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+def connect_frame(client_id):
+    body = encode_string("MQTT") + bytes([4, 0x02]) + (0).to_bytes(2, 'big') + encode_string(client_id)
+    return bytes([CONNECT << 4]) + bytes(encode_remaining_length(len(body))) + body
+
+def subscribe_frame(topic_filter, qos):
+    body = (1).to_bytes(2, 'big') + encode_string(topic_filter) + bytes([qos])
+    return bytes([SUBSCRIBE << 4 | 0x02]) + bytes(encode_remaining_length(len(body))) + body
+
+class LegacyForwarder:
+    """旧实现：解码时拷贝剩余数据，切出消息内容，QoS 0拼接完整数据包，QoS>0按数据块列表交给writelines"""
+
+    def __init__(self, transports, qos):
+        self.buffer = bytearray()
+        self.transports = transports
+        self.qos = qos
+
+    def feed(self, data):
+        buf = self.buffer
+        buf += data
+        pos = 0
+        while len(buf) - pos >= 2:
+            index = pos + 1
+            multiplier = 1
+            remaining_length = 0
+            while True:
+                byte = buf[index]
+                index += 1
+                remaining_length += (byte & 127) * multiplier
+                multiplier *= 128
+                if byte & 128 == 0:
+                    break
+            end = index + remaining_length
+            if end > len(buf):
+                break
+            self.forward(bytes(buf[index:end]))
+            pos = end
+        if pos:
+            del buf[:pos]
+
+    def forward(self, payload):
+        topic_len = (payload[0] << 8) | payload[1]
+        topic = payload[2:2+topic_len].decode('utf-8')
+        message = payload[2+topic_len:]
+        header = build_publish_header(topic.encode('utf-8'), self.qos, len(message))
+        if self.qos == 0:
+            packet = header + message
+            for transport in self.transports:
+                transport.writelines([packet])
+        else:
+            for packet_id, transport in enumerate(self.transports, 1):
+                transport.writelines([header, packet_id.to_bytes(2, 'big'), message])
+
+async def zerocopy_brokers(args, frame):
+    """分别用旧实现和服务器的Protocol引擎转发frame，返回 {名称: 每条消息的峰值内存增量}"""
+    stream_chunks = chunks(frame, READ_CHUNK_SIZE)
+    results = {}
+
+    legacy_transports = [SinkTransport() for _ in range(args.subscribers)]
+    legacy = LegacyForwarder(legacy_transports, args.qos)
+
+    def legacy_feed(message_id):
+        for chunk in stream_chunks:
+            legacy.feed(chunk)
+
+    publisher = MQTTProtocol()
+    publisher.connection_made(SinkTransport())
+    publisher.data_received(connect_frame("zerocopy-pub"))
+    subscribers = []
+    for i in range(args.subscribers):
+        subscriber = MQTTProtocol()
+        subscriber.connection_made(SinkTransport())
+        subscriber.data_received(connect_frame(f"zerocopy-sub-{i}"))
+        subscriber.data_received(subscribe_frame("waveform/#", args.qos))
+        subscribers.append(subscriber)
+    await asyncio.sleep(0)
+
+    def broker_feed(message_id):
+        for chunk in stream_chunks:
+            publisher.data_received(chunk)
+        if args.qos:
+            ack = encode_ack(PUBACK, message_id)
+            for subscriber in subscribers:
+                subscriber.data_received(ack)
+
+    for label, feed, transports in (("旧实现", legacy_feed, legacy_transports),
+                                    ("memoryview", broker_feed, [s.transport for s in subscribers])):
+        peaks = []
+        tracemalloc.start()
+        for message_id in range(1, args.messages + 1):
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            feed(message_id)
+            await asyncio.sleep(0)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+            for transport in transports:
+                transport.written.clear()
+        tracemalloc.stop()
+        results[label] = sum(peaks) / len(peaks)
+    return results
+
+def bench_zerocopy(args):
+    """比较旧实现与memoryview转发大消息时的内存拷贝"""
+    payload = b"\x5a" * args.payload_size
+    frame = build_publish_frame("waveform/site-001/device-0001", payload, args.qos)
+    results = asyncio.run(zerocopy_brokers(args, frame))
+
+    print(f"负载大小: {args.payload_size}字节, 订阅者数: {args.subscribers}, QoS: {args.qos}, "
+          f"读取块大小: {READ_CHUNK_SIZE}字节")
+    print("每条消息的峰值内存增量（写出的数据保留到测量结束，约等于解码和扇出时拷贝的字节数）：")
+    for label, allocated in results.items():
+        print(f"{label:<12} {allocated:>12,.0f} 字节/条  (负载的{allocated / args.payload_size:5.1f}倍)")
+
+async def stream_transfer(args, port, frame):
+    """启动服务器，发布一条大消息给args.subscribers个订阅者，返回 (峰值内存增量, 耗时)"""
+    server_task = asyncio.ensure_future(start_mqtt_server())
+    await asyncio.sleep(0.3)
+    try:
+        subscribers = []
+        for i in range(args.subscribers):
+            subscriber = BenchClient(f"stream-sub-{i}")
+            await subscriber.connect("127.0.0.1", port)
+            await subscriber.subscribe("firmware/#")
+            subscribers.append(subscriber)
+        publisher = BenchClient("stream-pub")
+        await publisher.connect("127.0.0.1", port)
+
+        async def consume(subscriber):
+            received = 0
+            while received < len(frame):
+                data = await subscriber.reader.read(READ_CHUNK_SIZE)
+                if not data:
+                    raise RuntimeError("订阅者连接已断开")
+                received += len(data)
+
+        async def produce():
+            view = memoryview(frame)
+            for offset in range(0, len(frame), READ_CHUNK_SIZE):
+                publisher.writer.write(view[offset:offset + READ_CHUNK_SIZE])
+                await publisher.writer.drain()
+
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        await asyncio.gather(produce(), *(consume(subscriber) for subscriber in subscribers))
+        elapsed = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] - base
+        tracemalloc.stop()
+        for client in subscribers + [publisher]:
+            await client.close()
+        return peak, elapsed
+    finally:
+        server_task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await server_task
+        await asyncio.sleep(0)
+
+def bench_stream(args):
+    """比较完整缓冲与流式转发一条大消息时进程的峰值内存"""
+    mqtt_config.host = "127.0.0.1"
+    mqtt_config.engine = args.engine
+    mqtt_config.log_level = "WARNING"
+    frame = build_publish_frame("firmware/gateway/v2.bin", os.urandom(args.payload_size))
+
+    print(f"负载大小: {args.payload_size}字节, 订阅者数: {args.subscribers}, 引擎: {args.engine}")
+    print("峰值内存增量（tracemalloc，服务器与压测客户端在同一进程中）：")
+    for index, (label, threshold) in enumerate((("完整缓冲", 0), (f"流式转发(>={args.stream_threshold})", args.stream_threshold))):
+        mqtt_config.port = args.port + index
+        mqtt_config.stream_threshold = threshold
+        peak, elapsed = run_event_loop(stream_transfer(args, mqtt_config.port, frame))
+        print(f"{label:<24} {peak / 1048576:>8.1f} MB  (负载的{peak / args.payload_size:5.2f}倍)  "
+              f"{args.payload_size * args.subscribers / elapsed / 1048576:>8.1f} MB/s")
+
+def storm_filters(index):
+    """断开连接测试中每个客户端的订阅：独占的主题、按站点共享的通配符和所有客户端共享的通配符"""
+    return [f"device/{index}/cmd", f"device/{index}/config/#", f"site/{index % 100}/+/temp", "alerts/#"]
+
+def legacy_disconnect(subscriptions, client_id):
+    """旧实现：遍历所有主题，在每个订阅者列表中线性查找"""
+    for topic in list(subscriptions.keys()):
+        if client_id in subscriptions[topic]:
+            subscriptions[topic].remove(client_id)
+            if not subscriptions[topic]:
+                del subscriptions[topic]
+
+def bench_disconnect(args):
+    """比较遍历所有主题与按反向索引清理的断开连接开销"""
+    client_ids = [f"storm-{i}" for i in range(args.clients)]
+
+    subscriptions = {}
+    for i, client_id in enumerate(client_ids):
+        for topic_filter in storm_filters(i):
+            subscriptions.setdefault(topic_filter, []).append(client_id)
+    topic_count = len(subscriptions)
+    sample = client_ids[:args.legacy_sample]
+    start = time.perf_counter()
+    for client_id in sample:
+        legacy_disconnect(subscriptions, client_id)
+    legacy_elapsed = (time.perf_counter() - start) * len(client_ids) / len(sample)
+
+    trie = TopicTrie()
+    for i, client_id in enumerate(client_ids):
+        for topic_filter in storm_filters(i):
+            trie.subscribe(topic_filter, client_id)
+    start = time.perf_counter()
+    for client_id in client_ids:
+        trie.unsubscribe_all(client_id)
+    trie_elapsed = time.perf_counter() - start
+    assert not trie.to_dict()
+
+    print(f"客户端数: {args.clients}, 每个客户端 {len(storm_filters(0))} 个订阅, 主题数: {topic_count}")
+    print(f"遍历所有主题（按前 {len(sample)} 个客户端估算）: {legacy_elapsed:.2f} 秒")
+    print(f"订阅树 + 反向索引: {trie_elapsed:.3f} 秒")
+
+async def pairs_load(host, port, load_id, pairs, payload_size, duration, window=PUBLISH_WINDOW):
+    """一个压测进程：pairs对发布者/订阅者，每对使用独立的主题，返回订阅者收到的消息数
+
+    每个发布者最多领先其订阅者window条消息，避免服务器发送队列溢出丢弃消息。
+    """
+    subscribers = []
+    publishers = []
+    for i in range(pairs):
+        topic = f"bench/{load_id}/{i}"
+        subscriber = BenchClient(f"bench-sub-{load_id}-{i}")
+        await subscriber.connect(host, port)
+        await subscriber.subscribe(topic)
+        subscribers.append(subscriber)
+        publisher = BenchClient(f"bench-pub-{load_id}-{i}")
+        await publisher.connect(host, port)
+        publishers.append((publisher, topic))
+    # 等待订阅同步到其他工作进程
+    await asyncio.sleep(0.5)
+
+    received = [0] * pairs
+    progress = [asyncio.Event() for _ in range(pairs)]
+    payload = b"x" * payload_size
+    stop_at = time.monotonic() + duration
+
+    async def consume(index):
+        subscriber = subscribers[index]
+        try:
+            while True:
+                received[index] += len(await subscriber.read_frames())
+                progress[index].set()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def produce(index):
+        publisher, topic = publishers[index]
+        sent = 0
+        batch = max(window // 4, 1)
+        while time.monotonic() < stop_at:
+            if sent - received[index] + batch > window:
+                progress[index].clear()
+                try:
+                    await asyncio.wait_for(progress[index].wait(), 1.0)
+                except asyncio.TimeoutError:
+                    # 消息被服务器丢弃时不再等待
+                    sent = received[index]
+                continue
+            for _ in range(batch):
+                publisher.publish(topic, payload)
+            sent += batch
+            await publisher.writer.drain()
+
+    consumers = [asyncio.ensure_future(consume(i)) for i in range(pairs)]
+    await asyncio.gather(*(produce(i) for i in range(pairs)))
+    await asyncio.sleep(0.5)
+    for consumer in consumers:
+        consumer.cancel()
+    for client in subscribers + [publisher for publisher, _ in publishers]:
+        await client.close()
+    return sum(received)
+
+def pairs_load_main(host, port, load_id, pairs, payload_size, duration, results):
+    results.put(asyncio.run(pairs_load(host, port, load_id, pairs, payload_size, duration)))
+
+def run_pairs_load(host, port, load_processes, pairs, payload_size, duration):
+    """用load_processes个压测进程同时压测，返回每秒收到的消息数"""
+    results = multiprocessing.Queue()
+    loaders = [
+        multiprocessing.Process(target=pairs_load_main,
+                                args=(host, port, i, pairs, payload_size, duration, results))
+        for i in range(load_processes)
+    ]
+    for loader in loaders:
+        loader.start()
+    received = sum(results.get() for _ in loaders)
+    for loader in loaders:
+        loader.join()
+    return received / duration
+
+def bench_cluster(args):
+    """比较不同工作进程数下的多进程模式吞吐量"""
+    host = "127.0.0.1"
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mqtt_cluster.py")
+    print(f"压测进程: {args.load_processes}, 每个进程 {args.pairs} 对发布者/订阅者, "
+          f"负载大小: {args.payload_size}字节, 持续: {args.duration}秒")
+
+    for workers in args.workers:
+        server = subprocess.Popen(
+            [sys.executable, script, "--workers", str(workers), "--mqtt-host", host,
+             "--mqtt-port", str(args.port), "--max-connections", "100000"],
+            stdout=subprocess.DEVNULL)
+        try:
+            wait_for_port(host, args.port)
+            time.sleep(0.5)
+            rate = run_pairs_load(host, args.port, args.load_processes, args.pairs, args.payload_size,
+                                  args.duration)
+        finally:
+            server.terminate()
+            server.wait()
+        print(f"工作进程数 {workers}: {rate:,.0f} 条/秒")
+
+def run_broker(args):
+    """只启动MQTT服务（不启动Web管理界面），供压测使用"""
+    mqtt_config.host = args.host
+    mqtt_config.port = args.port
+    mqtt_config.max_connections = args.max_connections
+    mqtt_config.engine = args.engine
+    mqtt_config.use_uvloop = args.uvloop
+    mqtt_config.write_coalesce_us = args.write_coalesce_us
+    try:
+        run_event_loop(start_mqtt_server())
+    except KeyboardInterrupt:
+        pass
+
+def start_broker(host, port, engine, use_uvloop, write_coalesce_us=0):
+    """在子进程中启动压测用的MQTT服务并等待其开始监听"""
+    command = [sys.executable, os.path.abspath(__file__), "broker", "--host", host, "--port", str(port),
+               "--engine", engine, "--max-connections", "1000000", "--write-coalesce-us", str(write_coalesce_us)]
+    if use_uvloop:
+        command.append("--uvloop")
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    wait_for_port(host, port)
+    return server
+
+def process_rss(pid):
+    """进程当前的常驻内存（字节），读取/proc，仅支持Linux"""
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+async def measure_connection_memory(host, port, pid, count):
+    """建立count个空闲连接，返回服务器进程每个连接增加的内存（字节）"""
+    before = process_rss(pid)
+    idle = []
+    for i in range(count):
+        client = BenchClient(f"bench-idle-{i}")
+        await client.connect(host, port)
+        idle.append(client)
+    await asyncio.sleep(0.5)
+    after = process_rss(pid)
+    for client in idle:
+        await client.close()
+    return (after - before) / count
+
+def bench_engine(args):
+    """比较流引擎与Protocol引擎（以及uvloop）的吞吐量和每连接内存"""
+    host = "127.0.0.1"
+    variants = args.variants
+    if variants is None:
+        variants = list(ENGINES)
+        if importlib.util.find_spec("uvloop") is not None:
+            variants += [f"{engine}+uvloop" for engine in ENGINES]
+    print(f"压测进程: {args.load_processes}, 每个进程 {args.pairs} 对发布者/订阅者, "
+          f"负载大小: {args.payload_size}字节, 持续: {args.duration}秒, 空闲连接: {args.connections}")
+
+    for variant in variants:
+        engine, _, loop_name = variant.partition("+")
+        server = start_broker(host, args.port, engine, loop_name == "uvloop")
+        try:
+            time.sleep(0.5)
+            memory = asyncio.run(measure_connection_memory(host, args.port, server.pid, args.connections))
+            rate = run_pairs_load(host, args.port, args.load_processes, args.pairs, args.payload_size,
+                                  args.duration)
+        finally:
+            server.terminate()
+            server.wait()
+        print(f"{variant:<16} {rate:>12,.0f} 条/秒  {memory / 1024:>8.1f} KB/连接")
+
+async def http_post(reader, writer, path, body, content_type):
+    """在已建立的HTTP/1.1连接上发送一个POST请求，返回响应体"""
+    writer.write(f"POST {path} HTTP/1.1\r\nHost: bench\r\nContent-Type: {content_type}\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode('ascii') + body)
+    await writer.drain()
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    length = 0
+    for line in head.split(b"\r\n")[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    data = await reader.readexactly(length)
+    if status != 200:
+        raise RuntimeError(f"{path} 返回 {status}: {data!r}")
+    return data
+
+async def http_post_json(reader, writer, path, payload):
+    """在已建立的HTTP/1.1连接上发送一个JSON POST请求，返回响应体"""
+    return await http_post(reader, writer, path, json.dumps(payload).encode('utf-8'), "application/json")
+
+async def admin_publish_latency(host, mqtt_port, web_port, duration, concurrency):
+    """concurrency个HTTP连接持续调用 POST /publish，返回 (请求延迟列表, 送达订阅者的延迟列表)"""
+    subscriber = BenchClient("bench-admin-sub")
+    await subscriber.connect(host, mqtt_port)
+    await subscriber.subscribe("bench/admin")
+    sent_at = {}
+    request_latencies = []
+    delivery_latencies = []
+    stop_at = time.monotonic() + duration
+
+    async def consume():
+        try:
+            while True:
+                for first_byte, body in await subscriber.read_frames():
+                    if first_byte >> 4 != PUBLISH:
+                        continue
+                    topic_length = int.from_bytes(body[:2], 'big')
+                    started = sent_at.pop(bytes(body[2 + topic_length:]).decode('utf-8'), None)
+                    if started is not None:
+                        delivery_latencies.append(time.perf_counter() - started)
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def request(index):
+        reader, writer = await asyncio.open_connection(host, web_port)
+        count = 0
+        while time.monotonic() < stop_at:
+            key = f"{index}-{count}"
+            count += 1
+            started = sent_at[key] = time.perf_counter()
+            await http_post_json(reader, writer, "/publish", {"topic": "bench/admin", "message": key})
+            request_latencies.append(time.perf_counter() - started)
+        writer.close()
+
+    consumer = asyncio.ensure_future(consume())
+    await asyncio.gather(*(request(i) for i in range(concurrency)))
+    await asyncio.sleep(0.5)
+    consumer.cancel()
+    await subscriber.close()
+    return request_latencies, delivery_latencies
+
+def start_api_server(host, mqtt_port, web_port, single_loop):
+    """在子进程中用run.py启动MQTT服务器和Web服务，等待两者开始监听"""
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run.py")
+    command = [sys.executable, script, "--mqtt-host", host, "--mqtt-port", str(mqtt_port),
+               "--web-port", str(web_port), "--max-connections", "100000", "--max-queued-messages", "1000000",
+               "--log-level", "WARNING"]
+    if single_loop:
+        command.append("--single-loop")
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for_port(host, mqtt_port)
+    wait_for_port(host, web_port)
+    return server
+
+def bench_admin(args):
+    """比较MQTT服务器运行在单独线程（经call_in_server_loop桥接）与单事件循环模式下 POST /publish 的延迟"""
+    host = "127.0.0.1"
+    print(f"并发HTTP连接: {args.concurrency}, 背景负载: {args.load_processes}个压测进程 × {args.pairs}对发布者/订阅者, "
+          f"持续: {args.duration}秒")
+    print(f"{'模式':<14} {'请求/秒':>10} {'请求p50':>10} {'请求p99':>10} {'送达p50':>10} {'送达p99':>10} {'背景消息/秒':>12}")
+    for label, single_loop in (("独立线程+桥接", False), ("单事件循环", True)):
+        server = start_api_server(host, args.port, args.web_port, single_loop)
+        try:
+            time.sleep(0.5)
+            results = multiprocessing.Queue()
+            loaders = [
+                multiprocessing.Process(target=pairs_load_main,
+                                        args=(host, args.port, i, args.pairs, args.payload_size, args.duration + 1,
+                                              results))
+                for i in range(args.load_processes)
+            ]
+            for loader in loaders:
+                loader.start()
+            # 等待背景负载建立连接
+            time.sleep(1.0 if loaders else 0)
+            requests, deliveries = asyncio.run(
+                admin_publish_latency(host, args.port, args.web_port, args.duration, args.concurrency))
+            received = sum(results.get() for _ in loaders)
+            for loader in loaders:
+                loader.join()
+        finally:
+            server.terminate()
+            server.wait()
+        requests.sort()
+        deliveries.sort()
+        milliseconds = [(percentile(values, fraction) or 0) * 1000
+                        for values in (requests, deliveries) for fraction in (0.5, 0.99)]
+        print(f"{label:<14} {len(requests) / args.duration:>10,.0f} "
+              + " ".join(f"{value:>8.2f}ms" for value in milliseconds)
+              + f" {received / (args.duration + 1):>12,.0f}")
+
+async def batch_publish_rate(host, mqtt_port, web_port, messages, batch_size, body_format):
+    """通过管理接口发布messages条消息，返回订阅者全部收到为止每秒的消息数
+
+    body_format为single时每条消息调用一次 POST /publish，否则每batch_size条调用一次 POST /publish/batch。
+    """
+    subscriber = BenchClient("bench-batch-sub")
+    await subscriber.connect(host, mqtt_port)
+    await subscriber.subscribe("bench/batch/#")
+    reader, writer = await asyncio.open_connection(host, web_port)
+    payloads = [(f"bench/batch/{i % 16}", b"%08d" % i + b"x" * 56, 0, False) for i in range(messages)]
+
+    async def consume():
+        received = 0
+        while received < messages:
+            received += sum(1 for first_byte, _ in await subscriber.read_frames() if first_byte >> 4 == PUBLISH)
+
+    consumer = asyncio.ensure_future(consume())
+    started = time.perf_counter()
+    if body_format == "single":
+        for topic, payload, _, _ in payloads:
+            await http_post_json(reader, writer, "/publish", {"topic": topic, "message": payload.decode('ascii')})
+    else:
+        for start in range(0, messages, batch_size):
+            batch = payloads[start:start + batch_size]
+            if body_format == "binary":
+                await http_post(reader, writer, "/publish/batch", encode_batch(batch), BINARY_CONTENT_TYPE)
+            else:
+                body = "".join(json.dumps({"topic": topic, "payload": base64.b64encode(payload).decode('ascii')}) + "\n"
+                               for topic, payload, _, _ in batch).encode('utf-8')
+                await http_post(reader, writer, "/publish/batch", body, NDJSON_CONTENT_TYPE)
+    await asyncio.wait_for(consumer, 30)
+    elapsed = time.perf_counter() - started
+    writer.close()
+    await subscriber.close()
+    return messages / elapsed
+
+def bench_batch(args):
+    """比较逐条 POST /publish 与 POST /publish/batch（二进制、NDJSON）通过管理接口注入消息的速率"""
+    host = "127.0.0.1"
+    server = start_api_server(host, args.port, args.web_port, args.single_loop)
+    try:
+        time.sleep(0.5)
+        print(f"消息数: {args.messages}, 每批: {args.batch_size}条, 负载: 64字节")
+        for label, body_format, messages in (("逐条 /publish", "single", min(args.messages, args.single_messages)),
+                                             ("/publish/batch 二进制", "binary", args.messages),
+                                             ("/publish/batch NDJSON", "ndjson", args.messages)):
+            rate = asyncio.run(batch_publish_rate(host, args.port, args.web_port, messages, args.batch_size,
+                                                  body_format))
+            print(f"{label:<24} {rate:>12,.0f} 条/秒")
+    finally:
+        server.terminate()
+        server.wait()
+
+def percentile(sorted_values, fraction):
+    """已排序列表的分位数"""
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+def load_topic(index):
+    return f"bench/t{index}/data"
+
+def load_filter(index, args):
+    """第index个订阅者的过滤器：前wildcard_ratio比例的订阅者使用通配符订阅所有主题"""
+    if index < round(args.subscribers * args.wildcard_ratio):
+        return "bench/+/data" if index % 2 == 0 else "bench/#"
+    return load_topic(index % args.topics)
+
+async def run_load(args, host, port):
+    """按参数建立发布者和订阅者并压测，返回测量结果"""
+    subscribers = []
+    expected_fanout = [0] * args.topics  # 每个主题的订阅者数
+    for i in range(args.subscribers):
+        topic_filter = load_filter(i, args)
+        subscriber = BenchClient(f"load-sub-{i}")
+        await subscriber.connect(host, port)
+        await subscriber.subscribe(topic_filter, args.qos)
+        subscribers.append(subscriber)
+        for k in range(args.topics):
+            if topic_filter == load_topic(k) or topic_filter in ("bench/+/data", "bench/#"):
+                expected_fanout[k] += 1
+    publishers = []
+    for i in range(args.publishers):
+        publisher = BenchClient(f"load-pub-{i}")
+        await publisher.connect(host, port)
+        publishers.append(publisher)
+
+    latencies = []
+    state = {"expected": 0, "received": 0, "published": 0}
+    progress = asyncio.Event()
+    padding = b"x" * max(args.payload_size - 8, 0)
+    measuring = True
+
+    async def consume(subscriber):
+        try:
+            while True:
+                for first_byte, payload in await subscriber.read_frames():
+                    packet_type = first_byte >> 4
+                    if packet_type == PUBLISH:
+                        qos = (first_byte >> 1) & 0x03
+                        offset = 2 + int.from_bytes(payload[:2], 'big')
+                        if qos:
+                            message_id = int.from_bytes(payload[offset:offset + 2], 'big')
+                            subscriber.send(encode_ack(PUBACK if qos == 1 else PUBREC, message_id))
+                            offset += 2
+                        if measuring:
+                            sent_ns = int.from_bytes(payload[offset:offset + 8], 'big')
+                            latencies.append((time.monotonic_ns() - sent_ns) / 1e6)
+                            state["received"] += 1
+                            progress.set()
+                    elif packet_type == PUBREL:
+                        subscriber.send(encode_ack(PUBCOMP, int.from_bytes(payload[:2], 'big')))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def acknowledge(publisher):
+        """发布者一方：QoS 2收到PUBREC后回复PUBREL，其余确认直接丢弃"""
+        try:
+            while True:
+                for first_byte, payload in await publisher.read_frames():
+                    if first_byte >> 4 == PUBREC:
+                        publisher.send(encode_ack(PUBREL, int.from_bytes(payload[:2], 'big')))
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    async def produce(index, publisher, stop_at):
+        sequence = 0
+        interval = args.publishers / args.rate if args.rate else 0
+        next_send = time.monotonic()
+        while time.monotonic() < stop_at:
+            if interval:
+                next_send += interval
+                delay = next_send - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif state["expected"] - state["received"] > args.window:
+                # 未按速率发送时，最多领先订阅者window次投递，避免服务器发送队列溢出
+                progress.clear()
+                try:
+                    await asyncio.wait_for(progress.wait(), 1.0)
+                except asyncio.TimeoutError:
+                    state["expected"] = state["received"]
+                continue
+            topic_index = (index + sequence * args.publishers) % args.topics
+            payload = time.monotonic_ns().to_bytes(8, 'big') + padding
+            publisher.publish(load_topic(topic_index), payload, args.qos, sequence % 65535 + 1)
+            sequence += 1
+            state["published"] += 1
+            state["expected"] += expected_fanout[topic_index]
+            if sequence % 64 == 0 or interval:
+                await publisher.writer.drain()
+
+    tasks = [asyncio.ensure_future(consume(subscriber)) for subscriber in subscribers]
+    tasks += [asyncio.ensure_future(acknowledge(publisher)) for publisher in publishers]
+    await asyncio.sleep(0.2)
+
+    start = time.monotonic()
+    stop_at = start + args.duration
+    await asyncio.gather(*(produce(i, publisher, stop_at) for i, publisher in enumerate(publishers)))
+    elapsed = time.monotonic() - start
+    # 等待仍在途中的消息
+    await asyncio.sleep(0.5)
+    measuring = False
+    for task in tasks:
+        task.cancel()
+    for client in subscribers + publishers:
+        await client.close()
+
+    latencies.sort()
+    return {
+        "published": state["published"],
+        "delivered": state["received"],
+        "publish_rate": state["published"] / elapsed,
+        "deliver_rate": state["received"] / elapsed,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.5),
+            "p99": percentile(latencies, 0.99),
+            "p999": percentile(latencies, 0.999),
+            "max": latencies[-1] if latencies else None,
+        },
+    }
+
+def bench_load(args):
+    """可配置的端到端压测，结果以JSON输出"""
+    host = "127.0.0.1"
+    config = {key: value for key, value in vars(args).items() if key != "func"}
+
+    if args.broker == "subprocess":
+        server = start_broker(host, args.port, args.engine, args.uvloop, args.write_coalesce_us)
+        try:
+            time.sleep(0.3)
+            results = asyncio.run(run_load(args, host, args.port))
+            results["broker_rss_bytes"] = process_rss(server.pid)
+        finally:
+            server.terminate()
+            server.wait()
+    else:
+        # 服务器与压测客户端运行在同一个事件循环中，RSS同时包含两者
+        mqtt_config.host = host
+        mqtt_config.port = args.port
+        mqtt_config.max_connections = 1000000
+        mqtt_config.engine = args.engine
+        mqtt_config.write_coalesce_us = args.write_coalesce_us
+        mqtt_config.log_level = "WARNING"
+
+        async def in_process():
+            server_task = asyncio.ensure_future(start_mqtt_server())
+            await asyncio.sleep(0.3)
+            try:
+                return await run_load(args, host, args.port)
+            finally:
+                server_task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await server_task
+                # 让服务器的定时任务处理取消
+                await asyncio.sleep(0)
+
+        results = run_event_loop(in_process())
+        results["broker_rss_bytes"] = process_rss(os.getpid())
+        # 同一进程中可以直接读取服务器指标：平均每次写入包含的报文数
+        results["packets_per_write"] = sum(metrics.packets_out) / max(metrics.socket_writes, 1)
+
+    report = {
+        "benchmark": "load",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "config": config,
+        "results": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        if os.path.dirname(args.output):
+            os.makedirs(os.path.dirname(args.output), exist_ok=True)
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='MQTT服务器性能测试')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    decoder = subparsers.add_parser('decoder', help='测试数据包解码吞吐量')
+    decoder.add_argument('--count', type=int, default=200000, help='数据包数量')
+    decoder.add_argument('--payload-size', type=int, default=32, help='每个数据包的负载字节数')
+    decoder.add_argument('--chunk-size', type=int, default=65536, help='每次读取的字节数')
+    decoder.set_defaults(func=bench_decoder)
+
+    encode = subparsers.add_parser('encode', help='测试PUBLISH扇出的编码开销')
+    encode.add_argument('--messages', type=int, default=200, help='发布的消息数')
+    encode.add_argument('--subscribers', type=int, default=5000, help='每条消息的订阅者数')
+    encode.add_argument('--payload-size', type=int, default=256, help='每条消息的负载字节数')
+    encode.add_argument('--qos', type=int, default=0, choices=[0, 1], help='投递的QoS级别')
+    encode.set_defaults(func=bench_encode)
+
+    cluster = subparsers.add_parser('cluster', help='测试多进程模式在不同工作进程数下的吞吐量')
+    cluster.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='要测试的工作进程数')
+    cluster.add_argument('--port', type=int, default=18830, help='测试用的MQTT端口')
+    cluster.add_argument('--load-processes', type=int, default=4, help='压测进程数')
+    cluster.add_argument('--pairs', type=int, default=8, help='每个压测进程的发布者/订阅者对数')
+    cluster.add_argument('--payload-size', type=int, default=64, help='每条消息的负载字节数')
+    cluster.add_argument('--duration', type=float, default=5.0, help='每轮测试的持续时间（秒）')
+    cluster.set_defaults(func=bench_cluster)
+
+    log = subparsers.add_parser('logging', help='测试记录PUBLISH事件的开销')
+    log.add_argument('--messages', type=int, default=200000, help='消息数')
+    log.add_argument('--payload-size', type=int, default=256, help='每条消息的负载字节数')
+    log.add_argument('--sample-rate', type=float, default=10, help='采样时每秒最多记录的条数')
+    log.set_defaults(func=bench_logging)
+
+    alias = subparsers.add_parser('alias', help='比较使用MQTT 5主题别名前后的上行字节数')
+    alias.add_argument('--messages', type=int, default=100000, help='发布的消息数')
+    alias.add_argument('--topics', type=int, default=100, help='不同主题的数量')
+    alias.add_argument('--payload-size', type=int, default=32, help='每条消息的负载字节数')
+    alias.add_argument('--qos', type=int, default=1, choices=[0, 1, 2], help='发布的QoS')
+    alias.set_defaults(func=bench_alias)
+
+    zerocopy = subparsers.add_parser('zerocopy', help='比较旧实现与memoryview转发大消息时的内存拷贝')
+    zerocopy.add_argument('--messages', type=int, default=200, help='发布的消息数')
+    zerocopy.add_argument('--subscribers', type=int, default=16, help='订阅者数')
+    zerocopy.add_argument('--payload-size', type=int, default=65536, help='每条消息的负载字节数')
+    zerocopy.add_argument('--qos', type=int, default=0, choices=[0, 1], help='发布和订阅的QoS')
+    zerocopy.set_defaults(func=bench_zerocopy)
+
+    stream = subparsers.add_parser('stream', help='比较完整缓冲与流式转发大消息时的峰值内存')
+    stream.add_argument('--payload-size', type=int, default=64 * 1024 * 1024, help='消息的负载字节数')
+    stream.add_argument('--subscribers', type=int, default=4, help='订阅者数')
+    stream.add_argument('--stream-threshold', type=int, default=1024 * 1024, help='流式转发的剩余长度阈值（字节）')
+    stream.add_argument('--engine', type=str, default=mqtt_config.engine, choices=ENGINES, help='连接处理引擎')
+    stream.add_argument('--port', type=int, default=18833, help='测试用的MQTT端口（流式转发使用下一个端口）')
+    stream.set_defaults(func=bench_stream)
+
+    disconnect = subparsers.add_parser('disconnect', help='测试大量客户端同时断开时清理订阅的开销')
+    disconnect.add_argument('--clients', type=int, default=10000, help='同时断开的客户端数')
+    disconnect.add_argument('--legacy-sample', type=int, default=500, help='旧实现实际测量的客户端数，其余按比例估算')
+    disconnect.set_defaults(func=bench_disconnect)
+
+    engine = subparsers.add_parser('engine', help='比较不同连接处理引擎的吞吐量和每连接内存')
+    engine.add_argument('--variants', nargs='+',
+                        choices=list(ENGINES) + [f"{name}+uvloop" for name in ENGINES],
+                        help='要测试的引擎，默认测试全部引擎（已安装uvloop时包括uvloop）')
+    engine.add_argument('--port', type=int, default=18831, help='测试用的MQTT端口')
+    engine.add_argument('--load-processes', type=int, default=2, help='压测进程数')
+    engine.add_argument('--pairs', type=int, default=8, help='每个压测进程的发布者/订阅者对数')
+    engine.add_argument('--payload-size', type=int, default=64, help='每条消息的负载字节数')
+    engine.add_argument('--duration', type=float, default=5.0, help='每轮测试的持续时间（秒）')
+    engine.add_argument('--connections', type=int, default=2000, help='测量内存用的空闲连接数')
+    engine.set_defaults(func=bench_engine)
+
+    load = subparsers.add_parser('load', help='端到端压测：吞吐量、延迟分位数和服务器内存，结果以JSON输出')
+    load.add_argument('--broker', choices=['subprocess', 'inprocess'], default='subprocess',
+                      help='在子进程中启动服务器，或与压测客户端运行在同一个事件循环中')
+    load.add_argument('--engine', type=str, default=mqtt_config.engine, choices=ENGINES, help='连接处理引擎')
+    load.add_argument('--uvloop', action='store_true', help='子进程服务器使用uvloop（已安装时）')
+    load.add_argument('--write-coalesce-us', type=int, default=0, help='服务器的写合并窗口（微秒）')
+    load.add_argument('--port', type=int, default=18832, help='测试用的MQTT端口')
+    load.add_argument('--publishers', type=int, default=4, help='发布者数')
+    load.add_argument('--subscribers', type=int, default=16, help='订阅者数')
+    load.add_argument('--topics', type=int, default=16, help='主题数')
+    load.add_argument('--wildcard-ratio', type=float, default=0.0, help='使用通配符订阅所有主题的订阅者比例')
+    load.add_argument('--payload-size', type=int, default=64, help='每条消息的负载字节数（至少8字节，用于携带发送时间）')
+    load.add_argument('--qos', type=int, default=0, choices=[0, 1, 2], help='发布和订阅的QoS')
+    load.add_argument('--rate', type=float, default=0, help='所有发布者合计每秒发送的消息数，0表示尽可能快')
+    load.add_argument('--window', type=int, default=2000, help='未限速时最多未送达的投递数')
+    load.add_argument('--duration', type=float, default=5.0, help='测试持续时间（秒）')
+    load.add_argument('--output', type=str, help='把JSON结果写入此文件')
+    load.set_defaults(func=bench_load)
+
+    admin = subparsers.add_parser('admin', help='比较独立线程与单事件循环模式下管理接口 POST /publish 的延迟')
+    admin.add_argument('--port', type=int, default=18834, help='测试用的MQTT端口')
+    admin.add_argument('--web-port', type=int, default=18080, help='测试用的Web服务端口')
+    admin.add_argument('--concurrency', type=int, default=4, help='并发的HTTP连接数')
+    admin.add_argument('--load-processes', type=int, default=1, help='产生背景MQTT负载的压测进程数，0表示不加负载')
+    admin.add_argument('--pairs', type=int, default=4, help='每个压测进程的发布者/订阅者对数')
+    admin.add_argument('--payload-size', type=int, default=64, help='背景负载每条消息的负载字节数')
+    admin.add_argument('--duration', type=float, default=5.0, help='每种模式的测试时间（秒）')
+    admin.set_defaults(func=bench_admin)
+
+    batch = subparsers.add_parser('batch', help='比较逐条发布与批量发布接口注入消息的速率')
+    batch.add_argument('--port', type=int, default=18835, help='测试用的MQTT端口')
+    batch.add_argument('--web-port', type=int, default=18081, help='测试用的Web服务端口')
+    batch.add_argument('--messages', type=int, default=100000, help='批量发布的消息数')
+    batch.add_argument('--single-messages', type=int, default=5000, help='逐条发布的消息数（逐条发布较慢）')
+    batch.add_argument('--batch-size', type=int, default=10000, help='每个批量请求的消息数')
+    batch.add_argument('--single-loop', action='store_true', help='服务器以单事件循环模式运行')
+    batch.set_defaults(func=bench_batch)
+
+    broker = subparsers.add_parser('broker', help='只启动MQTT服务，供压测使用')
+    broker.add_argument('--host', type=str, default='127.0.0.1', help='MQTT服务器主机地址')
+    broker.add_argument('--port', type=int, default=1883, help='MQTT服务器端口')
+    broker.add_argument('--max-connections', type=int, default=100000, help='最大连接数')
+    broker.add_argument('--engine', type=str, default=mqtt_config.engine, choices=ENGINES, help='连接处理引擎')
+    broker.add_argument('--uvloop', action='store_true', help='已安装uvloop时使用uvloop事件循环')
+    broker.add_argument('--write-coalesce-us', type=int, default=0, help='写合并窗口（微秒）')
+    broker.set_defaults(func=run_broker)
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.func(args)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+MQTT服务器多进程模式
+
+启动N个工作进程，通过SO_REUSEPORT共享同一个监听端口，由内核把新连接分配给各个进程。
+每个工作进程拥有自己的连接，进程之间通过Unix套接字转发消息：
+每个进程把本地订阅过滤器的增删同步给其他进程，发布消息时只转发给有匹配订阅者的进程。
+
+限制：客户端ID的唯一性、持久会话和保留消息之外的状态只在各自的工作进程内有效。
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import shutil
+import signal
+import struct
+import sys
+import tempfile
+from typing import Dict, Optional
+
+import mqtt_server
+from mqtt_server import mqtt_config, ENGINES, TopicTrie, publish_message, run_event_loop, start_mqtt_server, write_chunks
+from mqtt_v5 import MESSAGE_EXPIRY_INTERVAL, decode_properties, encode_publish_properties
+
+# 进程间报文类型
+HELLO = 0  # 连接建立后发送的第一个报文，携带发送方的工作进程ID
+FILTER_ADDED = 1  # 本进程的某个订阅过滤器有了第一个订阅者
+FILTER_REMOVED = 2  # 本进程的某个订阅过滤器失去了最后一个订阅者
+FORWARD_PUBLISH = 3  # 转发发布的消息
+
+# 报文头：1字节类型、4字节长度
+FRAME_HEADER = struct.Struct(">BI")
+# 转发消息的头部：1字节QoS、1字节保留标志、2字节主题长度，其后依次是主题、MQTT 5格式的发布属性和消息内容
+PUBLISH_HEADER = struct.Struct(">BBH")
+WORKER_ID = struct.Struct(">I")
+
+# 转发通道的写缓冲区超过此大小时丢弃消息，避免对端处理不过来时内存无限增长
+MAX_PEER_BUFFER = 64 * 1024 * 1024
+
+def socket_path(cluster_dir, worker_id):
+    """工作进程的Unix套接字路径"""
+    return os.path.join(cluster_dir, f"worker-{worker_id}.sock")
+
+class ClusterWorker:
+    """工作进程内的集群路由：同步订阅过滤器，按订阅转发消息"""
+
+    def __init__(self, worker_id: int, workers: int, cluster_dir: str):
+        self.worker_id = worker_id
+        self.workers = workers
+        self.cluster_dir = cluster_dir
+        self.peers: Dict[int, asyncio.StreamWriter] = {}  # 工作进程ID -> 发往该进程的通道
+        self.remote_topics = TopicTrie()  # 订阅过滤器 -> [有订阅者的工作进程ID]
+        self.forwarded_messages = 0
+        self.dropped_messages = 0
+
+    async def start(self):
+        """启动进程间通道，并注册订阅监听和发布钩子"""
+        await asyncio.start_unix_server(self._handle_peer, socket_path(self.cluster_dir, self.worker_id))
+        mqtt_server.topics.listeners.append(self)
+        mqtt_server.publish_hooks.append(self.forward)
+        for peer_id in range(self.workers):
+            if peer_id != self.worker_id:
+                asyncio.ensure_future(self._connect_peer(peer_id))
+
+    async def _connect_peer(self, peer_id: int):
+        """连接到其他工作进程，连上后先同步本进程已有的全部订阅过滤器"""
+        path = socket_path(self.cluster_dir, peer_id)
+        while True:
+            try:
+                _, writer = await asyncio.open_unix_connection(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.1)
+        self._send(writer, HELLO, WORKER_ID.pack(self.worker_id))
+        for topic_filter in mqtt_server.topics.to_dict():
+            self._send(writer, FILTER_ADDED, topic_filter.encode('utf-8'))
+        self.peers[peer_id] = writer
+
+    def _send(self, writer, frame_type: int, *parts):
+        if writer.transport.get_write_buffer_size() > MAX_PEER_BUFFER:
+            self.dropped_messages += 1
+            return
+        length = sum(len(part) for part in parts)
+        write_chunks(writer.transport, [FRAME_HEADER.pack(frame_type, length), *parts])
+
+    def filter_added(self, topic_filter: str):
+        for writer in self.peers.values():
+            self._send(writer, FILTER_ADDED, topic_filter.encode('utf-8'))
+
+    def filter_removed(self, topic_filter: str):
+        for writer in self.peers.values():
+            self._send(writer, FILTER_REMOVED, topic_filter.encode('utf-8'))
+
+    def forward(self, topic: str, message: bytes, qos: int, retain: bool, properties: Optional[Dict[int, object]]):
+        """把本地发布的消息转发给有匹配订阅者的进程；保留消息转发给所有进程"""
+        if retain:
+            targets = list(self.peers)
+        else:
+            targets = self.remote_topics.match(topic)
+            if not targets:
+                return
+        topic_bytes = topic.encode('utf-8')
+        header = PUBLISH_HEADER.pack(qos, int(retain), len(topic_bytes))
+        # 只转发需要转发给订阅者的属性，消息过期间隔原样转发，由接收进程重新计时
+        encoded_properties = encode_publish_properties(
+            properties, properties.get(MESSAGE_EXPIRY_INTERVAL) if properties else None)
+        for peer_id in targets:
+            writer = self.peers.get(int(peer_id))
+            if writer is not None:
+                self._send(writer, FORWARD_PUBLISH, header, topic_bytes, encoded_properties, message)
+                self.forwarded_messages += 1
+
+    async def _handle_peer(self, reader, writer):
+        """处理其他工作进程发来的报文"""
+        peer_id = None
+        try:
+            while True:
+                frame_type, length = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+                body = await reader.readexactly(length)
+
+                if frame_type == FORWARD_PUBLISH:
+                    qos, retain, topic_len = PUBLISH_HEADER.unpack_from(body)
+                    offset = PUBLISH_HEADER.size
+                    topic = body[offset:offset + topic_len].decode('utf-8')
+                    properties, offset = decode_properties(body, offset + topic_len)
+                    message = memoryview(body)[offset:]
+                    await publish_message(None, topic, message, qos, bool(retain), propagate=False,
+                                          properties=properties or None)
+
+                elif frame_type == FILTER_ADDED:
+                    self.remote_topics.subscribe(body.decode('utf-8'), str(peer_id))
+
+                elif frame_type == FILTER_REMOVED:
+                    self.remote_topics.unsubscribe(body.decode('utf-8'), str(peer_id))
+
+                elif frame_type == HELLO:
+                    peer_id = WORKER_ID.unpack(body)[0]
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            # 对端进程退出，移除它的全部订阅过滤器
+            if peer_id is not None:
+                self.remote_topics.unsubscribe_all(str(peer_id))
+                self.peers.pop(peer_id, None)
+            writer.close()
+
+async def run_worker(worker_id: int, workers: int, cluster_dir: str):
+    """工作进程主函数"""
+    worker = ClusterWorker(worker_id, workers, cluster_dir)
+    await worker.start()
+    await start_mqtt_server()
+
+def worker_main(worker_id: int, workers: int, cluster_dir: str):
+    mqtt_config.reuse_port = True
+    # 流式转发的消息不保留完整内容，无法转发给其他工作进程
+    mqtt_config.stream_threshold = 0
+    try:
+        run_event_loop(run_worker(worker_id, workers, cluster_dir))
+    except KeyboardInterrupt:
+        pass
+
+def run_cluster(workers: int):
+    """启动workers个工作进程并等待它们退出"""
+    cluster_dir = tempfile.mkdtemp(prefix="mqtt_cluster_")
+    # 工作进程通过fork继承主进程中已设置好的mqtt_config
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=worker_main, args=(worker_id, workers, cluster_dir), daemon=True)
+        for worker_id in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    # 被终止时同样走下面的清理流程，否则工作进程会继续占用监听端口
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        print("服务器关闭")
+    finally:
+        for process in processes:
+            process.terminate()
+        shutil.rmtree(cluster_dir, ignore_errors=True)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='MQTT服务器多进程模式')
+    parser.add_argument('--mqtt-host', type=str, default='0.0.0.0', help='MQTT服务器主机地址')
+    parser.add_argument('--mqtt-port', type=int, default=1883, help='MQTT服务器端口')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='工作进程数')
+    parser.add_argument('--max-connections', type=int, default=100, help='每个工作进程的最大连接数')
+    parser.add_argument('--engine', type=str, default=mqtt_config.engine, choices=ENGINES, help='连接处理引擎')
+    parser.add_argument('--uvloop', action='store_true', help='已安装uvloop时使用uvloop事件循环')
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    mqtt_config.host = args.mqtt_host
+    mqtt_config.port = args.mqtt_port
+    mqtt_config.max_connections = args.max_connections
+    mqtt_config.engine = args.engine
+    mqtt_config.use_uvloop = args.uvloop
+    run_cluster(args.workers)
@@ -0,0 +1,149 @@
+"""
+MQTT服务器日志
+
+事件日志通过队列交给后台线程格式化和写出，事件循环线程只负责入队。
+每类事件有独立的日志级别；逐条消息的事件（如PUBLISH）按速率采样，
+消息内容只在真正写出时才截断并转换为预览文本。
+"""
+import atexit
+import logging
+import queue
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+
+logger = logging.getLogger("mqtt_server")
+
+# 各类事件的默认日志级别
+EVENT_LEVELS: Dict[str, int] = {
+    "server": logging.INFO,  # 服务器启动、关闭
+    "connect": logging.INFO,  # 客户端连接
+    "disconnect": logging.INFO,  # 客户端断开
+    "subscribe": logging.INFO,  # 订阅
+    "unsubscribe": logging.INFO,  # 取消订阅
+    "publish": logging.DEBUG,  # 收到的每条发布消息
+    "slow_consumer": logging.WARNING,  # 发送队列已满断开客户端
+    "keepalive": logging.INFO,  # 保活超时断开客户端
+    "error": logging.ERROR,  # 处理客户端时的异常
+}
+
+# 逐条消息的高频事件，按速率采样；错误等其他事件总是记录
+SAMPLED_EVENTS = {"publish"}
+
+class PayloadPreview:
+    """消息内容的预览，只在格式化时截断并解码，不能按UTF-8解码时显示为十六进制"""
+    __slots__ = ("payload", "limit")
+
+    def __init__(self, payload: bytes, limit: int):
+        self.payload = payload
+        self.limit = limit
+
+    def __str__(self):
+        data = bytes(self.payload[:self.limit])
+        try:
+            text = repr(data.decode('utf-8'))
+        except UnicodeDecodeError:
+            text = data.hex()
+        if len(self.payload) > self.limit:
+            text += f"...({len(self.payload)}字节)"
+        return text
+
+class RateSampler:
+    """每秒最多放行rate条记录，并统计被丢弃的条数"""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.suppressed = 0
+
+    def ready(self) -> bool:
+        """下一条记录能否放行（不消耗配额），不能时计为丢弃"""
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return True
+        self.suppressed += 1
+        return False
+
+    def allow(self) -> bool:
+        """放行一条记录并消耗配额"""
+        if not self.ready():
+            return False
+        self.tokens -= 1
+        return True
+
+class EventFormatter(logging.Formatter):
+    """输出 时间 级别 [事件] 描述 key=value ..."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s [%(event)s] %(message)s")
+
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return text
+
+class _RecordQueueHandler(QueueHandler):
+    """把日志记录原样放入队列，格式化留给后台线程"""
+
+    def prepare(self, record):
+        return record
+
+_levels: Dict[str, int] = dict(EVENT_LEVELS)
+_samplers: Dict[str, RateSampler] = {}
+_listener: Optional[QueueListener] = None
+payload_preview_bytes = 64
+
+def configure(level=logging.INFO, sample_rate: float = 10, preview_bytes: int = 64,
+              event_levels: Optional[Dict[str, str]] = None, stream=None):
+    """设置日志级别和采样，并启动后台写日志线程（重复调用时只更新设置）"""
+    global _listener, payload_preview_bytes
+    logger.setLevel(level)
+    _levels.clear()
+    _levels.update(EVENT_LEVELS)
+    for event, event_level in (event_levels or {}).items():
+        _levels[event] = logging.getLevelName(event_level.upper()) if isinstance(event_level, str) else event_level
+    _samplers.clear()
+    for event in SAMPLED_EVENTS:
+        _samplers[event] = RateSampler(sample_rate)
+    payload_preview_bytes = preview_bytes
+
+    if _listener is None:
+        records = queue.SimpleQueue()
+        handler = logging.StreamHandler(stream or sys.stdout)
+        handler.setFormatter(EventFormatter())
+        _listener = QueueListener(records, handler)
+        _listener.start()
+        logger.addHandler(_RecordQueueHandler(records))
+        logger.propagate = False
+        atexit.register(_listener.stop)
+
+def enabled(event: str) -> bool:
+    """事件是否会被记录，调用方可据此跳过构造日志参数；采样的事件未被放行时同样返回False"""
+    if not logger.isEnabledFor(_levels.get(event, logging.INFO)):
+        return False
+    sampler = _samplers.get(event)
+    return sampler is None or sampler.ready()
+
+def log_event(event: str, message: str, **fields):
+    """记录一个事件；fields中的值在后台线程格式化时才转换为字符串"""
+    level = _levels.get(event, logging.INFO)
+    if not logger.isEnabledFor(level):
+        return
+    sampler = _samplers.get(event)
+    if sampler is not None:
+        if not sampler.allow():
+            return
+        if sampler.suppressed:
+            fields["suppressed"] = sampler.suppressed
+            sampler.suppressed = 0
+    logger.log(level, message, extra={"event": event, "fields": fields})
+
+def preview(payload: bytes) -> PayloadPreview:
+    """消息内容的延迟预览"""
+    return PayloadPreview(payload, payload_preview_bytes)
@@ -0,0 +1,103 @@
+"""
+MQTT服务器运行指标
+
+计数器和直方图都是普通的整数属性，热路径上只做加法；
+只有在 /metrics 被抓取时才汇总并输出为Prometheus文本格式。
+"""
+from bisect import bisect_left
+from typing import List, Sequence, Tuple
+
+# MQTT数据包类型名称，下标为类型值
+PACKET_TYPES = ("reserved", "connect", "connack", "publish", "puback", "pubrec", "pubrel", "pubcomp",
+                "subscribe", "suback", "unsubscribe", "unsuback", "pingreq", "pingresp", "disconnect", "auth")
+
+class Histogram:
+    """固定分桶的直方图"""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # 最后一个为+Inf桶
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """返回 (上界, 累计次数) 列表，最后一项为+Inf"""
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append(("+Inf" if bound == float("inf") else f"{bound:g}", total))
+        return result
+
+class BrokerMetrics:
+    def __init__(self):
+        self.packets_in = [0] * 16  # 按数据包类型
+        self.packets_out = [0] * 16
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.socket_writes = 0  # 写入客户端连接的次数（合并后），与发出的报文数之比反映写合并的效果
+        self.connects = 0  # 接受的连接
+        self.rejects = 0  # 被拒绝的连接（CONNACK返回码非0）
+        self.dropped_messages = 0  # 因队列已满或离线队列已满丢弃的消息
+        self.queue_overflows = 0  # 发送队列已满的次数（按慢消费者策略处理）
+        self.published_messages = 0  # 路由的发布消息数
+        self.expired_messages = 0  # 排队或离线期间超过消息过期间隔而丢弃的消息（MQTT 5）
+        self.evicted_messages = 0  # 虚拟客户端缓冲区已满时被挤出的消息
+        # 消息从服务器收到到写入订阅者连接的延迟（秒）
+        self.deliver_latency = Histogram((0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+        # 每条发布消息投递到的订阅者数
+        self.fanout = Histogram((0, 1, 2, 5, 10, 50, 100, 500, 1000, 5000))
+
+def render_prometheus(metrics: BrokerMetrics, gauges: Sequence[Tuple[str, str, float]] = ()) -> str:
+    """把指标输出为Prometheus文本格式，gauges为抓取时计算的 (名称, 说明, 值)"""
+    lines = []
+
+    def counter(name, help_text, value):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        lines.append(f"{name} {value}")
+
+    for name, help_text, values in (
+            ("mqtt_packets_received_total", "MQTT packets received by type", metrics.packets_in),
+            ("mqtt_packets_sent_total", "MQTT packets sent by type", metrics.packets_out)):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for packet_type, value in enumerate(values):
+            if value:
+                lines.append(f'{name}{{type="{PACKET_TYPES[packet_type]}"}} {value}')
+
+    counter("mqtt_bytes_received_total", "Bytes received from clients", metrics.bytes_in)
+    counter("mqtt_bytes_sent_total", "Bytes written to clients", metrics.bytes_out)
+    counter("mqtt_socket_writes_total", "Coalesced writes to client connections", metrics.socket_writes)
+    counter("mqtt_connects_total", "Accepted connections", metrics.connects)
+    counter("mqtt_connect_rejects_total", "Rejected connections", metrics.rejects)
+    counter("mqtt_dropped_messages_total", "Messages dropped because a queue was full", metrics.dropped_messages)
+    counter("mqtt_queue_overflows_total", "Times a client send queue was full", metrics.queue_overflows)
+    counter("mqtt_published_messages_total", "Messages routed to subscribers", metrics.published_messages)
+    counter("mqtt_expired_messages_total", "Queued messages dropped after their expiry interval",
+            metrics.expired_messages)
+    counter("mqtt_evicted_messages_total", "Messages evicted from full virtual client buffers",
+            metrics.evicted_messages)
+
+    for name, help_text, histogram in (
+            ("mqtt_deliver_latency_seconds", "Time from receiving a message to writing it to a subscriber",
+             metrics.deliver_latency),
+            ("mqtt_fanout_subscribers", "Subscribers each published message was delivered to", metrics.fanout)):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for bound, count in histogram.cumulative():
+            lines.append(f'{name}_bucket{{le="{bound}"}} {count}')
+        lines.append(f"{name}_sum {histogram.sum:g}")
+        lines.append(f"{name}_count {histogram.count}")
+
+    for name, help_text, value in gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+
+    return "\n".join(lines) + "\n"
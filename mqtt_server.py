@@ -1,391 +1,2347 @@
-import asyncio
-import json
-import os
-from typing import Dict, List, Optional, Set
-
-# MQTT服务器的配置类
-class MQTTConfig:
-    def __init__(self):
-        self.host = "0.0.0.0"  # 监听所有网络接口
-        self.port = 1883  # 默认MQTT端口
-        self.allow_anonymous = True  # 允许匿名连接
-        self.users = {}  # 用户名:密码
-        self.max_connections = 100  # 最大连接数
-        self.max_keepalive = 60  # 最大保持连接时间（秒）
-
-# 全局配置实例
-mqtt_config = MQTTConfig()
-
-# 客户端连接记录
-class Client:
-    def __init__(self, client_id: str, reader, writer):
-        self.client_id = client_id
-        self.reader = reader
-        self.writer = writer
-        self.subscriptions: Set[str] = set()
-        self.connected = True
-        self.username: Optional[str] = None
-
-# 全局变量
-clients: Dict[str, Client] = {}
-topics: Dict[str, List[str]] = {}  # topic -> [client_ids]
-
-# MQTT 数据包类型
-CONNECT = 1
-CONNACK = 2
-PUBLISH = 3
-PUBACK = 4
-SUBSCRIBE = 8
-SUBACK = 9
-UNSUBSCRIBE = 10
-UNSUBACK = 11
-PINGREQ = 12
-PINGRESP = 13
-DISCONNECT = 14
-
-# MQTT 连接返回码
-CONN_ACCEPTED = 0
-CONN_REFUSED_PROTOCOL = 1
-CONN_REFUSED_ID = 2
-CONN_REFUSED_SERVER = 3
-CONN_REFUSED_USER = 4
-CONN_REFUSED_AUTH = 5
-
-async def handle_client(reader, writer):
-    """处理MQTT客户端连接"""
-    client_id = None
-    client = None
-    
-    try:
-        while True:
-            # 读取固定头
-            first_byte = await reader.readexactly(1)
-            packet_type = (first_byte[0] >> 4) & 0x0F
-            
-            # 读取剩余长度
-            multiplier = 1
-            remaining_length = 0
-            while True:
-                byte = await reader.readexactly(1)
-                remaining_length += (byte[0] & 127) * multiplier
-                multiplier *= 128
-                if byte[0] & 128 == 0:
-                    break
-            
-            # 读取剩余的数据包
-            if remaining_length > 0:
-                payload = await reader.readexactly(remaining_length)
-            else:
-                payload = bytes()
-            
-            # 处理不同类型的MQTT数据包
-            if packet_type == CONNECT:
-                protocol_name_len = (payload[0] << 8) | payload[1]
-                protocol_name = payload[2:2+protocol_name_len].decode('utf-8')
-                offset = 2 + protocol_name_len
-                protocol_level = payload[offset]
-                offset += 1
-                connect_flags = payload[offset]
-                offset += 1
-                
-                # 解析保持连接时间
-                keepalive = (payload[offset] << 8) | payload[offset+1]
-                offset += 2
-                
-                # 解析客户端ID
-                client_id_len = (payload[offset] << 8) | payload[offset+1]
-                offset += 2
-                client_id = payload[offset:offset+client_id_len].decode('utf-8')
-                offset += client_id_len
-                
-                # 处理用户名和密码认证
-                username = None
-                password = None
-                
-                if connect_flags & 0x80:  # 用户名标志
-                    username_len = (payload[offset] << 8) | payload[offset+1]
-                    offset += 2
-                    username = payload[offset:offset+username_len].decode('utf-8')
-                    offset += username_len
-                
-                if connect_flags & 0x40:  # 密码标志
-                    password_len = (payload[offset] << 8) | payload[offset+1]
-                    offset += 2
-                    password = payload[offset:offset+password_len].decode('utf-8')
-                
-                # 检查认证
-                conn_return_code = CONN_ACCEPTED
-                
-                if not mqtt_config.allow_anonymous and username is None:
-                    conn_return_code = CONN_REFUSED_AUTH
-                
-                if username is not None and username in mqtt_config.users:
-                    if mqtt_config.users[username] != password:
-                        conn_return_code = CONN_REFUSED_AUTH
-                
-                if len(clients) >= mqtt_config.max_connections:
-                    conn_return_code = CONN_REFUSED_SERVER
-                
-                # 发送CONNACK数据包
-                connack = bytearray([
-                    CONNACK << 4, 2,  # 固定头，剩余长度为2
-                    0,  # 连接确认标志（没有会话）
-                    conn_return_code  # 连接返回码
-                ])
-                writer.write(connack)
-                await writer.drain()
-                
-                if conn_return_code == CONN_ACCEPTED:
-                    # 如果客户端已存在，清理旧连接
-                    if client_id in clients:
-                        old_client = clients[client_id]
-                        old_client.connected = False
-                        old_client.writer.close()
-                        await old_client.writer.wait_closed()
-                        # 从主题中移除旧客户端的订阅
-                        for topic in old_client.subscriptions:
-                            if topic in topics and client_id in topics[topic]:
-                                topics[topic].remove(client_id)
-                    
-                    # 创建新的客户端记录
-                    client = Client(client_id, reader, writer)
-                    client.username = username
-                    clients[client_id] = client
-                    print(f"客户端 {client_id} 已连接")
-                else:
-                    # 连接被拒绝，关闭连接
-                    writer.close()
-                    await writer.wait_closed()
-                    return
-            
-            elif packet_type == PUBLISH:
-                if client is None:
-                    continue
-                
-                # QoS位在第一个字节的1、2位
-                qos = (first_byte[0] >> 1) & 0x03
-                
-                # 解析主题
-                topic_len = (payload[0] << 8) | payload[1]
-                topic = payload[2:2+topic_len].decode('utf-8')
-                offset = 2 + topic_len
-                
-                # 对于QoS>0，提取消息ID
-                message_id = None
-                if qos > 0:
-                    message_id = (payload[offset] << 8) | payload[offset+1]
-                    offset += 2
-                
-                # 提取消息内容
-                message = payload[offset:]
-                
-                print(f"收到来自客户端 {client_id} 的发布消息: 主题={topic}, 消息={message.decode('utf-8')}")
-                
-                # 将消息转发给所有订阅此主题的客户端
-                await publish_message(client_id, topic, message, qos)
-                
-                # 对于QoS 1，发送PUBACK
-                if qos == 1 and message_id is not None:
-                    puback = bytearray([
-                        PUBACK << 4, 2,  # 固定头，剩余长度为2
-                        (message_id >> 8) & 0xFF,  # 消息ID高位
-                        message_id & 0xFF  # 消息ID低位
-                    ])
-                    writer.write(puback)
-                    await writer.drain()
-            
-            elif packet_type == SUBSCRIBE:
-                if client is None:
-                    continue
-                
-                offset = 0
-                message_id = (payload[offset] << 8) | payload[offset+1]
-                offset += 2
-                
-                # 解析订阅的主题
-                granted_qos = []
-                while offset < len(payload):
-                    topic_len = (payload[offset] << 8) | payload[offset+1]
-                    offset += 2
-                    topic = payload[offset:offset+topic_len].decode('utf-8')
-                    offset += topic_len
-                    requested_qos = payload[offset]
-                    offset += 1
-                    
-                    # 添加到客户端的订阅列表
-                    client.subscriptions.add(topic)
-                    
-                    # 添加到主题的订阅者列表
-                    if topic not in topics:
-                        topics[topic] = []
-                    if client_id not in topics[topic]:
-                        topics[topic].append(client_id)
-                    
-                    # QoS级别我们支持最高为1
-                    granted_qos.append(min(requested_qos, 1))
-                    
-                    print(f"客户端 {client_id} 订阅了主题: {topic}, QoS={min(requested_qos, 1)}")
-                
-                # 发送SUBACK数据包
-                suback = bytearray([
-                    SUBACK << 4, 2 + len(granted_qos),  # 固定头
-                    (message_id >> 8) & 0xFF,  # 消息ID高位
-                    message_id & 0xFF  # 消息ID低位
-                ] + granted_qos)
-                writer.write(suback)
-                await writer.drain()
-            
-            elif packet_type == UNSUBSCRIBE:
-                if client is None:
-                    continue
-                
-                offset = 0
-                message_id = (payload[offset] << 8) | payload[offset+1]
-                offset += 2
-                
-                # 解析要取消订阅的主题
-                while offset < len(payload):
-                    topic_len = (payload[offset] << 8) | payload[offset+1]
-                    offset += 2
-                    topic = payload[offset:offset+topic_len].decode('utf-8')
-                    offset += topic_len
-                    
-                    # 从客户端的订阅列表中移除
-                    if topic in client.subscriptions:
-                        client.subscriptions.remove(topic)
-                    
-                    # 从主题的订阅者列表中移除
-                    if topic in topics and client_id in topics[topic]:
-                        topics[topic].remove(client_id)
-                        print(f"客户端 {client_id} 取消订阅了主题: {topic}")
-                
-                # 发送UNSUBACK
-                unsuback = bytearray([
-                    UNSUBACK << 4, 2,  # 固定头
-                    (message_id >> 8) & 0xFF,  # 消息ID高位
-                    message_id & 0xFF  # 消息ID低位
-                ])
-                writer.write(unsuback)
-                await writer.drain()
-            
-            elif packet_type == PINGREQ:
-                # 回复PINGRESP
-                pingresp = bytearray([PINGRESP << 4, 0])  # 固定头，剩余长度为0
-                writer.write(pingresp)
-                await writer.drain()
-            
-            elif packet_type == DISCONNECT:
-                break
-    
-    except asyncio.IncompleteReadError:
-        # 连接断开
-        pass
-    except Exception as e:
-        print(f"处理客户端错误: {e}")
-    finally:
-        # 清理
-        if client_id and client_id in clients:
-            clients[client_id].connected = False
-            del clients[client_id]
-            
-            # 从所有主题中移除此客户端
-            for topic in list(topics.keys()):
-                if client_id in topics[topic]:
-                    topics[topic].remove(client_id)
-                    if not topics[topic]:  # 如果主题没有订阅者，删除主题
-                        del topics[topic]
-            
-            print(f"客户端 {client_id} 已断开连接")
-        
-        writer.close()
-        await writer.wait_closed()
-
-async def publish_message(sender_id, topic, message, qos=0):
-    """将消息发布到指定主题的所有订阅者"""
-    # 查找与主题匹配的所有订阅者
-    matching_clients = set()
-    
-    for t, client_ids in topics.items():
-        if topic_matches(t, topic):
-            matching_clients.update(client_ids)
-    
-    # 向所有匹配的客户端发送消息
-    for client_id in matching_clients:
-        if client_id == sender_id:  # 不要发送给发布者自己
-            continue
-        
-        if client_id in clients and clients[client_id].connected:
-            client = clients[client_id]
-            try:
-                # 构建PUBLISH数据包
-                first_byte = PUBLISH << 4
-                if qos > 0:
-                    first_byte |= 2  # 设置QoS位
-                
-                # 计算可变头和负载的总长度
-                topic_bytes = topic.encode('utf-8')
-                var_header_len = 2 + len(topic_bytes)
-                
-                if qos > 0:
-                    var_header_len += 2  # 消息ID长度
-                
-                remaining_length = var_header_len + len(message)
-                
-                # 编码剩余长度
-                remaining_length_bytes = encode_remaining_length(remaining_length)
-                
-                # 构建完整的数据包
-                packet = bytearray([first_byte]) + remaining_length_bytes
-                
-                # 添加主题
-                packet.extend([len(topic_bytes) >> 8, len(topic_bytes) & 0xFF])
-                packet.extend(topic_bytes)
-                
-                # 添加消息ID（如果QoS > 0）
-                if qos > 0:
-                    message_id = 1  # 简化处理，使用固定的消息ID
-                    packet.extend([(message_id >> 8) & 0xFF, message_id & 0xFF])
-                
-                # 添加消息内容
-                packet.extend(message)
-                
-                # 发送数据包
-                client.writer.write(packet)
-                await client.writer.drain()
-            except Exception as e:
-                print(f"向客户端 {client_id} 发送消息失败: {e}")
-                client.connected = False
-
-def encode_remaining_length(length):
-    """编码MQTT数据包的剩余长度字段"""
-    result = bytearray()
-    while True:
-        byte = length & 0x7F
-        length >>= 7
-        if length > 0:
-            byte |= 0x80
-        result.append(byte)
-        if length == 0:
-            break
-    return result
-
-def topic_matches(subscription_topic, publish_topic):
-    """检查发布主题是否与订阅主题匹配（支持通配符）"""
-    # 简单实现，不支持+和#通配符
-    return subscription_topic == publish_topic
-
-async def start_mqtt_server():
-    """启动MQTT服务器"""
-    server = await asyncio.start_server(
-        handle_client, mqtt_config.host, mqtt_config.port)
-    
-    print(f"MQTT服务器启动在 {mqtt_config.host}:{mqtt_config.port}")
-    
-    async with server:
-        await server.serve_forever()
-
-if __name__ == "__main__":
-    try:
-        asyncio.run(start_mqtt_server())
-    except KeyboardInterrupt:
+import asyncio
+import concurrent.futures
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional, Set, Tuple
+
+import mqtt_logging
+from mqtt_logging import log_event
+from mqtt_metrics import BrokerMetrics
+from mqtt_v5 import (BAD_USERNAME_OR_PASSWORD, CLIENT_IDENTIFIER_NOT_VALID, KEEP_ALIVE_TIMEOUT,
+                     MAXIMUM_PACKET_SIZE, MESSAGE_EXPIRY_INTERVAL, NO_MATCHING_SUBSCRIBERS, NO_SUBSCRIPTION_EXISTED,
+                     MALFORMED_PACKET, NOT_AUTHORIZED, PACKET_TOO_LARGE, PROTOCOL_ERROR, QUOTA_EXCEEDED, RECEIVE_MAXIMUM,
+                     RECEIVE_MAXIMUM_EXCEEDED, SERVER_KEEP_ALIVE, SERVER_UNAVAILABLE, SESSION_EXPIRY_INTERVAL,
+                     SESSION_TAKEN_OVER, SUBSCRIPTION_IDENTIFIER_AVAILABLE, TOPIC_ALIAS, TOPIC_ALIAS_INVALID,
+                     TOPIC_ALIAS_MAXIMUM, TOPIC_FILTER_INVALID, TOPIC_NAME_INVALID, UNSUPPORTED_PROTOCOL_VERSION,
+                     decode_properties, decode_varint, encode_properties, encode_publish_properties, encode_varint,
+                     refresh_expiry)
+
+# 慢消费者策略（发送队列已满时）
+DROP_NEWEST = "drop_newest"  # 丢弃新到的消息
+DROP_OLDEST = "drop_oldest"  # 丢弃队列中最早的消息
+DISCONNECT_CLIENT = "disconnect"  # 断开客户端连接
+SLOW_CONSUMER_POLICIES = (DROP_NEWEST, DROP_OLDEST, DISCONNECT_CLIENT)
+
+# 共享订阅（$share/组名/过滤器）在组内选择接收者的策略
+ROUND_ROBIN = "round_robin"  # 轮流投递给组内的每个成员
+LEAST_QUEUE_DEPTH = "least_queue_depth"  # 投递给发送队列最短的成员
+STICKY_BY_PUBLISHER = "sticky"  # 同一发布者的消息总是投递给同一个成员
+
+# 连接处理引擎
+STREAMS_ENGINE = "streams"  # asyncio流：每个连接一个读任务和一个发送任务
+PROTOCOL_ENGINE = "protocol"  # asyncio.Protocol：收到数据直接解码处理，直接写入transport
+ENGINES = (STREAMS_ENGINE, PROTOCOL_ENGINE)
+
+# MQTT服务器的配置类
+class MQTTConfig:
+    def __init__(self):
+        self.host = "0.0.0.0"  # 监听所有网络接口
+        self.port = 1883  # 默认MQTT端口
+        self.allow_anonymous = True  # 允许匿名连接
+        self.users = {}  # 用户名:密码
+        self.max_connections = 100  # 最大连接数
+        self.max_keepalive = 60  # MQTT 5客户端的最大保持连接时间（秒）
+        self.max_queued_messages = 1000  # 每个客户端发送队列的最大消息数
+        self.slow_consumer_policy = DROP_NEWEST  # 发送队列已满时的处理策略
+        self.max_inflight_messages = 20  # 每个客户端未完成的QoS 1/2消息窗口（接收最大值）
+        self.retry_interval = 20  # 未确认消息的重发间隔（秒），只用于MQTT 3.1.1客户端
+        self.session_dir = os.path.join(tempfile.gettempdir(), "mqtt_sessions")  # 离线消息段文件目录
+        self.offline_memory_limit = 1024 * 1024  # 每个离线会话在内存中缓存的消息字节数，超出后写入段文件
+        self.offline_segment_size = 16 * 1024 * 1024  # 每个段文件的大小（字节）
+        self.max_offline_messages = 100000  # 每个离线会话最多保存的消息数
+        self.engine = STREAMS_ENGINE  # 连接处理引擎
+        self.use_uvloop = False  # 已安装uvloop时由run_event_loop使用uvloop事件循环
+        self.log_level = "INFO"  # 日志级别
+        self.log_event_levels: Dict[str, str] = {}  # 按事件覆盖日志级别，如 {"publish": "INFO"}
+        self.log_sample_rate = 10  # 逐条消息的事件（如收到PUBLISH）每秒最多记录的条数
+        self.log_payload_preview = 64  # 日志中消息内容预览的最大字节数
+        self.reuse_port = False  # 多进程模式下各工作进程通过SO_REUSEPORT共享监听端口
+        self.shared_subscription_strategy = ROUND_ROBIN  # 共享订阅的组内投递策略，见SHARED_STRATEGIES
+        self.topic_alias_maximum = 1024  # MQTT 5客户端发布时可使用的主题别名数，0表示不接受主题别名
+        self.max_packet_size = 0  # 接受的最大报文长度（字节），0表示不限制；超过的报文在解析出固定头后即断开连接
+        # 剩余长度不小于此值（字节）的非保留PUBLISH边接收边转发给在线订阅者（按QoS 0投递），0表示不流式转发
+        self.stream_threshold = 0
+        # 写合并窗口（微秒）：发给同一客户端的报文在此时间内攒成一次写入，增大可减少系统调用、提高吞吐，
+        # 但会增加投递延迟；0表示只合并同一轮事件循环中产生的报文
+        self.write_coalesce_us = 0
+        self.virtual_client_buffer = 1000  # 每个虚拟客户端最多缓冲的消息数，满时挤出最早的消息
+        self.virtual_client_ttl = 300  # 虚拟客户端超过此时间（秒）未被读取即断开，0表示不断开
+
+# 全局配置实例
+mqtt_config = MQTTConfig()
+
+# 客户端连接记录（流引擎，由发送任务写出队列中的数据）
+class Client:
+    def __init__(self, client_id: str, writer):
+        self.client_id = client_id
+        self.writer = writer
+        self.transport = writer.transport
+        self.connected = True
+        self.username: Optional[str] = None
+        self.protocol_level = MQTT_V311
+        self.receive_maximum = 65535  # 客户端声明的接收最大值（MQTT 5），与max_inflight_messages共同限制发送窗口
+        self.maximum_packet_size = 0  # 客户端声明的最大报文长度（MQTT 5），0表示不限制
+        
+        # 发送队列：控制报文（ACK等）不受队列长度限制，消息受限
+        self.control_queue = deque()
+        self.message_queue = deque()
+        self.message_times = deque()  # 与message_queue一一对应：消息被服务器收到的时间，用于统计投递延迟
+        self.dropped_messages = 0
+        self.queue_ready = asyncio.Event()
+        self.writer_task: Optional[asyncio.Task] = None
+        
+        # 保活：超过keepalive_timeout秒没有收到任何报文则断开
+        self.keepalive_timeout: Optional[float] = None
+        self.last_active = 0.0
+        
+        # QoS 1/2投递：已发送未确认的消息，以及等待窗口空出的消息
+        self.clean_session = True
+        self.next_packet_id = 1
+        self.inflight: Dict[int, "InflightMessage"] = {}
+        self.pending = deque()  # (header, message, qos, expires_at)
+        
+        # QoS 2握手状态，只保存消息ID
+        self.inbound_qos2: Set[int] = set()  # 收到PUBLISH、等待PUBREL的消息ID
+        self.pubrel_pending: Set[int] = set()  # 已发送PUBREL、等待PUBCOMP的消息ID
+        self.completed_ids: List[int] = []  # 已收到PUBCOMP、等待批量清理的消息ID
+        
+        # 持久会话离线期间积压的QoS>0消息，重连后随发送窗口逐步发出
+        self.offline: Optional["OfflineQueue"] = None
+        
+        # 正在写给此客户端的流式转发消息，写完之前队列中的其他报文暂不写出
+        self.stream: Optional["PublishStream"] = None
+
+    @property
+    def subscriptions(self) -> Set[str]:
+        """此客户端的订阅过滤器（来自订阅树和共享订阅的反向索引）"""
+        return topics.filters(self.client_id) | shared_subscriptions.filters(self.client_id)
+
+    @property
+    def queue_depth(self) -> int:
+        """发送队列中等待发送的消息数"""
+        return len(self.message_queue)
+
+    def start(self):
+        """启动此客户端的发送任务"""
+        self.writer_task = asyncio.ensure_future(self._write_loop())
+
+    def send(self, data):
+        """发送控制报文，data为bytes或bytes列表"""
+        self.control_queue.append(data)
+        self._data_ready()
+
+    def enqueue(self, data, bounded=True, published_at: Optional[float] = None) -> bool:
+        """将消息加入发送队列，按慢消费者策略处理队列已满的情况
+
+        已占用消息ID的QoS>0消息受窗口大小限制，以bounded=False入队。
+        published_at为服务器收到该消息的时间（time.monotonic），默认为入队时间。
+        """
+        if not self.connected:
+            return False
+        if bounded and len(self.message_queue) >= mqtt_config.max_queued_messages:
+            if not self._overflow(self.message_queue):
+                return False
+        self.message_queue.append(data)
+        self.message_times.append(time.monotonic() if published_at is None else published_at)
+        self._data_ready()
+        return True
+
+    def _data_ready(self):
+        """通知发送任务队列中有数据"""
+        self.queue_ready.set()
+
+    def _take_chunks(self) -> list:
+        """取出队列中积压的全部数据，控制报文在前"""
+        chunks = []
+        packets_out = metrics.packets_out
+        for queue in (self.control_queue, self.message_queue):
+            while queue:
+                data = queue.popleft()
+                if isinstance(data, list):
+                    packets_out[data[0][0] >> 4] += 1
+                    chunks.extend(data)
+                else:
+                    packets_out[data[0] >> 4] += 1
+                    chunks.append(data)
+        if chunks:
+            metrics.socket_writes += 1
+        times = self.message_times
+        if times:
+            now = time.monotonic()
+            observe = metrics.deliver_latency.observe
+            while times:
+                observe(now - times.popleft())
+        metrics.bytes_out += sum(map(len, chunks))
+        return chunks
+
+    def _overflow(self, queue) -> bool:
+        """队列已满时按慢消费者策略处理，返回新消息是否仍可入队"""
+        policy = mqtt_config.slow_consumer_policy
+        metrics.queue_overflows += 1
+        if policy == DROP_OLDEST:
+            queue.popleft()
+            if queue is self.message_queue:
+                self.message_times.popleft()
+            self.dropped_messages += 1
+            metrics.dropped_messages += 1
+            return True
+        if policy == DISCONNECT_CLIENT:
+            log_event("slow_consumer", "发送队列已满，断开连接", client_id=self.client_id)
+            self.close(QUOTA_EXCEEDED)
+            return False
+        self.dropped_messages += 1
+        metrics.dropped_messages += 1
+        return False
+
+    def publish(self, header: bytes, message: bytes, qos: int, published_at: Optional[float] = None,
+                expires_at: float = 0.0) -> bool:
+        """投递QoS>0的消息：窗口未满时分配消息ID并发送，否则排队等待
+
+        expires_at为消息过期的时间（time.monotonic），0表示不过期；排队的消息过期后不再发送。
+        """
+        if not self.connected:
+            return False
+        if self.offline:
+            # 离线消息尚未发完，新消息排在其后以保证顺序
+            return self.store_offline(header, message, qos, expires_at)
+        window = self.send_window
+        if self.inflight_count >= window and self.completed_ids:
+            self.release_completed()
+        if self.inflight_count >= window:
+            if len(self.pending) >= mqtt_config.max_queued_messages:
+                if not self._overflow(self.pending):
+                    return False
+            self.pending.append((header, message, qos, expires_at))
+            return True
+        self._send_inflight(header, message, qos, published_at)
+        return True
+
+    @property
+    def send_window(self) -> int:
+        """发送窗口：服务器的max_inflight_messages与客户端声明的接收最大值中较小的一个"""
+        return min(mqtt_config.max_inflight_messages, self.receive_maximum)
+
+    @property
+    def inflight_count(self) -> int:
+        """占用发送窗口的消息数（包括等待PUBCOMP的QoS 2消息）"""
+        return len(self.inflight) + len(self.pubrel_pending)
+
+    def _allocate_packet_id(self) -> int:
+        """分配一个未被占用的消息ID（1-65535）"""
+        packet_id = self.next_packet_id
+        while packet_id in self.inflight or packet_id in self.pubrel_pending:
+            packet_id = packet_id % 65535 + 1
+        self.next_packet_id = packet_id % 65535 + 1
+        return packet_id
+
+    def _send_inflight(self, header: bytes, message: bytes, qos: int, published_at: Optional[float] = None):
+        packet_id = self._allocate_packet_id()
+        entry = InflightMessage(self, packet_id, header, message, qos)
+        self.inflight[packet_id] = entry
+        self.enqueue([header, packet_id.to_bytes(2, 'big'), message], bounded=False, published_at=published_at)
+        self._schedule_retry(entry)
+
+    def _schedule_retry(self, entry: "InflightMessage"):
+        """按重发间隔排期重发；MQTT 5只允许在重连恢复会话时重发（[MQTT-4.4.0-1]），不排期"""
+        if self.protocol_level == MQTT_V5:
+            return
+        entry.retry_at = asyncio.get_running_loop().time() + mqtt_config.retry_interval
+        retry_wheel.schedule(entry, entry.retry_at)
+
+    def _release_inflight(self, entry: "InflightMessage"):
+        """释放已确认的消息：移出窗口和重发时间轮，不再引用消息内容（可能是接收缓冲区上的视图）"""
+        del self.inflight[entry.packet_id]
+        retry_wheel.cancel(entry, entry.retry_at)
+        entry.message = b""
+
+    def acknowledge(self, packet_id: int):
+        """处理PUBACK：释放消息ID，并用排队的消息补满窗口"""
+        entry = self.inflight.get(packet_id)
+        if entry is None or entry.qos != 1:
+            return
+        self._release_inflight(entry)
+        self._fill_window()
+
+    def received(self, packet_id: int, reason_code: int = 0):
+        """处理QoS 2的PUBREC：丢弃消息内容，只保留消息ID等待PUBCOMP
+
+        MQTT 5的PUBREC原因码不小于0x80时握手到此结束，直接释放消息ID。
+        """
+        entry = self.inflight.get(packet_id)
+        if entry is not None and entry.qos == 2:
+            self._release_inflight(entry)
+            if reason_code >= 0x80:
+                self._fill_window()
+                return
+            self.pubrel_pending.add(packet_id)
+        elif packet_id not in self.pubrel_pending:
+            return
+        # 重复的PUBREC同样回复PUBREL
+        self.send(encode_ack(PUBREL, packet_id))
+
+    def complete(self, packet_id: int):
+        """处理QoS 2的PUBCOMP：消息ID攒够一批后统一清理"""
+        if packet_id not in self.pubrel_pending:
+            return
+        self.completed_ids.append(packet_id)
+        # 有消息（包括离线队列中的消息）在等待窗口时立即清理，否则攒够一批再清理
+        if self.pending or self.offline or len(self.completed_ids) >= COMPLETED_BATCH_SIZE:
+            self.release_completed()
+
+    def release_completed(self):
+        """批量释放已完成的QoS 2消息ID，并补满发送窗口"""
+        self.pubrel_pending.difference_update(self.completed_ids)
+        self.completed_ids.clear()
+        self._fill_window()
+
+    def _fill_window(self):
+        """用排队的消息补满发送窗口，先发内存中排队的，再发离线队列中的"""
+        window = self.send_window
+        while self.inflight_count < window:
+            if self.pending:
+                header, message, qos, expires_at = self.pending.popleft()
+            elif self.offline:
+                header, message, qos, expires_at = self.offline.popleft()
+            else:
+                break
+            if expires_at:
+                message = self._unexpired(message, expires_at)
+                if message is None:
+                    continue
+            self._send_inflight(header, message, qos)
+
+    def _unexpired(self, message: bytes, expires_at: float) -> Optional[bytes]:
+        """排队的消息已过期时丢弃并返回None；MQTT 5客户端的消息过期间隔改为剩余的秒数"""
+        remaining = expires_at - time.monotonic()
+        if remaining <= 0:
+            metrics.expired_messages += 1
+            return None
+        if self.protocol_level == MQTT_V5:
+            return refresh_expiry(message, math.ceil(remaining))
+        return message
+
+    def store_offline(self, header: bytes, message: bytes, qos: int, expires_at: float = 0.0) -> bool:
+        """把QoS>0的消息存入离线队列"""
+        if self.offline is None:
+            self.offline = OfflineQueue(self.client_id)
+        if len(self.offline) >= mqtt_config.max_offline_messages:
+            self.dropped_messages += 1
+            metrics.dropped_messages += 1
+            return False
+        self.offline.append(header, message, qos, expires_at)
+        return True
+
+    def discard_session(self):
+        """丢弃会话：移除所有订阅并删除离线消息"""
+        topics.unsubscribe_all(self.client_id)
+        shared_subscriptions.unsubscribe_all(self.client_id)
+        if self.offline is not None:
+            self.offline.close()
+            self.offline = None
+
+    def retransmit(self, entry: "InflightMessage"):
+        """以DUP标志重发未确认的消息"""
+        header = entry.header
+        self.enqueue([bytes([header[0] | 0x08]), header[1:], entry.packet_id.to_bytes(2, 'big'), entry.message],
+                     bounded=False)
+        self._schedule_retry(entry)
+
+    def resume_session(self, old: "Client"):
+        """接管同ID旧连接的会话（clean session=0），重发其未完成的消息"""
+        old.connected = False
+        self.next_packet_id = old.next_packet_id
+        self.pending = old.pending
+        self.inbound_qos2 = old.inbound_qos2
+        old.pubrel_pending.difference_update(old.completed_ids)
+        self.pubrel_pending = old.pubrel_pending
+        for packet_id, entry in old.inflight.items():
+            entry.client = self
+            self.inflight[packet_id] = entry
+            self.retransmit(entry)
+        for packet_id in self.pubrel_pending:
+            self.send(encode_ack(PUBREL, packet_id))
+        # 离线期间积压的消息随发送窗口逐步从离线队列中取出
+        self.offline = old.offline
+        self._fill_window()
+
+    def close(self, reason_code: Optional[int] = None):
+        """标记客户端断开并立即中止连接，读循环随后结束并清理
+
+        MQTT 5客户端会先尽量写出带reason_code的DISCONNECT（发送缓冲区已满时会随连接一起丢弃）。
+        """
+        self.connected = False
+        self._data_ready()
+        if reason_code is not None and self.protocol_level == MQTT_V5:
+            self.transport.write(encode_disconnect(reason_code))
+        # 不等待发送缓冲区排空，慢消费者的缓冲区可能永远无法排空
+        self.transport.abort()
+
+    def stop(self):
+        """停止发送任务"""
+        self.connected = False
+        if self.writer_task is not None:
+            self.writer_task.cancel()
+
+    async def _write_loop(self):
+        """发送任务：把队列中积压的数据一次性写出，再等待缓冲区排空"""
+        control_queue = self.control_queue
+        message_queue = self.message_queue
+        try:
+            while self.connected:
+                if (not control_queue and not message_queue) or self.stream is not None:
+                    self.queue_ready.clear()
+                    await self.queue_ready.wait()
+                    continue
+                
+                # 等待写合并窗口，让随后到达的报文一起写出
+                if mqtt_config.write_coalesce_us:
+                    await asyncio.sleep(mqtt_config.write_coalesce_us / 1e6)
+                    if not self.connected:
+                        break
+                    # 等待期间开始了流式转发，其余报文要等流式转发结束后再写出
+                    if self.stream is not None:
+                        continue
+
+                write_chunks(self.transport, self._take_chunks())
+                await self.writer.drain()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log_event("error", "发送消息失败", client_id=self.client_id, error=repr(e))
+            self.close()
+
+# Protocol引擎的客户端连接记录：没有发送任务，队列中的数据在本轮事件循环结束时直接写入transport
+class ProtocolClient(Client):
+    def __init__(self, client_id: str, writer):
+        super().__init__(client_id, writer)
+        self.flush_scheduled = False
+
+    def start(self):
+        pass
+
+    def _data_ready(self):
+        """同一轮事件循环（或写合并窗口）中入队的数据合并为一次写入"""
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            if mqtt_config.write_coalesce_us:
+                asyncio.get_running_loop().call_later(mqtt_config.write_coalesce_us / 1e6, self.flush)
+            else:
+                asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        """把队列中的数据写入transport；写缓冲区超过高水位时暂停，等待resume_writing"""
+        self.flush_scheduled = False
+        if not self.connected or self.writer.paused or self.stream is not None:
+            return
+        chunks = self._take_chunks()
+        if chunks:
+            write_chunks(self.transport, chunks)
+
+    def stop(self):
+        self.connected = False
+
+# 进程内的虚拟客户端（如Web客户端）：没有网络连接，消息在MQTT服务器的事件循环中放入有界环形缓冲区，
+# 由另一个事件循环（如Web服务的）取出。缓冲区由空变为非空时才跨线程唤醒一次读取方，
+# 读取方取出前到达的消息攒在一起，一次取出
+class VirtualClient:
+    def __init__(self, client_id: str, loop: asyncio.AbstractEventLoop):
+        self.client_id = client_id
+        self.loop = loop  # 读取方的事件循环
+        self.messages = deque(maxlen=mqtt_config.virtual_client_buffer)  # (主题, 消息内容, QoS)
+        self.lock = threading.Lock()
+        self.ready = asyncio.Event()  # 缓冲区非空或已断开时为set，只在读取方的事件循环中使用
+        self.evicted = 0  # 上次取出后因缓冲区已满被挤出的消息数
+        self.evicted_messages = 0  # 累计被挤出的消息数
+        self.last_active = time.monotonic()  # 最后一次被读取的时间
+        self.closed = False
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.messages)
+
+    def deliver(self, topic: str, message, qos: int):
+        """（MQTT服务器的事件循环）放入一条消息，缓冲区已满时挤出最早的一条"""
+        with self.lock:
+            if len(self.messages) == self.messages.maxlen:
+                self.evicted += 1
+                self.evicted_messages += 1
+                metrics.evicted_messages += 1
+            # 消息可能是接收缓冲区上的视图，缓冲前拷贝
+            self.messages.append((topic, bytes(message), qos))
+            wake = len(self.messages) == 1
+        if wake:
+            self.loop.call_soon_threadsafe(self.ready.set)
+
+    def take(self, limit: Optional[int] = None) -> Tuple[List[Tuple[str, bytes, int]], int]:
+        """（读取方的事件循环）取出最多limit条消息，返回 (消息列表, 上次取出后被挤出的消息数)"""
+        self.last_active = time.monotonic()
+        with self.lock:
+            count = len(self.messages) if limit is None else min(limit, len(self.messages))
+            batch = [self.messages.popleft() for _ in range(count)]
+            evicted = self.evicted
+            self.evicted = 0
+            if not self.messages and not self.closed:
+                self.ready.clear()
+        return batch, evicted
+
+    def touch(self):
+        """读取方仍在等待消息，推迟空闲断开"""
+        self.last_active = time.monotonic()
+
+    def close(self):
+        """断开，唤醒读取方结束读取"""
+        self.closed = True
+        self.loop.call_soon_threadsafe(self.ready.set)
+
+# 已发送但未确认的QoS>0消息
+class InflightMessage:
+    __slots__ = ("client", "packet_id", "header", "message", "qos", "retry_at")
+
+    def __init__(self, client: Client, packet_id: int, header: bytes, message: bytes, qos: int):
+        self.client = client
+        self.packet_id = packet_id
+        self.header = header  # 不含消息ID的PUBLISH头部，可与其他订阅者共享
+        self.message = message
+        self.qos = qos
+        self.retry_at = 0.0
+
+# 离线消息段文件：预先分配大小并做内存映射，只追加写入，按顺序读出
+class SegmentFile:
+    # 记录格式：4字节记录长度、1字节QoS、8字节过期时间、4字节头部长度、PUBLISH头部、消息内容
+    RECORD_HEADER = struct.Struct(">IBdI")
+
+    def __init__(self, path: str, size: int):
+        """创建新的段文件，文件已存在时抛出FileExistsError，不覆盖其他进程（或会话）的段文件"""
+        self.path = path
+        self.size = size
+        self.file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600), "r+b")
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+        self.write_pos = 0
+        self.read_pos = 0
+
+    def append(self, header: bytes, message: bytes, qos: int, expires_at: float) -> bool:
+        """追加一条记录，空间不足时返回False"""
+        length = self.RECORD_HEADER.size + len(header) + len(message)
+        if self.write_pos + length > self.size:
+            return False
+        pos = self.write_pos
+        self.RECORD_HEADER.pack_into(self.map, pos, length, qos, expires_at, len(header))
+        pos += self.RECORD_HEADER.size
+        self.map[pos:pos + len(header)] = header
+        pos += len(header)
+        self.map[pos:pos + len(message)] = message
+        self.write_pos += length
+        return True
+
+    def popleft(self) -> Tuple[bytes, bytes, int, float]:
+        """读出最早的一条记录"""
+        length, qos, expires_at, header_len = self.RECORD_HEADER.unpack_from(self.map, self.read_pos)
+        pos = self.read_pos + self.RECORD_HEADER.size
+        header = self.map[pos:pos + header_len]
+        message = self.map[pos + header_len:self.read_pos + length]
+        self.read_pos += length
+        return header, message, qos, expires_at
+
+    @property
+    def exhausted(self) -> bool:
+        return self.read_pos >= self.write_pos
+
+    def close(self):
+        """关闭并删除段文件"""
+        self.map.close()
+        self.file.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+# 离线消息队列：先缓存在内存中，超过offline_memory_limit后追加到段文件
+class OfflineQueue:
+    def __init__(self, client_id: str):
+        # 客户端ID可能包含不能用作文件名的字符
+        self.name = hashlib.sha1(client_id.encode('utf-8')).hexdigest()[:16]
+        self.memory = deque()  # (header, message, qos, expires_at)
+        self.memory_bytes = 0
+        self.segments = deque()
+        self.segment_seq = 0
+        self.length = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def append(self, header: bytes, message: bytes, qos: int, expires_at: float = 0.0):
+        size = len(header) + len(message)
+        # 一旦开始写段文件，后续消息都写入段文件，保证先进先出
+        if not self.segments and self.memory_bytes + size <= mqtt_config.offline_memory_limit:
+            # 消息内容可能是接收缓冲区上的视图，拷贝一份，使memory_bytes与实际占用的内存一致
+            self.memory.append((header, bytes(message), qos, expires_at))
+            self.memory_bytes += size
+        elif not self.segments or not self.segments[-1].append(header, message, qos, expires_at):
+            segment = self._new_segment(SegmentFile.RECORD_HEADER.size + size)
+            segment.append(header, message, qos, expires_at)
+        self.length += 1
+
+    def popleft(self) -> Tuple[bytes, bytes, int, float]:
+        if self.memory:
+            entry = self.memory.popleft()
+            self.memory_bytes -= len(entry[0]) + len(entry[1])
+        else:
+            segment = self.segments[0]
+            entry = segment.popleft()
+            if segment.exhausted:
+                self.segments.popleft()
+                segment.close()
+        self.length -= 1
+        return entry
+
+    def _new_segment(self, min_size: int) -> SegmentFile:
+        os.makedirs(mqtt_config.session_dir, exist_ok=True)
+        # 多进程模式下各工作进程可能都有同一客户端ID的会话，文件名带上进程ID
+        while True:
+            self.segment_seq += 1
+            path = os.path.join(mqtt_config.session_dir, f"{self.name}-{os.getpid()}-{self.segment_seq}.seg")
+            try:
+                segment = SegmentFile(path, max(mqtt_config.offline_segment_size, min_size))
+            except FileExistsError:
+                # 之前的进程遗留的同名文件
+                continue
+            break
+        self.segments.append(segment)
+        return segment
+
+    def close(self):
+        """删除所有段文件"""
+        for segment in self.segments:
+            segment.close()
+        self.segments.clear()
+        self.memory.clear()
+        self.memory_bytes = 0
+        self.length = 0
+
+# 订阅树节点，每一层对应主题中的一级
+class TopicNode:
+    __slots__ = ("children", "subscribers")
+
+    def __init__(self):
+        self.children: Dict[str, "TopicNode"] = {}
+        self.subscribers: Dict[str, int] = {}  # 订阅到此层级的客户端ID（或共享订阅组）-> 授予的QoS
+
+# 按层级拆分的订阅树，支持+和#通配符
+class TopicTrie:
+    def __init__(self):
+        self.root = TopicNode()
+        # 反向索引：客户端ID -> 该客户端的订阅过滤器，断开连接时只需处理自己的订阅
+        self.client_filters: Dict[str, Set[str]] = {}
+        # 过滤器出现第一个订阅者、失去最后一个订阅者时通知的监听者
+        # （需实现filter_added/filter_removed方法，多进程模式用于同步订阅）
+        self.listeners: List[object] = []
+
+    def subscribe(self, topic_filter: str, client_id: str, qos: int = 0):
+        """添加订阅，重复订阅时更新QoS"""
+        node = self.root
+        for level in topic_filter.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = TopicNode()
+            node = child
+        new_filter = not node.subscribers
+        node.subscribers[client_id] = qos
+        filters = self.client_filters.get(client_id)
+        if filters is None:
+            filters = self.client_filters[client_id] = set()
+        filters.add(topic_filter)
+        if new_filter:
+            for listener in self.listeners:
+                listener.filter_added(topic_filter)
+
+    def unsubscribe(self, topic_filter: str, client_id: str) -> bool:
+        """移除订阅，并清理不再使用的节点"""
+        if not self._remove(topic_filter, client_id):
+            return False
+        filters = self.client_filters[client_id]
+        filters.discard(topic_filter)
+        if not filters:
+            del self.client_filters[client_id]
+        return True
+
+    def unsubscribe_all(self, client_id: str) -> int:
+        """移除客户端的所有订阅，返回移除的订阅数"""
+        filters = self.client_filters.pop(client_id, ())
+        for topic_filter in filters:
+            self._remove(topic_filter, client_id)
+        return len(filters)
+
+    def _remove(self, topic_filter: str, client_id: str) -> bool:
+        """从树中移除订阅（不更新反向索引）"""
+        path = [self.root]
+        levels = topic_filter.split('/')
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return False
+            path.append(node)
+
+        node = path[-1]
+        if node.subscribers.pop(client_id, None) is None:
+            return False
+        if not node.subscribers:
+            for listener in self.listeners:
+                listener.filter_removed(topic_filter)
+
+        # 自底向上删除空节点
+        for i in range(len(levels), 0, -1):
+            node = path[i]
+            if node.subscribers or node.children:
+                break
+            del path[i - 1].children[levels[i - 1]]
+        return True
+
+    def filters(self, client_id: str) -> Set[str]:
+        """返回客户端的订阅过滤器"""
+        return set(self.client_filters.get(client_id, ()))
+
+    def match(self, topic: str) -> Dict[str, int]:
+        """返回订阅了与该主题匹配的过滤器的所有客户端ID及其QoS
+
+        同一客户端有多个过滤器匹配时取最大的QoS。
+        """
+        result: Dict[str, int] = {}
+        levels = topic.split('/')
+        # 以$开头的主题不匹配首层的通配符
+        self._match(self.root, levels, 0, result, topic.startswith('$'))
+        return result
+
+    def _match(self, node: TopicNode, levels: List[str], index: int, result: Dict[str, int], dollar: bool):
+        if index == len(levels):
+            _collect(result, node.subscribers)
+            # "a/#" 同时匹配 "a"
+            multi = node.children.get('#')
+            if multi is not None:
+                _collect(result, multi.subscribers)
+            return
+
+        wildcard = not (dollar and index == 0)
+        if wildcard:
+            multi = node.children.get('#')
+            if multi is not None:
+                _collect(result, multi.subscribers)
+
+        child = node.children.get(levels[index])
+        if child is not None:
+            self._match(child, levels, index + 1, result, dollar)
+
+        if wildcard:
+            single = node.children.get('+')
+            if single is not None:
+                self._match(single, levels, index + 1, result, dollar)
+
+    def subscribers(self, topic_filter: str) -> List[str]:
+        """返回订阅了指定过滤器的客户端ID"""
+        node = self.root
+        for level in topic_filter.split('/'):
+            node = node.children.get(level)
+            if node is None:
+                return []
+        return list(node.subscribers)
+
+    def to_dict(self) -> Dict[str, List[str]]:
+        """以 过滤器 -> [client_ids] 的形式列出树中的所有订阅"""
+        result: Dict[str, List[str]] = {}
+        stack = [(self.root, None)]
+        while stack:
+            node, prefix = stack.pop()
+            if prefix is not None and node.subscribers:
+                result[prefix] = [str(subscriber) for subscriber in node.subscribers]
+            for level, child in node.children.items():
+                stack.append((child, level if prefix is None else f"{prefix}/{level}"))
+        return result
+
+def _collect(result: Dict[str, int], subscribers: Dict[str, int]):
+    """合并匹配到的订阅者，保留最大的QoS"""
+    if not result:
+        result.update(subscribers)
+        return
+    for client_id, qos in subscribers.items():
+        if result.get(client_id, -1) < qos:
+            result[client_id] = qos
+
+# 共享订阅组：订阅树中以组对象作为订阅者，匹配到时按策略从组内选出一个成员投递
+class SharedGroup:
+    def __init__(self, name: str, topic_filter: str):
+        self.name = name  # 完整的共享订阅过滤器，如 $share/workers/telemetry/#
+        self.topic_filter = topic_filter
+        self.members: Dict[str, int] = {}  # 客户端ID -> 授予的QoS
+        self.order: List[str] = []  # 轮询顺序
+        self.next_index = 0
+        self.sticky: Dict[str, str] = {}  # 发布者ID -> 固定的接收者
+
+    def __str__(self):
+        return self.name
+
+    def select(self, sender_id) -> Tuple[Optional[str], int]:
+        """按配置的策略选出接收者，返回 (客户端ID, 授予的QoS)
+
+        没有在线成员时选一个保留了会话的成员，由其离线队列保存消息。
+        """
+        member = SHARED_STRATEGIES[mqtt_config.shared_subscription_strategy](self, sender_id)
+        if member is None:
+            member = next((member for member in self.order if member in sessions), None)
+            if member is None:
+                return None, 0
+        return member, self.members[member]
+
+class SharedSubscriptions:
+    def __init__(self, trie: TopicTrie):
+        self.trie = trie
+        self.groups: Dict[str, SharedGroup] = {}  # 共享订阅过滤器 -> 组
+        self.client_groups: Dict[str, Set[str]] = {}  # 反向索引：客户端ID -> 加入的共享订阅过滤器
+
+    def subscribe(self, share_filter: str, client_id: str, qos: int):
+        """加入共享订阅组，组的第一个成员把组登记到订阅树中"""
+        group = self.groups.get(share_filter)
+        if group is None:
+            group = self.groups[share_filter] = SharedGroup(share_filter, share_filter.split('/', 2)[2])
+            self.trie.subscribe(group.topic_filter, group, 2)
+        if client_id not in group.members:
+            group.order.append(client_id)
+        group.members[client_id] = qos
+        self.client_groups.setdefault(client_id, set()).add(share_filter)
+
+    def unsubscribe(self, share_filter: str, client_id: str) -> bool:
+        """退出共享订阅组，组的最后一个成员退出时从订阅树中移除组"""
+        if not self._leave(share_filter, client_id):
+            return False
+        share_filters = self.client_groups[client_id]
+        share_filters.discard(share_filter)
+        if not share_filters:
+            del self.client_groups[client_id]
+        return True
+
+    def unsubscribe_all(self, client_id: str) -> int:
+        """退出客户端加入的所有共享订阅组"""
+        share_filters = self.client_groups.pop(client_id, ())
+        for share_filter in share_filters:
+            self._leave(share_filter, client_id)
+        return len(share_filters)
+
+    def filters(self, client_id: str) -> Set[str]:
+        return set(self.client_groups.get(client_id, ()))
+
+    def _leave(self, share_filter: str, client_id: str) -> bool:
+        group = self.groups.get(share_filter)
+        if group is None or group.members.pop(client_id, None) is None:
+            return False
+        group.order.remove(client_id)
+        for publisher, member in list(group.sticky.items()):
+            if member == client_id:
+                del group.sticky[publisher]
+        if not group.members:
+            self.trie.unsubscribe(group.topic_filter, group)
+            del self.groups[share_filter]
+        return True
+
+def select_round_robin(group: SharedGroup, sender_id) -> Optional[str]:
+    """从上次的位置开始轮询，跳过不在线的成员"""
+    order = group.order
+    for _ in range(len(order)):
+        member = order[group.next_index % len(order)]
+        group.next_index += 1
+        if member in clients or member in virtual_clients:
+            return member
+    return None
+
+def select_least_queue_depth(group: SharedGroup, sender_id) -> Optional[str]:
+    """选择发送队列（含等待窗口的消息）最短的在线成员"""
+    best = None
+    best_depth = 0
+    for member in group.order:
+        client = clients.get(member)
+        if client is not None:
+            depth = client.queue_depth + len(client.pending)
+        else:
+            client = virtual_clients.get(member)
+            if client is None:
+                continue
+            depth = client.queue_depth
+        if best is None or depth < best_depth:
+            best = member
+            best_depth = depth
+    return best
+
+def select_sticky(group: SharedGroup, sender_id) -> Optional[str]:
+    """同一发布者固定投递给同一成员，该成员离线时重新轮询选择"""
+    member = group.sticky.get(sender_id)
+    if member is not None and (member in clients or member in virtual_clients):
+        return member
+    member = select_round_robin(group, sender_id)
+    if member is not None:
+        group.sticky[sender_id] = member
+    return member
+
+# 共享订阅策略：策略名 -> select(group, sender_id)，返回在线成员的客户端ID或None
+SHARED_STRATEGIES = {
+    ROUND_ROBIN: select_round_robin,
+    LEAST_QUEUE_DEPTH: select_least_queue_depth,
+    STICKY_BY_PUBLISHER: select_sticky,
+}
+
+# 保留消息
+class RetainedMessage:
+    __slots__ = ("topic", "payload", "qos", "properties", "expires_at")
+
+    def __init__(self, topic: str, payload: bytes, qos: int, properties: Optional[Dict[int, object]] = None,
+                 expires_at: float = 0.0):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.properties = properties  # 发布时带的MQTT 5属性，下发给MQTT 5订阅者
+        self.expires_at = expires_at  # 过期时间（time.monotonic），0表示不过期
+
+class RetainedNode:
+    __slots__ = ("children", "message")
+
+    def __init__(self):
+        self.children: Dict[str, "RetainedNode"] = {}
+        self.message: Optional[RetainedMessage] = None
+
+# 按主题层级组织的保留消息存储，订阅时按过滤器逐层查找，不扫描全部保留消息
+class RetainedStore:
+    def __init__(self):
+        self.root = RetainedNode()
+        self.count = 0
+
+    def set(self, topic: str, payload: bytes, qos: int, properties: Optional[Dict[int, object]] = None,
+            expires_at: float = 0.0):
+        """保存保留消息，空消息表示清除该主题的保留消息"""
+        if not payload:
+            self.remove(topic)
+            return
+        node = self.root
+        for level in topic.split('/'):
+            child = node.children.get(level)
+            if child is None:
+                child = node.children[level] = RetainedNode()
+            node = child
+        if node.message is None:
+            self.count += 1
+        # 消息内容可能是接收缓冲区上的视图，拷贝一份，不让长期保存的消息占住整个缓冲区
+        node.message = RetainedMessage(topic, bytes(payload), qos, properties, expires_at)
+
+    def remove(self, topic: str):
+        """清除主题的保留消息，并清理不再使用的节点"""
+        path = [self.root]
+        levels = topic.split('/')
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+        if path[-1].message is None:
+            return
+        path[-1].message = None
+        self.count -= 1
+        for i in range(len(levels), 0, -1):
+            node = path[i]
+            if node.message is not None or node.children:
+                break
+            del path[i - 1].children[levels[i - 1]]
+
+    def match(self, topic_filter: str) -> List[RetainedMessage]:
+        """返回与订阅过滤器匹配的所有保留消息"""
+        result: List[RetainedMessage] = []
+        self._match(self.root, topic_filter.split('/'), 0, result)
+        return result
+
+    def _match(self, node: RetainedNode, levels: List[str], index: int, result: List[RetainedMessage]):
+        if index == len(levels):
+            if node.message is not None:
+                result.append(node.message)
+            return
+
+        level = levels[index]
+        if level == '#':
+            # "a/#" 同时匹配 "a"
+            if node.message is not None:
+                result.append(node.message)
+            self._collect_all(node, index == 0, result)
+        elif level == '+':
+            for name, child in node.children.items():
+                # 以$开头的主题不匹配首层的通配符
+                if index == 0 and name.startswith('$'):
+                    continue
+                self._match(child, levels, index + 1, result)
+        else:
+            child = node.children.get(level)
+            if child is not None:
+                self._match(child, levels, index + 1, result)
+
+    def _collect_all(self, node: RetainedNode, top_level: bool, result: List[RetainedMessage]):
+        stack = [child for name, child in node.children.items()
+                 if not (top_level and name.startswith('$'))]
+        while stack:
+            node = stack.pop()
+            if node.message is not None:
+                result.append(node.message)
+            stack.extend(node.children.values())
+
+    def topics(self) -> List[str]:
+        """列出所有有保留消息的主题"""
+        result = []
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if node.message is not None:
+                result.append(node.message.topic)
+            stack.extend(node.children.values())
+        return result
+
+# 哈希时间轮，到期时间按刻度散列到固定数量的槽位中
+class TimerWheel:
+    def __init__(self, tick: float = 1.0, size: int = 512):
+        self.tick = tick
+        self.slots: List[Dict[object, float]] = [{} for _ in range(size)]
+        self.current_tick: Optional[int] = None  # 最后处理过的刻度
+
+    def schedule(self, item, deadline: float):
+        """添加定时项，O(1)"""
+        # 放入到期时间之后的第一个刻度
+        index = math.ceil(deadline / self.tick)
+        if self.current_tick is not None and index <= self.current_tick:
+            index = self.current_tick + 1
+        self.slots[index % len(self.slots)][item] = deadline
+
+    def cancel(self, item, deadline: float):
+        """移除按deadline添加的定时项，O(1)；添加时已到期的项（放在下一个刻度）由advance清理"""
+        self.slots[math.ceil(deadline / self.tick) % len(self.slots)].pop(item, None)
+
+    def advance(self, now: float) -> List[object]:
+        """推进到当前时间，返回所有已到期的定时项
+
+        只访问经过的槽位；槽位中属于后面几圈的项保留不动。
+        """
+        now_tick = int(now // self.tick)
+        if self.current_tick is None:
+            self.current_tick = now_tick - 1
+        expired = []
+        size = len(self.slots)
+        # 一次最多转一整圈
+        start = max(self.current_tick + 1, now_tick - size + 1)
+        for tick in range(start, now_tick + 1):
+            slot = self.slots[tick % size]
+            if not slot:
+                continue
+            due = [item for item, deadline in slot.items() if deadline <= now]
+            for item in due:
+                del slot[item]
+            expired.extend(due)
+        self.current_tick = now_tick
+        return expired
+
+# 全局变量
+clients: Dict[str, Client] = {}
+topics = TopicTrie()  # 订阅过滤器 -> [client_ids]
+keepalive_wheel = TimerWheel()  # 保活超时检查
+retry_wheel = TimerWheel()  # 未确认消息的重发
+retained_messages = RetainedStore()  # 主题 -> 保留消息
+shared_subscriptions = SharedSubscriptions(topics)  # $share/组名/过滤器 -> 共享订阅组
+sessions: Dict[str, Client] = {}  # 已断开但保留会话（clean session=0）的客户端
+virtual_clients: Dict[str, VirtualClient] = {}  # 进程内的虚拟客户端
+idle_wheel = TimerWheel()  # 虚拟客户端的空闲断开
+metrics = BrokerMetrics()  # 运行指标，由 /metrics 输出
+server_loop: Optional[asyncio.AbstractEventLoop] = None  # MQTT服务器运行的事件循环，供其他线程（如Web服务）提交操作
+server_ready = threading.Event()  # server_loop已设置时为set
+SERVER_START_TIMEOUT = 10  # 提交操作时等待MQTT服务器启动的最长时间（秒）
+publish_hooks: List[object] = []  # 本地客户端发布的每条消息都会调用 hook(topic, message, qos, retain, properties)
+
+# MQTT 数据包类型
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+# MQTT 协议级别
+MQTT_V31 = 3
+MQTT_V311 = 4
+MQTT_V5 = 5
+PROTOCOL_LEVELS = (MQTT_V31, MQTT_V311, MQTT_V5)
+
+# 共享订阅过滤器的前缀
+SHARE_PREFIX = "$share/"
+
+# 已完成的QoS 2消息ID攒够这么多再批量清理
+COMPLETED_BATCH_SIZE = 16
+
+# 每次从套接字读取的最大字节数
+READ_CHUNK_SIZE = 65536
+
+# 写出时不小于此长度的数据块单独写入，不做拼接
+LARGE_CHUNK_SIZE = 16384
+
+# 解码器交出的流式转发数据包的内容片段（报文类型0保留不用）
+STREAM_DATA = 0
+
+# 流式转发时订阅者的写缓冲区超过此字节数就暂停读取发布者，并每隔STREAM_POLL_INTERVAL秒检查一次
+STREAM_WRITE_LIMIT = 4 * READ_CHUNK_SIZE
+STREAM_POLL_INTERVAL = 0.01
+
+# 流式转发的PUBLISH可变头（主题、消息ID、属性）的最大长度
+STREAM_HEAD_LIMIT = 2 * READ_CHUNK_SIZE
+
+# MQTT 连接返回码
+CONN_ACCEPTED = 0
+CONN_REFUSED_PROTOCOL = 1
+CONN_REFUSED_ID = 2
+CONN_REFUSED_SERVER = 3
+CONN_REFUSED_USER = 4
+CONN_REFUSED_AUTH = 5
+
+# MQTT 5 CONNACK中与连接返回码对应的原因码
+CONNACK_REASON_CODES = {
+    CONN_ACCEPTED: 0x00,
+    CONN_REFUSED_PROTOCOL: UNSUPPORTED_PROTOCOL_VERSION,
+    CONN_REFUSED_ID: CLIENT_IDENTIFIER_NOT_VALID,
+    CONN_REFUSED_SERVER: SERVER_UNAVAILABLE,
+    CONN_REFUSED_USER: BAD_USERNAME_OR_PASSWORD,
+    CONN_REFUSED_AUTH: NOT_AUTHORIZED,
+}
+
+class MQTTFrameDecoder:
+    """增量式MQTT帧解码器
+
+    每次喂入任意长度的字节流，返回其中所有完整的数据包，
+    不完整的部分留在缓冲区中等待下一次喂入。
+    数据包的剩余数据是接收数据上的memoryview，不做拷贝：
+    交出过视图的缓冲区不再修改，未解析完的数据拷贝到新的缓冲区中。
+    
+    max_packet_size不为0时，超过此长度的数据包在解析出固定头后即停止解码（too_large为其长度），
+    不缓冲其内容。stream_threshold不为0时，剩余长度不小于此值且尚未接收完整的非保留PUBLISH
+    不等待接收完整：先交出 (固定头首字节, None)，stream_length为其剩余长度，
+    已收到和之后收到的剩余数据以 (STREAM_DATA, 片段) 陆续交出。
+    """
+
+    def __init__(self, max_packet_size: int = 0, stream_threshold: int = 0):
+        self.buffer = bytearray()
+        self.max_packet_size = max_packet_size
+        self.stream_threshold = stream_threshold
+        self.too_large = 0
+        self.stream_length = 0
+        self.stream_remaining = 0  # 流式交出的数据包还未收到的字节数
+
+    def feed(self, data: bytes) -> List[Tuple[int, memoryview]]:
+        """喂入数据（bytes，调用方之后不能再修改），返回 (固定头首字节, 剩余数据) 的列表"""
+        frames = []
+        if self.stream_remaining:
+            # 正在流式交出的数据包的后续内容
+            take = min(len(data), self.stream_remaining)
+            self.stream_remaining -= take
+            view = memoryview(data)
+            frames.append((STREAM_DATA, view[:take]))
+            if take == len(data):
+                return frames
+            data = view[take:]
+        if self.too_large:
+            return frames
+        
+        if self.buffer:
+            buf = self.buffer
+            buf += data
+        else:
+            buf = data
+        size = len(buf)
+        pos = 0
+        view = None
+
+        while size - pos >= 2:
+            # 解码剩余长度（最多4个字节）
+            remaining_length = 0
+            multiplier = 1
+            index = pos + 1
+            complete = False
+            while index < size:
+                byte = buf[index]
+                index += 1
+                remaining_length += (byte & 127) * multiplier
+                if byte & 128 == 0:
+                    complete = True
+                    break
+                multiplier *= 128
+                if multiplier > 128 ** 3:
+                    raise ValueError("剩余长度字段无效")
+            if not complete:
+                # 剩余长度字段尚未接收完整
+                break
+
+            end = index + remaining_length
+            if self.max_packet_size and end - pos > self.max_packet_size:
+                # 超过最大报文长度：不再解码，丢弃缓冲的数据
+                self.too_large = end - pos
+                pos = size
+                break
+            if end > size:
+                first_byte = buf[pos]
+                if (self.stream_threshold and remaining_length >= self.stream_threshold
+                        and first_byte & 0xF1 == PUBLISH << 4):
+                    if view is None:
+                        view = memoryview(buf)
+                    frames.append((first_byte, None))
+                    frames.append((STREAM_DATA, view[index:size]))
+                    self.stream_length = remaining_length
+                    self.stream_remaining = end - size
+                    pos = size
+                break
+            if view is None:
+                view = memoryview(buf)
+            frames.append((buf[pos], view[index:end]))
+            pos = end
+
+        if pos == 0:
+            if buf is not self.buffer:
+                self.buffer = bytearray(buf)
+        elif pos < size:
+            self.buffer = bytearray(view[pos:])
+        else:
+            self.buffer = bytearray()
+        return frames
+
+class MQTTConnection:
+    """一个客户端连接的MQTT协议处理，与网络引擎无关
+
+    网络引擎把收到的数据交给data_received（解码后逐个交给handle_packet），连接断开时调用connection_lost。
+    writer需提供transport属性，client_class为该引擎使用的客户端记录类。
+    """
+
+    def __init__(self, writer, client_class=Client):
+        self.writer = writer
+        self.transport = writer.transport
+        self.client_class = client_class
+        self.client: Optional[Client] = None
+        self.client_id: Optional[str] = None
+        self.protocol_level = MQTT_V311
+        self.topic_aliases: Dict[int, str] = {}  # MQTT 5客户端发布时使用的主题别名 -> 主题
+        self.loop = asyncio.get_running_loop()
+        self.decoder = MQTTFrameDecoder(mqtt_config.max_packet_size, mqtt_config.stream_threshold)
+        self.stream: Optional[PublishStream] = None  # 正在流式接收的大PUBLISH
+
+    def data_received(self, data) -> bool:
+        """处理收到的数据，返回False表示应关闭连接"""
+        metrics.bytes_in += len(data)
+        decoder = self.decoder
+        for first_byte, payload in decoder.feed(data):
+            if first_byte == STREAM_DATA:
+                if self.client is not None:
+                    self.client.last_active = self.loop.time()
+                if not self.stream.feed(payload):
+                    return False
+            elif payload is None:
+                metrics.packets_in[PUBLISH] += 1
+                self.stream = PublishStream(self, first_byte, decoder.stream_length)
+            elif not self.handle_packet(first_byte, payload):
+                return False
+        if decoder.too_large:
+            # 超过max_packet_size的报文按协议错误断开，不等待接收其内容
+            log_event("error", "报文超过最大长度", client_id=self.client_id, size=decoder.too_large)
+            return self.disconnect(PACKET_TOO_LARGE)
+        return True
+
+    def disconnect(self, reason_code: int) -> bool:
+        """服务器主动断开连接：MQTT 5客户端先发送带原因码的DISCONNECT，返回False供handle_packet直接返回"""
+        if self.protocol_level == MQTT_V5:
+            self.transport.write(encode_disconnect(reason_code))
+        return False
+
+    def handle_packet(self, first_byte: int, payload) -> bool:
+        """处理一个数据包，返回False表示应关闭连接
+
+        payload可以是memoryview：PUBLISH的消息内容以视图的形式转发，其他报文先转换为bytes。
+        """
+        packet_type = (first_byte >> 4) & 0x0F
+        metrics.packets_in[packet_type] += 1
+        client = self.client
+        client_id = self.client_id
+        if client is not None:
+            client.last_active = self.loop.time()
+        
+        if packet_type != PUBLISH:
+            payload = bytes(payload)
+        
+        # 处理不同类型的MQTT数据包
+        if packet_type == CONNECT:
+            protocol_name_len = (payload[0] << 8) | payload[1]
+            protocol_name = payload[2:2+protocol_name_len].decode('utf-8')
+            offset = 2 + protocol_name_len
+            protocol_level = payload[offset]
+            offset += 1
+            connect_flags = payload[offset]
+            offset += 1
+            clean_start = bool(connect_flags & 0x02)
+            
+            # 解析保持连接时间
+            keepalive = (payload[offset] << 8) | payload[offset+1]
+            offset += 2
+            
+            # MQTT 5的连接属性
+            properties = {}
+            if protocol_level == MQTT_V5:
+                self.protocol_level = MQTT_V5
+                properties, offset = decode_properties(payload, offset)
+            
+            # 解析客户端ID
+            client_id_len = (payload[offset] << 8) | payload[offset+1]
+            offset += 2
+            client_id = self.client_id = payload[offset:offset+client_id_len].decode('utf-8')
+            offset += client_id_len
+            
+            # 不支持遗嘱消息，跳过遗嘱属性、遗嘱主题和遗嘱内容
+            if connect_flags & 0x04:
+                if protocol_level == MQTT_V5:
+                    _, offset = decode_properties(payload, offset)
+                for _ in range(2):
+                    offset += 2 + ((payload[offset] << 8) | payload[offset+1])
+            
+            # 处理用户名和密码认证
+            username = None
+            password = None
+            
+            if connect_flags & 0x80:  # 用户名标志
+                username_len = (payload[offset] << 8) | payload[offset+1]
+                offset += 2
+                username = payload[offset:offset+username_len].decode('utf-8')
+                offset += username_len
+            
+            if connect_flags & 0x40:  # 密码标志
+                password_len = (payload[offset] << 8) | payload[offset+1]
+                offset += 2
+                password = payload[offset:offset+password_len].decode('utf-8')
+            
+            # 检查协议级别和认证
+            conn_return_code = CONN_ACCEPTED
+            
+            if protocol_level not in PROTOCOL_LEVELS:
+                conn_return_code = CONN_REFUSED_PROTOCOL
+            
+            if not mqtt_config.allow_anonymous and username is None:
+                conn_return_code = CONN_REFUSED_AUTH
+            
+            if username is not None and username in mqtt_config.users:
+                if mqtt_config.users[username] != password:
+                    conn_return_code = CONN_REFUSED_AUTH
+            
+            # ID已被虚拟客户端使用
+            if client_id in virtual_clients:
+                conn_return_code = CONN_REFUSED_ID
+            
+            if len(clients) >= mqtt_config.max_connections:
+                conn_return_code = CONN_REFUSED_SERVER
+            
+            # MQTT 3.1.1的clean session同时决定是否沿用旧会话和断开后是否保留会话；
+            # MQTT 5由clean start决定是否沿用，由会话过期间隔决定断开后是否保留
+            if protocol_level == MQTT_V5:
+                clean_session = properties.get(SESSION_EXPIRY_INTERVAL, 0) == 0
+            else:
+                clean_session = clean_start
+            
+            # clean start=0且同ID、同协议级别的会话仍在（在线或离线）时，沿用该会话
+            previous = clients.get(client_id) or sessions.get(client_id)
+            session_present = (conn_return_code == CONN_ACCEPTED and not clean_start and previous is not None
+                               and previous.protocol_level == protocol_level)
+            
+            # 保活超时为保持连接时间的1.5倍；MQTT 5可以用服务端保持连接时间通知客户端，
+            # 保持连接时间不超过max_keepalive，3.1.1没有这种通知，沿用客户端自己的值
+            effective_keepalive = keepalive
+            if (self.protocol_level == MQTT_V5 and mqtt_config.max_keepalive > 0
+                    and (keepalive == 0 or keepalive > mqtt_config.max_keepalive)):
+                effective_keepalive = mqtt_config.max_keepalive
+            
+            # 发送CONNACK数据包
+            if self.protocol_level == MQTT_V5:
+                connack_properties = {}
+                if conn_return_code == CONN_ACCEPTED:
+                    connack_properties[RECEIVE_MAXIMUM] = min(mqtt_config.max_inflight_messages, 65535)
+                    connack_properties[TOPIC_ALIAS_MAXIMUM] = mqtt_config.topic_alias_maximum
+                    connack_properties[SUBSCRIPTION_IDENTIFIER_AVAILABLE] = 0
+                    if mqtt_config.max_packet_size:
+                        connack_properties[MAXIMUM_PACKET_SIZE] = mqtt_config.max_packet_size
+                    if effective_keepalive != keepalive:
+                        connack_properties[SERVER_KEEP_ALIVE] = effective_keepalive
+                connack = encode_packet(CONNACK << 4, bytes([
+                    1 if session_present else 0,  # 连接确认标志（会话是否存在）
+                    CONNACK_REASON_CODES[conn_return_code]  # 原因码
+                ]) + encode_properties(connack_properties))
+            else:
+                connack = bytearray([
+                    CONNACK << 4, 2,  # 固定头，剩余长度为2
+                    1 if session_present else 0,  # 连接确认标志（会话是否存在）
+                    conn_return_code  # 连接返回码
+                ])
+            self.transport.write(connack)
+            metrics.packets_out[CONNACK] += 1
+            metrics.bytes_out += len(connack)
+            
+            if conn_return_code == CONN_ACCEPTED:
+                metrics.connects += 1
+                # 创建新的客户端记录，先登记再关闭旧连接，使旧连接的清理不会波及新连接
+                old_client = clients.get(client_id)
+                if old_client is None:
+                    old_client = sessions.pop(client_id, None)
+                client = self.client = self.client_class(client_id, self.writer)
+                client.username = username
+                client.clean_session = clean_session
+                client.protocol_level = protocol_level
+                client.receive_maximum = properties.get(RECEIVE_MAXIMUM, 65535)
+                client.maximum_packet_size = properties.get(MAXIMUM_PACKET_SIZE, 0)
+                clients[client_id] = client
+                if session_present:
+                    client.resume_session(old_client)
+                client.start()
+                
+                # 如果客户端已存在，清理旧连接
+                if old_client is not None:
+                    if old_client.connected and old_client.protocol_level == MQTT_V5:
+                        old_client.transport.write(encode_disconnect(SESSION_TAKEN_OVER))
+                    old_client.stop()
+                    old_client.transport.close()
+                    # 不沿用会话时，丢弃旧会话的订阅和离线消息
+                    if not session_present:
+                        old_client.discard_session()
+                
+                if effective_keepalive > 0:
+                    client.keepalive_timeout = effective_keepalive * 1.5
+                    client.last_active = self.loop.time()
+                    keepalive_wheel.schedule(client, client.last_active + client.keepalive_timeout)
+                log_event("connect", "客户端已连接", client_id=client_id, clean_session=clean_session,
+                          keepalive=keepalive, protocol_level=protocol_level)
+            else:
+                # 连接被拒绝，关闭连接
+                metrics.rejects += 1
+                return False
+        
+        elif packet_type == PUBLISH:
+            if client is None:
+                return True
+            
+            # QoS位在第一个字节的1、2位，保留标志在第0位
+            qos = (first_byte >> 1) & 0x03
+            retain = bool(first_byte & 0x01)
+            
+            # 解析主题
+            topic_len = (payload[0] << 8) | payload[1]
+            topic = str(payload[2:2+topic_len], 'utf-8')
+            offset = 2 + topic_len
+            
+            # 对于QoS>0，提取消息ID
+            message_id = None
+            if qos > 0:
+                message_id = (payload[offset] << 8) | payload[offset+1]
+                offset += 2
+            
+            # MQTT 5的发布属性，没有属性时只有一个0字节
+            properties = None
+            if self.protocol_level == MQTT_V5:
+                if payload[offset] == 0:
+                    offset += 1
+                else:
+                    properties, offset = decode_properties(payload, offset)
+                topic = self.resolve_topic(topic, properties)
+                if topic is None:
+                    return False
+            # 发布主题不能含通配符，否则按协议错误断开
+            if not valid_topic_name(topic):
+                return self.disconnect(TOPIC_NAME_INVALID)
+            
+            # 提取消息内容（接收缓冲区上的视图）
+            message = payload[offset:]
+            
+            if mqtt_logging.enabled("publish"):
+                log_event("publish", "收到发布消息", client_id=client_id, topic=topic, qos=qos,
+                          payload=mqtt_logging.preview(message))
+            
+            if qos == 2:
+                # QoS 2：同一消息ID在收到PUBREL之前只转发一次，重复的PUBLISH只回复PUBREC
+                reason_code = 0
+                if message_id not in client.inbound_qos2:
+                    if not self.accept_qos2():
+                        return self.disconnect(RECEIVE_MAXIMUM_EXCEEDED)
+                    client.inbound_qos2.add(message_id)
+                    if not route_message(client_id, topic, message, qos, retain, properties=properties):
+                        reason_code = NO_MATCHING_SUBSCRIBERS
+                client.send(encode_ack(PUBREC, message_id, reason_code if self.protocol_level == MQTT_V5 else 0))
+                return True
+            
+            # 将消息转发给所有订阅此主题的客户端
+            delivered = route_message(client_id, topic, message, qos, retain, properties=properties)
+            
+            # 对于QoS 1，发送PUBACK（MQTT 5在没有订阅者时带原因码0x10）
+            if qos == 1 and message_id is not None:
+                reason_code = NO_MATCHING_SUBSCRIBERS if not delivered and self.protocol_level == MQTT_V5 else 0
+                client.send(encode_ack(PUBACK, message_id, reason_code))
+        
+        elif packet_type in (PUBACK, PUBREC, PUBREL, PUBCOMP):
+            if client is None:
+                return True
+            
+            message_id = (payload[0] << 8) | payload[1]
+            if packet_type == PUBACK:
+                # 订阅者确认了QoS 1消息，释放消息ID
+                client.acknowledge(message_id)
+            elif packet_type == PUBREC:
+                # 订阅者收到了QoS 2消息，回复PUBREL（MQTT 5可在消息ID之后带原因码）
+                client.received(message_id, payload[2] if len(payload) > 2 else 0)
+            elif packet_type == PUBREL:
+                # 发布者释放了QoS 2消息，回复PUBCOMP
+                client.inbound_qos2.discard(message_id)
+                client.send(encode_ack(PUBCOMP, message_id))
+            else:
+                # 订阅者完成了QoS 2握手
+                client.complete(message_id)
+        
+        elif packet_type == SUBSCRIBE:
+            if client is None:
+                return True
+            
+            offset = 0
+            message_id = (payload[offset] << 8) | payload[offset+1]
+            offset += 2
+            v5 = self.protocol_level == MQTT_V5
+            if v5:
+                # 不支持订阅标识符，其余订阅属性也无需处理
+                _, offset = decode_properties(payload, offset)
+            
+            # 解析订阅的主题
+            granted_qos = []
+            accepted = []
+            while offset < len(payload):
+                topic_len = (payload[offset] << 8) | payload[offset+1]
+                offset += 2
+                topic = payload[offset:offset+topic_len].decode('utf-8')
+                offset += topic_len
+                # 订阅选项：0、1位为QoS；MQTT 5的4、5位为保留消息处理方式
+                options = payload[offset]
+                offset += 1
+                requested_qos = options & 0x03 if v5 else options
+                retain_handling = (options >> 4) & 0x03 if v5 else 0
+                
+                # 非法的订阅过滤器返回失败码0x80（MQTT 5为0x8F）
+                shared = topic.startswith(SHARE_PREFIX)
+                if not (valid_shared_filter(topic) if shared else valid_topic_filter(topic)):
+                    granted_qos.append(TOPIC_FILTER_INVALID if v5 else 0x80)
+                    continue
+                
+                # QoS级别最高为2
+                qos = min(requested_qos, 2)
+                granted_qos.append(qos)
+                
+                if shared:
+                    # 加入共享订阅组，共享订阅不发送保留消息
+                    shared_subscriptions.subscribe(topic, client_id, qos)
+                else:
+                    # 保留消息处理方式：0 总是发送，1 只在新建订阅时发送，2 不发送
+                    existed = topic in topics.client_filters.get(client_id, ())
+                    # 添加到订阅树（同时记入此客户端的反向索引）
+                    topics.subscribe(topic, client_id, qos)
+                    if retain_handling == 0 or (retain_handling == 1 and not existed):
+                        accepted.append((topic, qos))
+                
+                log_event("subscribe", "订阅主题", client_id=client_id, topic=topic, qos=qos)
+            
+            # 发送SUBACK数据包
+            header = message_id.to_bytes(2, 'big')
+            if v5:
+                header += b"\x00"  # 属性长度
+            client.send(encode_packet(SUBACK << 4, header + bytes(granted_qos)))
+            
+            # 发送与新订阅匹配的保留消息
+            for topic, qos in accepted:
+                send_retained(client, topic, qos)
+        
+        elif packet_type == UNSUBSCRIBE:
+            if client is None:
+                return True
+            
+            offset = 0
+            message_id = (payload[offset] << 8) | payload[offset+1]
+            offset += 2
+            v5 = self.protocol_level == MQTT_V5
+            if v5:
+                _, offset = decode_properties(payload, offset)
+            
+            # 解析要取消订阅的主题，MQTT 5的UNSUBACK对每个主题给出原因码
+            reason_codes = []
+            while offset < len(payload):
+                topic_len = (payload[offset] << 8) | payload[offset+1]
+                offset += 2
+                topic = payload[offset:offset+topic_len].decode('utf-8')
+                offset += topic_len
+                
+                # 从订阅树和此客户端的反向索引中移除
+                if topic.startswith(SHARE_PREFIX):
+                    removed = shared_subscriptions.unsubscribe(topic, client_id)
+                else:
+                    removed = topics.unsubscribe(topic, client_id)
+                if removed:
+                    log_event("unsubscribe", "取消订阅主题", client_id=client_id, topic=topic)
+                reason_codes.append(0x00 if removed else NO_SUBSCRIPTION_EXISTED)
+            
+            # 发送UNSUBACK
+            if v5:
+                unsuback = encode_packet(UNSUBACK << 4, message_id.to_bytes(2, 'big') + b"\x00" + bytes(reason_codes))
+            else:
+                unsuback = bytearray([
+                    UNSUBACK << 4, 2,  # 固定头
+                    (message_id >> 8) & 0xFF,  # 消息ID高位
+                    message_id & 0xFF  # 消息ID低位
+                ])
+            client.send(unsuback)
+        
+        elif packet_type == PINGREQ:
+            if client is None:
+                return True
+            
+            # 回复PINGRESP
+            pingresp = bytearray([PINGRESP << 4, 0])  # 固定头，剩余长度为0
+            client.send(pingresp)
+        
+        elif packet_type == DISCONNECT:
+            # MQTT 5客户端可在DISCONNECT中把会话过期间隔改为0，断开后丢弃会话
+            if client is not None and self.protocol_level == MQTT_V5 and len(payload) > 1:
+                properties, _ = decode_properties(payload, 1)
+                if properties.get(SESSION_EXPIRY_INTERVAL) == 0:
+                    client.clean_session = True
+            return False
+        
+        return True
+
+    def resolve_topic(self, topic: str, properties: Optional[Dict[int, object]]) -> Optional[str]:
+        """返回MQTT 5 PUBLISH的实际主题：带主题别名时建立（或更新）映射，主题为空时按别名取出主题
+
+        别名或主题无效时发送DISCONNECT并返回None。
+        """
+        alias = properties.pop(TOPIC_ALIAS, None) if properties else None
+        if alias is not None:
+            if not 0 < alias <= mqtt_config.topic_alias_maximum:
+                self.disconnect(TOPIC_ALIAS_INVALID)
+                return None
+            if topic:
+                self.topic_aliases[alias] = topic
+            else:
+                topic = self.topic_aliases.get(alias)
+        if not topic:
+            self.disconnect(PROTOCOL_ERROR)
+            return None
+        return topic
+
+    def accept_qos2(self) -> bool:
+        """能否再接收一条新的QoS 2消息：MQTT 5客户端未完成的QoS 2消息不能超过CONNACK中的接收最大值"""
+        return (self.protocol_level != MQTT_V5
+                or len(self.client.inbound_qos2) < mqtt_config.max_inflight_messages)
+
+    def connection_lost(self):
+        """连接断开后的清理"""
+        if self.stream is not None:
+            self.stream.abort()
+            self.stream = None
+        client = self.client
+        client_id = self.client_id
+        # 只清理属于本连接的客户端记录（同ID的新连接可能已接管）
+        if client is not None and clients.get(client_id) is client:
+            del clients[client_id]
+            client.stop()
+            
+            if client.clean_session:
+                # 从此客户端订阅过的主题中移除此客户端
+                client.discard_session()
+                log_event("disconnect", "客户端已断开连接", client_id=client_id)
+            else:
+                # 保留会话：订阅继续有效，QoS>0消息存入离线队列
+                sessions[client_id] = client
+                log_event("disconnect", "客户端已断开连接，会话已保留", client_id=client_id)
+
+class PublishStream:
+    """一条边接收边转发的大PUBLISH消息
+
+    先攒齐可变头（主题、消息ID、MQTT 5属性），再选出在线的订阅者，写出它们队列中积压的报文和本消息的头部，
+    之后收到的消息内容片段直接写入订阅者的transport，不缓冲整条消息。转发期间这些订阅者的其他报文暂不写出；
+    订阅者的写缓冲区超过STREAM_WRITE_LIMIT时暂停读取发布者的连接，直到缓冲区排空。
+    不保留消息内容就无法重发，所以消息按QoS 0投递，也不存入离线会话；正在接收另一条流式消息的订阅者收不到本消息。
+    """
+
+    def __init__(self, connection: MQTTConnection, first_byte: int, length: int):
+        self.connection = connection
+        self.qos = (first_byte >> 1) & 0x03
+        self.length = length
+        self.remaining = length  # 还未收到的剩余数据字节数
+        self.head: Optional[bytearray] = bytearray()  # 尚未解析的可变头，开始转发后为None
+        self.message_id = None
+        self.duplicate = False
+        self.targets: List[Client] = []
+        self.paused = False
+
+    def feed(self, data) -> bool:
+        """收到一段剩余数据，返回False表示应关闭连接"""
+        self.remaining -= len(data)
+        if self.head is not None:
+            self.head += data
+            offset = self._head_length()
+            if not offset:
+                if self.remaining == 0 or len(self.head) > STREAM_HEAD_LIMIT:
+                    return self.connection.disconnect(MALFORMED_PACKET)
+                return True
+            if not self._start(offset):
+                return False
+            data = memoryview(self.head)[offset:]
+            self.head = None
+        if data:
+            self._write(data)
+        if self.remaining == 0:
+            self._finish()
+        return True
+
+    def _head_length(self) -> int:
+        """可变头的长度，尚未接收完整时为0"""
+        head = self.head
+        if len(head) < 2:
+            return 0
+        offset = 2 + ((head[0] << 8) | head[1])
+        if self.qos:
+            offset += 2
+        if self.connection.protocol_level == MQTT_V5:
+            if len(head) <= offset:
+                return 0
+            try:
+                length, offset = decode_varint(head, offset)
+            except IndexError:
+                return 0
+            offset += length
+        return offset if len(head) >= offset else 0
+
+    def _start(self, offset: int) -> bool:
+        """解析可变头，选出订阅者并写出各自的报文头，返回False表示应关闭连接"""
+        connection = self.connection
+        client = connection.client
+        head = self.head
+        topic_len = (head[0] << 8) | head[1]
+        topic = str(head[2:2+topic_len], 'utf-8')
+        pos = 2 + topic_len
+        if self.qos:
+            self.message_id = (head[pos] << 8) | head[pos+1]
+            pos += 2
+        properties = None
+        if connection.protocol_level == MQTT_V5:
+            properties = decode_properties(head, pos)[0]
+            topic = connection.resolve_topic(topic, properties)
+            if topic is None:
+                return False
+        if not valid_topic_name(topic):
+            return connection.disconnect(TOPIC_NAME_INVALID)
+        if client is None:
+            return True
+        
+        log_event("publish", "收到发布消息（流式转发）", client_id=client.client_id, topic=topic, qos=self.qos,
+                  size=self.length - offset)
+        if self.qos == 2:
+            # 重复的QoS 2消息不再转发，只回复PUBREC
+            if self.message_id in client.inbound_qos2:
+                self.duplicate = True
+                return True
+            if not connection.accept_qos2():
+                return connection.disconnect(RECEIVE_MAXIMUM_EXCEEDED)
+        
+        metrics.published_messages += 1
+        self._route(client.client_id, topic, properties, self.length - offset)
+        return True
+
+    def _route(self, sender_id: str, topic: str, properties: Optional[Dict[int, object]], body_length: int):
+        """选出在线的订阅者，写出它们队列中积压的报文和本消息的头部（QoS 0，不带保留标志）"""
+        expiry = properties.get(MESSAGE_EXPIRY_INTERVAL) if properties else None
+        topic_bytes = topic.encode('utf-8')
+        headers = {}  # 协议级别 -> 报文头（MQTT 5包括属性）
+        for client_id, subscription_qos in topics.match(topic).items():
+            if client_id.__class__ is SharedGroup:
+                client_id = client_id.select(sender_id)[0]
+                if client_id is None:
+                    continue
+            elif client_id == sender_id:
+                continue
+            client = clients.get(client_id)
+            if client is None or not client.connected:
+                continue
+            if client.stream is not None:
+                client.dropped_messages += 1
+                metrics.dropped_messages += 1
+                continue
+            
+            header = headers.get(client.protocol_level)
+            if header is None:
+                if client.protocol_level == MQTT_V5:
+                    properties5 = encode_publish_properties(properties, expiry)
+                    header = build_publish_header(topic_bytes, 0, len(properties5) + body_length) + properties5
+                else:
+                    header = build_publish_header(topic_bytes, 0, body_length)
+                headers[client.protocol_level] = header
+            if client.maximum_packet_size and len(header) + body_length > client.maximum_packet_size:
+                client.dropped_messages += 1
+                metrics.dropped_messages += 1
+                continue
+            
+            # 先写出队列中积压的报文，保证顺序
+            chunks = client._take_chunks()
+            chunks.append(header)
+            write_chunks(client.transport, chunks)
+            metrics.packets_out[PUBLISH] += 1
+            metrics.bytes_out += len(header)
+            client.stream = self
+            self.targets.append(client)
+        metrics.fanout.observe(len(self.targets))
+
+    def _write(self, data):
+        """把一段消息内容写给仍在接收本消息的订阅者"""
+        written = 0
+        for client in self.targets:
+            if client.stream is self and client.connected:
+                client.transport.write(data)
+                written += 1
+        metrics.bytes_out += len(data) * written
+        if not self.paused:
+            self._check_backpressure()
+
+    def _check_backpressure(self):
+        """订阅者的写缓冲区超过STREAM_WRITE_LIMIT时暂停读取发布者，之后定时检查，排空后恢复读取"""
+        transport = self.connection.transport
+        if transport.is_closing():
+            return
+        if any(client.stream is self and client.connected
+               and client.transport.get_write_buffer_size() > STREAM_WRITE_LIMIT for client in self.targets):
+            if not self.paused:
+                self.paused = True
+                transport.pause_reading()
+            asyncio.get_running_loop().call_later(STREAM_POLL_INTERVAL, self._check_backpressure)
+        elif self.paused:
+            self.paused = False
+            transport.resume_reading()
+
+    def _release(self) -> List[Client]:
+        """结束转发，返回仍在接收本消息的订阅者"""
+        receivers = [client for client in self.targets if client.stream is self]
+        for client in receivers:
+            client.stream = None
+        return receivers
+
+    def _finish(self):
+        """消息接收完整：让订阅者写出暂停期间积压的报文，并确认发布者"""
+        for client in self._release():
+            if client.connected:
+                client._data_ready()
+        connection = self.connection
+        connection.stream = None
+        client = connection.client
+        if client is None:
+            return
+        if self.qos == 1:
+            reason_code = NO_MATCHING_SUBSCRIBERS if not self.targets and connection.protocol_level == MQTT_V5 else 0
+            client.send(encode_ack(PUBACK, self.message_id, reason_code))
+        elif self.qos == 2:
+            client.inbound_qos2.add(self.message_id)
+            client.send(encode_ack(PUBREC, self.message_id))
+
+    def abort(self):
+        """发布者在消息接收完整之前断开：订阅者已收到不完整的报文，只能断开它们"""
+        for client in self._release():
+            client.close()
+
+async def handle_client(reader, writer):
+    """流引擎：处理MQTT客户端连接"""
+    connection = MQTTConnection(writer)
+    try:
+        while True:
+            data = await reader.read(READ_CHUNK_SIZE)
+            if not data or not connection.data_received(data):
+                break
+    except (asyncio.IncompleteReadError, ConnectionError):
+        # 连接断开
+        pass
+    except Exception as e:
+        log_event("error", "处理客户端错误", client_id=connection.client_id, error=repr(e))
+    finally:
+        # 清理
+        connection.connection_lost()
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+class MQTTProtocol(asyncio.Protocol):
+    """Protocol引擎：收到的数据直接喂给帧解码器，不经过StreamReader和读任务"""
+
+    def __init__(self):
+        self.transport = None
+        self.connection: Optional[MQTTConnection] = None
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connection = MQTTConnection(self, ProtocolClient)
+
+    def data_received(self, data):
+        try:
+            if not self.connection.data_received(data):
+                self.transport.close()
+        except Exception as e:
+            log_event("error", "处理客户端错误", client_id=self.connection.client_id, error=repr(e))
+            self.transport.abort()
+
+    def connection_lost(self, exc):
+        self.connection.connection_lost()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        client = self.connection.client
+        if client is not None:
+            client.flush()
+
+class ServerNotRunning(RuntimeError):
+    """MQTT服务器未在运行，无法提交操作"""
+
+async def call_in_server_loop(func, *args):
+    """在MQTT服务器的事件循环中执行func(*args)并返回其结果，供运行在其他事件循环（如Web服务）中的代码修改服务器状态
+
+    调用方与服务器在同一个事件循环中时直接调用；否则通过call_soon_threadsafe提交，
+    结果或异常经future返回给调用方的事件循环。服务器尚未启动时最多等待SERVER_START_TIMEOUT秒，
+    仍未启动则抛出ServerNotRunning，不在调用方的线程中修改服务器状态。
+    """
+    loop = server_loop
+    if loop is None:
+        started = await asyncio.get_running_loop().run_in_executor(None, server_ready.wait, SERVER_START_TIMEOUT)
+        loop = server_loop
+        if not started or loop is None:
+            raise ServerNotRunning("MQTT服务器未启动")
+    if loop is asyncio.get_running_loop():
+        return func(*args)
+    future = concurrent.futures.Future()
+    
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+    
+    loop.call_soon_threadsafe(run)
+    return await asyncio.wrap_future(future)
+
+async def publish_message(sender_id, topic, message, qos=0, retain=False, propagate=True, properties=None) -> int:
+    """将消息发布到指定主题的所有订阅者（供API和其他工作进程调用的协程版本），返回投递到的订阅者数"""
+    return await call_in_server_loop(route_message, sender_id, topic, message, qos, retain, propagate, properties)
+
+def route_message(sender_id, topic, message, qos=0, retain=False, propagate=True, properties=None,
+                  matching_clients=None) -> int:
+    """将消息发布到指定主题的所有订阅者，返回投递到的订阅者数
+
+    propagate为False表示消息来自其他工作进程，不再调用publish_hooks转发。
+    properties为MQTT 5发布者带的属性，其中的消息过期间隔对所有订阅者生效，
+    其余需转发的属性只编码给MQTT 5订阅者。
+    matching_clients为调用方已在订阅树中查到的匹配结果（topics.match(topic)），省略时在此查找。
+    """
+    published_at = time.monotonic()
+    expiry = properties.get(MESSAGE_EXPIRY_INTERVAL) if properties else None
+    expires_at = published_at + expiry if expiry else 0.0
+    
+    # 保存或清除保留消息；转发给现有订阅者时不带保留标志
+    if retain:
+        retained_messages.set(topic, message, qos, properties, expires_at)
+    
+    if propagate:
+        for hook in publish_hooks:
+            hook(topic, message, qos, retain, properties)
+    
+    metrics.published_messages += 1
+    
+    # 在订阅树中查找与主题匹配的所有订阅者
+    if matching_clients is None:
+        matching_clients = topics.match(topic)
+    if not matching_clients:
+        metrics.fanout.observe(0)
+        return 0
+    
+    # 每条消息按协议级别和投递QoS只编码一次头部，所有订阅者共享同一份数据，消息内容不做拷贝：
+    # QoS 0缓存 [头部, 消息内容]，QoS>0缓存消息ID之前的头部
+    topic_bytes = topic.encode('utf-8')
+    headers = {}
+    headers5 = {}
+    message5 = None  # MQTT 5订阅者的 属性 + 消息内容
+    delivered = 0
+    
+    # 将消息放入所有匹配客户端的发送队列，由各自的发送任务写出
+    for client_id, subscription_qos in matching_clients.items():
+        if client_id.__class__ is SharedGroup:
+            # 共享订阅：按策略从组内选出一个成员
+            client_id, subscription_qos = client_id.select(sender_id)
+            if client_id is None:
+                continue
+        elif client_id == sender_id:  # 不要发送给发布者自己
+            continue
+        
+        # 投递QoS取发布QoS与订阅QoS中较小的一个
+        delivery_qos = min(qos, subscription_qos)
+        
+        client = clients.get(client_id)
+        online = client is not None and client.connected
+        if not online:
+            virtual = virtual_clients.get(client_id)
+            if virtual is not None:
+                virtual.deliver(topic, message, delivery_qos)
+                delivered += 1
+                continue
+            # 离线的持久会话只保存QoS>0的消息
+            client = sessions.get(client_id)
+            if client is None or delivery_qos == 0:
+                continue
+        
+        if client.protocol_level == MQTT_V5:
+            if message5 is None:
+                message5 = encode_publish_properties(properties, expiry) + message
+            body = message5
+            cache = headers5
+        else:
+            body = message
+            cache = headers
+        encoded = cache.get(delivery_qos)
+        if encoded is None:
+            encoded = build_publish_header(topic_bytes, delivery_qos, len(body))
+            if delivery_qos == 0:
+                encoded = [encoded, body]
+            cache[delivery_qos] = encoded
+        
+        # 超过客户端声明的最大报文长度的消息不发送给它
+        limit = client.maximum_packet_size
+        if limit and (len(encoded[0]) if delivery_qos == 0 else len(encoded) + 2) + len(body) > limit:
+            client.dropped_messages += 1
+            metrics.dropped_messages += 1
+            continue
+        
+        delivered += 1
+        
+        if not online:
+            client.store_offline(encoded, body, delivery_qos, expires_at)
+        elif delivery_qos == 0:
+            client.enqueue(encoded, published_at=published_at)
+        else:
+            # 头部共享，消息ID由客户端分配
+            client.publish(encoded, body, delivery_qos, published_at, expires_at)
+    
+    metrics.fanout.observe(delivered)
+    return delivered
+
+def route_batch(sender_id, messages) -> List[int]:
+    """按顺序路由一批 (主题, 消息内容, QoS, 保留标志)，返回每条消息投递到的订阅者数
+
+    整批在一次调用中完成，期间订阅不会变化，同一主题只在订阅树中匹配一次。
+    """
+    matches: Dict[str, Dict[object, int]] = {}
+    delivered = []
+    for topic, message, qos, retain in messages:
+        matching_clients = matches.get(topic)
+        if matching_clients is None:
+            matching_clients = matches[topic] = topics.match(topic)
+        delivered.append(route_message(sender_id, topic, message, qos, retain, matching_clients=matching_clients))
+    return delivered
+
+def send_retained(client, topic_filter, granted_qos):
+    """向新订阅的客户端发送与过滤器匹配的保留消息"""
+    now = time.monotonic()
+    for retained in retained_messages.match(topic_filter):
+        expiry = None
+        if retained.expires_at:
+            if retained.expires_at <= now:
+                # 已过期的保留消息不再发送，并从存储中清除
+                retained_messages.remove(retained.topic)
+                metrics.expired_messages += 1
+                continue
+            expiry = math.ceil(retained.expires_at - now)
+        qos = min(retained.qos, granted_qos)
+        payload = retained.payload
+        if client.protocol_level == MQTT_V5:
+            payload = encode_publish_properties(retained.properties, expiry) + payload
+        header = build_publish_header(retained.topic.encode('utf-8'), qos, len(payload), retain=True)
+        if client.maximum_packet_size and len(header) + 2 + len(payload) > client.maximum_packet_size:
+            continue
+        if qos == 0:
+            client.enqueue([header, payload])
+        else:
+            client.publish(header, payload, qos)
+
+def connect_virtual_client(client_id: str, loop: asyncio.AbstractEventLoop) -> Optional[VirtualClient]:
+    """创建虚拟客户端，取代同ID的虚拟客户端（保留其订阅），loop为读取方的事件循环
+
+    ID已被MQTT客户端或其会话使用时返回None，两者的订阅记录在同一个主题树中，ID不能重复。
+    """
+    if client_id in clients or client_id in sessions:
+        return None
+    old = virtual_clients.get(client_id)
+    if old is not None:
+        old.close()
+    virtual = virtual_clients[client_id] = VirtualClient(client_id, loop)
+    if mqtt_config.virtual_client_ttl:
+        idle_wheel.schedule(virtual, virtual.last_active + mqtt_config.virtual_client_ttl)
+    return virtual
+
+def disconnect_virtual_client(client_id: str) -> bool:
+    """断开虚拟客户端并移除它的所有订阅，没有该虚拟客户端时返回False（不影响同ID的MQTT客户端）"""
+    virtual = virtual_clients.pop(client_id, None)
+    if virtual is None:
+        return False
+    virtual.close()
+    topics.unsubscribe_all(client_id)
+    shared_subscriptions.unsubscribe_all(client_id)
+    return True
+
+def subscribe_virtual_client(virtual: VirtualClient, topic_filter: str, qos: int):
+    """为虚拟客户端订阅过滤器，并放入匹配的保留消息"""
+    if topic_filter.startswith(SHARE_PREFIX):
+        shared_subscriptions.subscribe(topic_filter, virtual.client_id, qos)
+        return
+    topics.subscribe(topic_filter, virtual.client_id, qos)
+    now = time.monotonic()
+    for retained in retained_messages.match(topic_filter):
+        if retained.expires_at and retained.expires_at <= now:
+            continue
+        virtual.deliver(retained.topic, retained.payload, min(retained.qos, qos))
+
+def check_virtual_clients(now):
+    """断开超过virtual_client_ttl没有被读取的虚拟客户端"""
+    expired = 0
+    for virtual in idle_wheel.advance(now):
+        if virtual_clients.get(virtual.client_id) is not virtual:
+            continue
+        ttl = mqtt_config.virtual_client_ttl
+        if not ttl:
+            continue
+        deadline = virtual.last_active + ttl
+        if deadline > now:
+            idle_wheel.schedule(virtual, deadline)
+        else:
+            disconnect_virtual_client(virtual.client_id)
+            expired += 1
+    if expired:
+        log_event("disconnect", "断开空闲的虚拟客户端", count=expired)
+
+def encode_ack(packet_type, message_id, reason_code=0):
+    """构建只包含消息ID的确认报文（PUBACK/PUBREC/PUBREL/PUBCOMP），MQTT 5的原因码非0时附在消息ID之后"""
+    # PUBREL固定头的保留位必须为0010
+    first_byte = packet_type << 4 | (0x02 if packet_type == PUBREL else 0)
+    if reason_code:
+        return bytes((first_byte, 3, message_id >> 8, message_id & 0xFF, reason_code))
+    return bytes((first_byte, 2, message_id >> 8, message_id & 0xFF))
+
+def write_chunks(transport, chunks):
+    """把数据块写入transport：通常合并为一次写入；有大数据块（如大消息的内容）时，
+    大数据块单独写入，不与其他数据块拼接（writelines会把所有数据块拼接成一个新的bytes）"""
+    if max(map(len, chunks)) < LARGE_CHUNK_SIZE:
+        transport.writelines(chunks)
+        return
+    small = []
+    for chunk in chunks:
+        if len(chunk) < LARGE_CHUNK_SIZE:
+            small.append(chunk)
+            continue
+        if small:
+            transport.write(b"".join(small))
+            small = []
+        transport.write(chunk)
+    if small:
+        transport.write(b"".join(small))
+
+def encode_packet(first_byte, body):
+    """在可变头和负载之前加上固定头"""
+    return bytes([first_byte]) + encode_varint(len(body)) + body
+
+def encode_disconnect(reason_code):
+    """构建服务器发给MQTT 5客户端的DISCONNECT"""
+    return bytes((DISCONNECT << 4, 1, reason_code))
+
+def build_publish_header(topic_bytes, qos, payload_len, dup=False, retain=False):
+    """构建PUBLISH数据包中消息ID之前的部分（固定头和主题）
+
+    QoS>0时，完整的数据包为 头部 + 2字节消息ID + 消息内容。
+    """
+    first_byte = PUBLISH << 4 | qos << 1
+    if dup:
+        first_byte |= 0x08
+    if retain:
+        first_byte |= 0x01
+    
+    # 可变头和负载的总长度
+    remaining_length = 2 + len(topic_bytes) + payload_len
+    if qos > 0:
+        remaining_length += 2  # 消息ID长度
+    
+    header = bytearray([first_byte])
+    header += encode_remaining_length(remaining_length)
+    header += len(topic_bytes).to_bytes(2, 'big')
+    header += topic_bytes
+    return bytes(header)
+
+def encode_remaining_length(length):
+    """编码MQTT数据包的剩余长度字段"""
+    result = bytearray()
+    while True:
+        byte = length & 0x7F
+        length >>= 7
+        if length > 0:
+            byte |= 0x80
+        result.append(byte)
+        if length == 0:
+            break
+    return result
+
+def valid_topic_filter(topic_filter):
+    """检查订阅过滤器中通配符的用法是否合法"""
+    if not topic_filter:
+        return False
+    levels = topic_filter.split('/')
+    for i, level in enumerate(levels):
+        if '#' in level and (level != '#' or i != len(levels) - 1):
+            return False
+        if '+' in level and level != '+':
+            return False
+    return True
+
+def valid_topic_name(topic):
+    """检查发布主题：非空，不含通配符和空字符"""
+    return bool(topic) and '+' not in topic and '#' not in topic and '\0' not in topic
+
+def valid_shared_filter(share_filter):
+    """检查 $share/组名/过滤器 形式的共享订阅：组名非空且不含通配符，过滤器合法"""
+    parts = share_filter.split('/', 2)
+    if len(parts) != 3 or parts[0] != '$share':
+        return False
+    group = parts[1]
+    if not group or '+' in group or '#' in group:
+        return False
+    return valid_topic_filter(parts[2])
+
+def check_keepalive(now):
+    """断开超过保活时间没有通信的客户端"""
+    reaped = 0
+    for client in keepalive_wheel.advance(now):
+        # 已断开或已被同ID新连接取代的客户端直接丢弃
+        if not client.connected or clients.get(client.client_id) is not client:
+            continue
+        # 收到过报文的客户端按最后活动时间重新排期
+        deadline = client.last_active + client.keepalive_timeout
+        if deadline > now:
+            keepalive_wheel.schedule(client, deadline)
+        else:
+            client.close(KEEP_ALIVE_TIMEOUT)
+            reaped += 1
+    if reaped:
+        log_event("keepalive", "断开超时客户端", count=reaped)
+
+def check_retries(now):
+    """重发超过重发间隔仍未确认的消息"""
+    for entry in retry_wheel.advance(now):
+        client = entry.client
+        # 已确认的消息不再重发；断开的客户端在重连接管会话时统一重发
+        if client.inflight.get(entry.packet_id) is not entry or not client.connected:
+            continue
+        # 重新排期过的消息以最新的重发时间为准
+        if entry.retry_at > now:
+            continue
+        client.retransmit(entry)
+
+async def timer_loop():
+    """定期推进各个时间轮"""
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(keepalive_wheel.tick)
+        now = loop.time()
+        check_keepalive(now)
+        check_retries(now)
+        check_virtual_clients(time.monotonic())
+
+async def start_mqtt_server():
+    """启动MQTT服务器"""
+    global server_loop
+    server_loop = asyncio.get_running_loop()
+    server_ready.set()
+    try:
+        await serve_mqtt()
+    finally:
+        # 服务器已停止，之后提交的操作不再执行
+        server_loop = None
+        server_ready.clear()
+
+async def serve_mqtt():
+    """监听MQTT端口并运行到被取消"""
+    mqtt_logging.configure(mqtt_config.log_level, mqtt_config.log_sample_rate, mqtt_config.log_payload_preview,
+                           mqtt_config.log_event_levels)
+    reuse_port = mqtt_config.reuse_port or None
+    if mqtt_config.engine == PROTOCOL_ENGINE:
+        server = await asyncio.get_running_loop().create_server(
+            MQTTProtocol, mqtt_config.host, mqtt_config.port, reuse_port=reuse_port)
+    else:
+        server = await asyncio.start_server(
+            handle_client, mqtt_config.host, mqtt_config.port, reuse_port=reuse_port)
+    
+    loop_name = type(asyncio.get_running_loop()).__module__.split('.')[0]
+    log_event("server", "MQTT服务器已启动", address=f"{mqtt_config.host}:{mqtt_config.port}",
+              engine=mqtt_config.engine, loop=loop_name)
+    
+    timer_task = asyncio.ensure_future(timer_loop())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        timer_task.cancel()
+
+def new_event_loop():
+    """创建事件循环：配置了use_uvloop且已安装uvloop时使用uvloop，否则使用asyncio默认的事件循环
+
+    实际使用的事件循环记录在服务器启动日志的loop字段中。
+    """
+    if mqtt_config.use_uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            pass
+        else:
+            return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+def run_event_loop(main):
+    """与asyncio.run相同，但事件循环由new_event_loop创建"""
+    loop = new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(main)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+if __name__ == "__main__":
+    try:
+        run_event_loop(start_mqtt_server())
+    except KeyboardInterrupt:
         print("服务器关闭") 
\ No newline at end of file
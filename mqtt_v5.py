@@ -0,0 +1,231 @@
+"""
+MQTT 5.0 属性编解码和原因码
+
+属性在CONNECT、CONNACK、PUBLISH等报文中以 变长长度 + (标识符, 值)... 的形式出现。
+解码得到 {标识符: 值} 的字典，可重复出现的属性（用户属性、订阅标识符）的值为列表。
+"""
+from typing import Dict, Optional, Tuple
+
+# 属性标识符
+PAYLOAD_FORMAT_INDICATOR = 0x01
+MESSAGE_EXPIRY_INTERVAL = 0x02
+CONTENT_TYPE = 0x03
+RESPONSE_TOPIC = 0x08
+CORRELATION_DATA = 0x09
+SUBSCRIPTION_IDENTIFIER = 0x0B
+SESSION_EXPIRY_INTERVAL = 0x11
+ASSIGNED_CLIENT_IDENTIFIER = 0x12
+SERVER_KEEP_ALIVE = 0x13
+AUTHENTICATION_METHOD = 0x15
+AUTHENTICATION_DATA = 0x16
+REQUEST_PROBLEM_INFORMATION = 0x17
+WILL_DELAY_INTERVAL = 0x18
+REQUEST_RESPONSE_INFORMATION = 0x19
+RESPONSE_INFORMATION = 0x1A
+SERVER_REFERENCE = 0x1C
+REASON_STRING = 0x1F
+RECEIVE_MAXIMUM = 0x21
+TOPIC_ALIAS_MAXIMUM = 0x22
+TOPIC_ALIAS = 0x23
+MAXIMUM_QOS = 0x24
+RETAIN_AVAILABLE = 0x25
+USER_PROPERTY = 0x26
+MAXIMUM_PACKET_SIZE = 0x27
+WILDCARD_SUBSCRIPTION_AVAILABLE = 0x28
+SUBSCRIPTION_IDENTIFIER_AVAILABLE = 0x29
+SHARED_SUBSCRIPTION_AVAILABLE = 0x2A
+
+# 属性值的编码类型
+BYTE = 1
+TWO_BYTE = 2
+FOUR_BYTE = 4
+VARIABLE_INT = 5
+UTF8_STRING = 6
+BINARY = 7
+STRING_PAIR = 8
+
+PROPERTY_TYPES: Dict[int, int] = {
+    PAYLOAD_FORMAT_INDICATOR: BYTE,
+    MESSAGE_EXPIRY_INTERVAL: FOUR_BYTE,
+    CONTENT_TYPE: UTF8_STRING,
+    RESPONSE_TOPIC: UTF8_STRING,
+    CORRELATION_DATA: BINARY,
+    SUBSCRIPTION_IDENTIFIER: VARIABLE_INT,
+    SESSION_EXPIRY_INTERVAL: FOUR_BYTE,
+    ASSIGNED_CLIENT_IDENTIFIER: UTF8_STRING,
+    SERVER_KEEP_ALIVE: TWO_BYTE,
+    AUTHENTICATION_METHOD: UTF8_STRING,
+    AUTHENTICATION_DATA: BINARY,
+    REQUEST_PROBLEM_INFORMATION: BYTE,
+    WILL_DELAY_INTERVAL: FOUR_BYTE,
+    REQUEST_RESPONSE_INFORMATION: BYTE,
+    RESPONSE_INFORMATION: UTF8_STRING,
+    SERVER_REFERENCE: UTF8_STRING,
+    REASON_STRING: UTF8_STRING,
+    RECEIVE_MAXIMUM: TWO_BYTE,
+    TOPIC_ALIAS_MAXIMUM: TWO_BYTE,
+    TOPIC_ALIAS: TWO_BYTE,
+    MAXIMUM_QOS: BYTE,
+    RETAIN_AVAILABLE: BYTE,
+    USER_PROPERTY: STRING_PAIR,
+    MAXIMUM_PACKET_SIZE: FOUR_BYTE,
+    WILDCARD_SUBSCRIPTION_AVAILABLE: BYTE,
+    SUBSCRIPTION_IDENTIFIER_AVAILABLE: BYTE,
+    SHARED_SUBSCRIPTION_AVAILABLE: BYTE,
+}
+
+# 可以重复出现的属性
+REPEATABLE_PROPERTIES = (USER_PROPERTY, SUBSCRIPTION_IDENTIFIER)
+
+# 服务器转发PUBLISH时必须原样带给订阅者的属性
+FORWARDED_PROPERTIES = (PAYLOAD_FORMAT_INDICATOR, CONTENT_TYPE, RESPONSE_TOPIC, CORRELATION_DATA, USER_PROPERTY)
+
+# 原因码
+SUCCESS = 0x00
+GRANTED_QOS_0 = 0x00
+GRANTED_QOS_1 = 0x01
+GRANTED_QOS_2 = 0x02
+NO_MATCHING_SUBSCRIBERS = 0x10
+NO_SUBSCRIPTION_EXISTED = 0x11
+UNSPECIFIED_ERROR = 0x80
+MALFORMED_PACKET = 0x81
+PROTOCOL_ERROR = 0x82
+UNSUPPORTED_PROTOCOL_VERSION = 0x84
+CLIENT_IDENTIFIER_NOT_VALID = 0x85
+BAD_USERNAME_OR_PASSWORD = 0x86
+NOT_AUTHORIZED = 0x87
+SERVER_UNAVAILABLE = 0x88
+SERVER_BUSY = 0x89
+KEEP_ALIVE_TIMEOUT = 0x8D
+SESSION_TAKEN_OVER = 0x8E
+TOPIC_FILTER_INVALID = 0x8F
+TOPIC_NAME_INVALID = 0x90
+RECEIVE_MAXIMUM_EXCEEDED = 0x93
+TOPIC_ALIAS_INVALID = 0x94
+PACKET_TOO_LARGE = 0x95
+QUOTA_EXCEEDED = 0x97
+
+def encode_varint(value: int) -> bytes:
+    """编码变长整数（与剩余长度字段的编码相同）"""
+    result = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value > 0:
+            byte |= 0x80
+        result.append(byte)
+        if value == 0:
+            return bytes(result)
+
+def decode_varint(data, offset: int) -> Tuple[int, int]:
+    """解码从offset开始的变长整数，返回 (值, 之后的偏移)"""
+    value = 0
+    multiplier = 1
+    for _ in range(4):
+        byte = data[offset]
+        offset += 1
+        value += (byte & 127) * multiplier
+        if byte & 128 == 0:
+            return value, offset
+        multiplier *= 128
+    raise ValueError("变长整数无效")
+
+def decode_properties(data, offset: int) -> Tuple[Dict[int, object], int]:
+    """解码从offset开始的属性（含长度字段），返回 (属性字典, 属性之后的偏移)"""
+    length, offset = decode_varint(data, offset)
+    end = offset + length
+    properties: Dict[int, object] = {}
+    while offset < end:
+        identifier = data[offset]
+        offset += 1
+        kind = PROPERTY_TYPES.get(identifier)
+        if kind is None:
+            raise ValueError(f"未知的属性标识符 0x{identifier:02x}")
+        if kind == BYTE:
+            value = data[offset]
+            offset += 1
+        elif kind == TWO_BYTE or kind == FOUR_BYTE:
+            value = int.from_bytes(data[offset:offset + kind], 'big')
+            offset += kind
+        elif kind == VARIABLE_INT:
+            value, offset = decode_varint(data, offset)
+        elif kind == STRING_PAIR:
+            key, offset = _decode_binary(data, offset)
+            text, offset = _decode_binary(data, offset)
+            value = (key.decode('utf-8'), text.decode('utf-8'))
+        else:
+            value, offset = _decode_binary(data, offset)
+            if kind == UTF8_STRING:
+                value = value.decode('utf-8')
+        if identifier in REPEATABLE_PROPERTIES:
+            properties.setdefault(identifier, []).append(value)
+        else:
+            properties[identifier] = value
+    if offset != end:
+        raise ValueError("属性长度无效")
+    return properties, end
+
+def _decode_binary(data, offset: int) -> Tuple[bytes, int]:
+    length = (data[offset] << 8) | data[offset + 1]
+    offset += 2
+    return bytes(data[offset:offset + length]), offset + length
+
+def _encode_binary(value) -> bytes:
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return len(value).to_bytes(2, 'big') + value
+
+def _encode_property(identifier: int, value, out: bytearray):
+    kind = PROPERTY_TYPES[identifier]
+    out.append(identifier)
+    if kind == BYTE:
+        out.append(value)
+    elif kind == TWO_BYTE or kind == FOUR_BYTE:
+        out += value.to_bytes(kind, 'big')
+    elif kind == VARIABLE_INT:
+        out += encode_varint(value)
+    elif kind == STRING_PAIR:
+        out += _encode_binary(value[0])
+        out += _encode_binary(value[1])
+    else:
+        out += _encode_binary(value)
+
+def encode_properties(properties: Optional[Dict[int, object]]) -> bytes:
+    """编码属性（含长度字段），没有属性时为1个字节的0"""
+    if not properties:
+        return b"\x00"
+    out = bytearray()
+    for identifier, value in properties.items():
+        if identifier in REPEATABLE_PROPERTIES:
+            for item in value:
+                _encode_property(identifier, item, out)
+        else:
+            _encode_property(identifier, value, out)
+    return encode_varint(len(out)) + out
+
+def encode_publish_properties(properties: Optional[Dict[int, object]], expiry: Optional[int] = None) -> bytes:
+    """编码转发给订阅者的PUBLISH属性：消息过期间隔（剩余秒数）总在最前，其后是需原样转发的属性"""
+    out = bytearray()
+    if expiry is not None:
+        out.append(MESSAGE_EXPIRY_INTERVAL)
+        out += expiry.to_bytes(4, 'big')
+    if properties:
+        for identifier in FORWARDED_PROPERTIES:
+            value = properties.get(identifier)
+            if value is None:
+                continue
+            if identifier in REPEATABLE_PROPERTIES:
+                for item in value:
+                    _encode_property(identifier, item, out)
+            else:
+                _encode_property(identifier, value, out)
+    if not out:
+        return b"\x00"
+    return encode_varint(len(out)) + out
+
+def refresh_expiry(body: bytes, expiry: int) -> bytes:
+    """把 属性 + 消息内容 中的消息过期间隔改为剩余秒数，长度不变，头部无需重新编码"""
+    length, offset = decode_varint(body, 0)
+    if length == 0 or body[offset] != MESSAGE_EXPIRY_INTERVAL:
+        return body
+    return body[:offset + 1] + expiry.to_bytes(4, 'big') + body[offset + 5:]
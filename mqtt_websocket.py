@@ -0,0 +1,178 @@
+"""
+MQTT over WebSocket
+
+Web服务（FastAPI）的WebSocket端点把收到的二进制帧交给与TCP客户端相同的MQTTProtocol处理，
+MQTT服务器写出的报文作为二进制帧发回。MQTT服务器和Web服务可以运行在不同线程的事件循环中：
+WebSocketTransport的transport方法（write、close等）只在服务器的事件循环中调用，
+WebSocket帧只在Web服务的事件循环中收发，两边通过call_soon_threadsafe交接数据；
+单事件循环模式下两者是同一个事件循环，交接仍然有效。
+"""
+import asyncio
+from typing import Optional
+
+import mqtt_server
+from mqtt_server import MQTTProtocol, call_in_server_loop
+
+# MQTT over WebSocket的子协议名，客户端必须在握手时请求
+MQTT_SUBPROTOCOL = "mqtt"
+
+# 尚未发给WebSocket的数据超过HIGH_WATER字节时暂停写入（pause_writing），降到LOW_WATER以下时恢复
+HIGH_WATER = 64 * 1024
+LOW_WATER = 16 * 1024
+
+# WebSocket关闭码
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_UNSUPPORTED_DATA = 1003  # MQTT报文只能放在二进制帧中
+CLOSE_TRY_AGAIN_LATER = 1013  # MQTT服务器尚未启动
+
+class WebSocketTransport(asyncio.Transport):
+    """把一个WebSocket连接包装成asyncio transport，供MQTTProtocol使用"""
+
+    def __init__(self, websocket, server_loop: asyncio.AbstractEventLoop):
+        super().__init__()
+        self.websocket = websocket
+        self.server_loop = server_loop
+        self.web_loop = asyncio.get_running_loop()
+        self.protocol: Optional[MQTTProtocol] = None
+        # 以下两项只在Web服务的事件循环中使用
+        self.outgoing: asyncio.Queue = asyncio.Queue()  # 待发送的数据，None表示发完后关闭
+        self.reading = asyncio.Event()  # 未暂停读取时为set
+        self.reading.set()
+        self.sender: Optional[asyncio.Future] = None  # 发送循环
+        # 以下各项只在服务器的事件循环中使用
+        self.buffer_size = 0  # 已写入、尚未发给WebSocket的字节数
+        self.write_paused = False
+        self.closing = False
+        self.lost = False
+
+    def write(self, data):
+        if self.closing or not data:
+            return
+        # 数据交给另一个事件循环发送，拷贝出接收缓冲区上的视图
+        data = bytes(data)
+        self.buffer_size += len(data)
+        self.web_loop.call_soon_threadsafe(self.outgoing.put_nowait, data)
+        if not self.write_paused and self.buffer_size > HIGH_WATER:
+            self.write_paused = True
+            self.protocol.pause_writing()
+
+    def writelines(self, list_of_data):
+        """同一次写入的报文合并为一个WebSocket帧"""
+        self.write(b"".join(list_of_data))
+
+    def get_write_buffer_size(self) -> int:
+        return self.buffer_size
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def close(self):
+        """发完已写入的数据后关闭WebSocket"""
+        if not self.closing:
+            self.closing = True
+            self.web_loop.call_soon_threadsafe(self.outgoing.put_nowait, None)
+
+    def abort(self):
+        """丢弃尚未发出的数据，立即关闭WebSocket"""
+        if self.lost:
+            return
+        self.closing = True
+        self.buffer_size = 0
+        self.web_loop.call_soon_threadsafe(self._abort_websocket)
+        self._connection_lost()
+
+    def pause_reading(self):
+        self.web_loop.call_soon_threadsafe(self.reading.clear)
+
+    def resume_reading(self):
+        self.web_loop.call_soon_threadsafe(self.reading.set)
+
+    def get_extra_info(self, name, default=None):
+        if name == "peername" and self.websocket.client is not None:
+            return tuple(self.websocket.client)
+        return default
+
+    def _sent(self, size: int):
+        """（服务器的事件循环）一段数据已发给WebSocket"""
+        self.buffer_size -= size
+        if self.write_paused and self.buffer_size <= LOW_WATER and not self.lost:
+            self.write_paused = False
+            self.protocol.resume_writing()
+
+    def _received(self, data: bytes):
+        """（服务器的事件循环）收到一个二进制帧，连接已断开时丢弃"""
+        if not self.lost:
+            self.protocol.data_received(data)
+
+    def _abort_websocket(self):
+        """（Web服务的事件循环）停止发送循环，清空待发送的数据并关闭WebSocket"""
+        if self.sender is not None:
+            self.sender.cancel()
+        while not self.outgoing.empty():
+            self.outgoing.get_nowait()
+        asyncio.ensure_future(_close_websocket(self.websocket))
+
+    def _connection_lost(self):
+        """（服务器的事件循环）WebSocket已断开"""
+        if not self.lost:
+            self.lost = True
+            self.closing = True
+            self.protocol.connection_lost(None)
+
+def _attach(protocol: MQTTProtocol, transport: WebSocketTransport):
+    """在服务器的事件循环中建立MQTT连接"""
+    transport.protocol = protocol
+    protocol.connection_made(transport)
+
+async def _close_websocket(websocket):
+    try:
+        await websocket.close()
+    except Exception:
+        # WebSocket已断开
+        pass
+
+async def _send_loop(websocket, transport: WebSocketTransport):
+    """把服务器写出的数据逐个作为二进制帧发出，收到None时关闭WebSocket"""
+    outgoing = transport.outgoing
+    try:
+        while True:
+            data = await outgoing.get()
+            if data is None:
+                break
+            await websocket.send_bytes(data)
+            transport.server_loop.call_soon_threadsafe(transport._sent, len(data))
+        await websocket.close()
+    except Exception:
+        # WebSocket已断开，由接收循环清理
+        pass
+
+async def serve_websocket(websocket):
+    """处理一个MQTT over WebSocket连接（Starlette/FastAPI的WebSocket对象）"""
+    server_loop = mqtt_server.server_loop
+    if MQTT_SUBPROTOCOL not in websocket.scope.get("subprotocols", ()):
+        await websocket.close(code=CLOSE_PROTOCOL_ERROR)
+        return
+    if server_loop is None:
+        await websocket.close(code=CLOSE_TRY_AGAIN_LATER)
+        return
+    await websocket.accept(subprotocol=MQTT_SUBPROTOCOL)
+
+    transport = WebSocketTransport(websocket, server_loop)
+    protocol = MQTTProtocol()
+    await call_in_server_loop(_attach, protocol, transport)
+    transport.sender = sender = asyncio.ensure_future(_send_loop(websocket, transport))
+    try:
+        while True:
+            if not transport.reading.is_set():
+                await transport.reading.wait()
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            data = message.get("bytes")
+            if data is None:
+                await websocket.close(code=CLOSE_UNSUPPORTED_DATA)
+                break
+            server_loop.call_soon_threadsafe(transport._received, data)
+    finally:
+        server_loop.call_soon_threadsafe(transport._connection_lost)
+        sender.cancel()
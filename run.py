@@ -1,49 +1,98 @@
-#!/usr/bin/env python
-"""
-MQTT服务器启动脚本
-"""
-import argparse
-import sys
-from api_server import main as api_main
-from mqtt_server import mqtt_config
-
-def parse_args():
-    parser = argparse.ArgumentParser(description='MQTT服务器')
-    parser.add_argument('--mqtt-host', type=str, default='0.0.0.0', help='MQTT服务器主机地址')
-    parser.add_argument('--mqtt-port', type=int, default=1883, help='MQTT服务器端口')
-    parser.add_argument('--web-port', type=int, default=8000, help='Web管理界面端口')
-    parser.add_argument('--allow-anonymous', type=bool, default=True, help='是否允许匿名连接')
-    parser.add_argument('--max-connections', type=int, default=100, help='最大连接数')
-    parser.add_argument('--max-keepalive', type=int, default=60, help='最大保持连接时间(秒)')
-    
-    return parser.parse_args()
-
-if __name__ == "__main__":
-    args = parse_args()
-    
-    # 更新MQTT配置
-    mqtt_config.host = args.mqtt_host
-    mqtt_config.port = args.mqtt_port
-    mqtt_config.allow_anonymous = args.allow_anonymous
-    mqtt_config.max_connections = args.max_connections
-    mqtt_config.max_keepalive = args.max_keepalive
-    
-    # 打印欢迎信息
-    print("=" * 50)
-    print("MQTT服务器启动")
-    print("=" * 50)
-    print(f"MQTT服务器地址: {mqtt_config.host}:{mqtt_config.port}")
-    print(f"Web管理界面: http://127.0.0.1:{args.web_port}")
-    print(f"允许匿名连接: {'是' if mqtt_config.allow_anonymous else '否'}")
-    print(f"最大连接数: {mqtt_config.max_connections}")
-    print(f"最大保持连接时间: {mqtt_config.max_keepalive}秒")
-    print("-" * 50)
-    print("按Ctrl+C退出")
-    print("=" * 50)
-    
-    try:
-        # 启动服务器
-        api_main()
-    except KeyboardInterrupt:
-        print("\n服务器已停止")
+#!/usr/bin/env python
+"""
+MQTT服务器启动脚本
+"""
+import argparse
+import sys
+from api_server import main as api_main
+from mqtt_cluster import run_cluster
+from mqtt_server import mqtt_config, DROP_NEWEST, SLOW_CONSUMER_POLICIES, ENGINES, SHARED_STRATEGIES
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='MQTT服务器')
+    parser.add_argument('--mqtt-host', type=str, default='0.0.0.0', help='MQTT服务器主机地址')
+    parser.add_argument('--mqtt-port', type=int, default=1883, help='MQTT服务器端口')
+    parser.add_argument('--web-port', type=int, default=8000, help='Web管理界面端口')
+    parser.add_argument('--allow-anonymous', type=bool, default=True, help='是否允许匿名连接')
+    parser.add_argument('--max-connections', type=int, default=100, help='最大连接数')
+    parser.add_argument('--max-keepalive', type=int, default=60, help='MQTT 5客户端的最大保持连接时间(秒)')
+    parser.add_argument('--max-queued-messages', type=int, default=1000, help='每个客户端发送队列的最大消息数')
+    parser.add_argument('--slow-consumer-policy', type=str, default=DROP_NEWEST,
+                        choices=SLOW_CONSUMER_POLICIES, help='发送队列已满时的处理策略')
+    parser.add_argument('--max-inflight-messages', type=int, default=20, help='每个客户端已发送未完成的QoS 1/2消息数上限')
+    parser.add_argument('--retry-interval', type=int, default=20, help='未确认消息的重发间隔(秒)，只用于MQTT 3.1.1客户端')
+    parser.add_argument('--write-coalesce-us', type=int, default=0,
+                        help='写合并窗口(微秒)，发给同一客户端的报文在此时间内合并为一次写入；0表示只合并同一轮事件循环中的报文')
+    parser.add_argument('--max-packet-size', type=int, default=0, help='接受的最大报文长度(字节)，0表示不限制')
+    parser.add_argument('--stream-threshold', type=int, default=0,
+                        help='剩余长度不小于此值(字节)的非保留PUBLISH边接收边转发（按QoS 0投递），0表示不流式转发')
+    parser.add_argument('--topic-alias-maximum', type=int, default=mqtt_config.topic_alias_maximum,
+                        help='MQTT 5客户端发布时可使用的主题别名数，0表示不接受主题别名')
+    parser.add_argument('--shared-strategy', type=str, default=mqtt_config.shared_subscription_strategy,
+                        choices=list(SHARED_STRATEGIES), help='共享订阅($share/组名/过滤器)的组内投递策略')
+    parser.add_argument('--workers', type=int, default=1, help='工作进程数，大于1时以多进程模式运行（不启动Web管理界面）')
+    parser.add_argument('--engine', type=str, default=mqtt_config.engine, choices=ENGINES, help='连接处理引擎')
+    parser.add_argument('--uvloop', action='store_true', help='已安装uvloop时使用uvloop事件循环')
+    parser.add_argument('--single-loop', action='store_true',
+                        help='MQTT服务器与Web管理界面运行在同一个事件循环中（默认MQTT服务器运行在单独的线程中）')
+    parser.add_argument('--log-level', type=str, default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help='日志级别（收到的每条发布消息以DEBUG级别记录）')
+    parser.add_argument('--log-sample-rate', type=float, default=10, help='逐条消息的日志每秒最多记录的条数')
+    parser.add_argument('--session-dir', type=str, default=mqtt_config.session_dir, help='持久会话离线消息段文件目录')
+    
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    args = parse_args()
+    
+    # 更新MQTT配置
+    mqtt_config.host = args.mqtt_host
+    mqtt_config.port = args.mqtt_port
+    mqtt_config.allow_anonymous = args.allow_anonymous
+    mqtt_config.max_connections = args.max_connections
+    mqtt_config.max_keepalive = args.max_keepalive
+    mqtt_config.max_queued_messages = args.max_queued_messages
+    mqtt_config.slow_consumer_policy = args.slow_consumer_policy
+    mqtt_config.max_inflight_messages = args.max_inflight_messages
+    mqtt_config.retry_interval = args.retry_interval
+    mqtt_config.session_dir = args.session_dir
+    mqtt_config.shared_subscription_strategy = args.shared_strategy
+    mqtt_config.max_packet_size = args.max_packet_size
+    mqtt_config.stream_threshold = args.stream_threshold
+    mqtt_config.write_coalesce_us = args.write_coalesce_us
+    mqtt_config.topic_alias_maximum = args.topic_alias_maximum
+    mqtt_config.engine = args.engine
+    mqtt_config.log_level = args.log_level
+    mqtt_config.log_sample_rate = args.log_sample_rate
+    mqtt_config.use_uvloop = args.uvloop
+    
+    # 打印欢迎信息
+    print("=" * 50)
+    print("MQTT服务器启动")
+    print("=" * 50)
+    print(f"MQTT服务器地址: {mqtt_config.host}:{mqtt_config.port}")
+    if args.workers > 1:
+        print(f"多进程模式: {args.workers}个工作进程 (不启动Web管理界面)")
+    else:
+        print(f"Web管理界面: http://127.0.0.1:{args.web_port}")
+        print(f"MQTT over WebSocket: ws://127.0.0.1:{args.web_port}/mqtt")
+    print(f"允许匿名连接: {'是' if mqtt_config.allow_anonymous else '否'}")
+    print(f"最大连接数: {mqtt_config.max_connections}")
+    print(f"最大保持连接时间: {mqtt_config.max_keepalive}秒")
+    print(f"连接处理引擎: {mqtt_config.engine}{' + uvloop' if mqtt_config.use_uvloop else ''}")
+    if args.workers == 1:
+        print(f"事件循环: {'与Web管理界面共用' if args.single_loop else 'MQTT服务器使用单独的线程'}")
+    print(f"发送队列上限: {mqtt_config.max_queued_messages}条 (队列满时: {mqtt_config.slow_consumer_policy})")
+    print("-" * 50)
+    print("按Ctrl+C退出")
+    print("=" * 50)
+    
+    try:
+        # 启动服务器
+        if args.workers > 1:
+            run_cluster(args.workers)
+        else:
+            api_main(single_loop=args.single_loop, port=args.web_port)
+    except KeyboardInterrupt:
+        print("\n服务器已停止")
         sys.exit(0) 
\ No newline at end of file
@@ -0,0 +1,121 @@
+"""
+流式转发大消息与写合并窗口同时启用时，订阅者收到的报文顺序和内容
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mqtt_server
+from mqtt_server import (mqtt_config, MQTTFrameDecoder, CONNECT, PUBLISH, SUBSCRIBE, STREAMS_ENGINE,
+                         build_publish_header, encode_remaining_length, start_mqtt_server)
+
+HOST = "127.0.0.1"
+PORT = 18901
+
+def encode_string(value):
+    data = value.encode('utf-8')
+    return len(data).to_bytes(2, 'big') + data
+
+def packet(first_byte, body):
+    return bytes([first_byte]) + bytes(encode_remaining_length(len(body))) + body
+
+def publish_frame(topic, payload):
+    return build_publish_header(topic.encode('utf-8'), 0, len(payload)) + payload
+
+class RawClient:
+    def __init__(self, client_id):
+        self.client_id = client_id
+        self.decoder = MQTTFrameDecoder()
+        self.frames = []
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(HOST, PORT)
+        body = encode_string("MQTT") + bytes([4, 0x02]) + (0).to_bytes(2, 'big') + encode_string(self.client_id)
+        await self.send(packet(CONNECT << 4, body))
+        await self.read_frame()  # CONNACK
+
+    async def subscribe(self, topic_filter):
+        body = (1).to_bytes(2, 'big') + encode_string(topic_filter) + b"\x00"
+        await self.send(packet(SUBSCRIBE << 4 | 0x02, body))
+        await self.read_frame()  # SUBACK
+
+    async def send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def read_frame(self, timeout=2.0):
+        while not self.frames:
+            data = await asyncio.wait_for(self.reader.read(65536), timeout)
+            if not data:
+                raise ConnectionError("连接已关闭")
+            self.frames.extend((first_byte, bytes(body)) for first_byte, body in self.decoder.feed(data))
+        return self.frames.pop(0)
+
+    def close(self):
+        self.writer.close()
+
+def publish_payload(body):
+    """QoS 0 PUBLISH的 (主题, 消息内容)"""
+    topic_length = int.from_bytes(body[:2], 'big')
+    return body[2:2 + topic_length].decode('utf-8'), body[2 + topic_length:]
+
+async def stream_during_coalesce_window():
+    server = asyncio.ensure_future(start_mqtt_server())
+    await asyncio.sleep(0.2)
+    try:
+        subscriber = RawClient("stream-sub")
+        small = RawClient("stream-small")
+        large = RawClient("stream-large")
+        for client in (subscriber, small, large):
+            await client.connect()
+        await subscriber.subscribe("t/#")
+
+        big = os.urandom(50000)
+        big_frame = publish_frame("t/big", big)
+        # 第一条小消息让订阅者的发送任务进入写合并窗口
+        await small.send(publish_frame("t/small", b"first"))
+        await asyncio.sleep(0.05)
+        # 窗口内开始流式转发大消息，只发出一部分内容
+        await large.send(big_frame[:10000])
+        await asyncio.sleep(0.05)
+        # 流式转发进行中到达的小消息必须排在大消息之后
+        await small.send(publish_frame("t/small", b"second"))
+        # 等写合并窗口结束
+        await asyncio.sleep(mqtt_config.write_coalesce_us / 1e6 + 0.1)
+        await large.send(big_frame[10000:])
+
+        received = []
+        while len(received) < 3:
+            first_byte, body = await subscriber.read_frame()
+            assert first_byte >> 4 == PUBLISH
+            received.append(publish_payload(body))
+        for client in (subscriber, small, large):
+            client.close()
+        return big, received
+    finally:
+        server.cancel()
+        try:
+            await server
+        except asyncio.CancelledError:
+            pass
+
+def test_stream_not_interleaved_with_coalesced_writes():
+    saved = (mqtt_config.host, mqtt_config.port, mqtt_config.engine, mqtt_config.stream_threshold,
+             mqtt_config.write_coalesce_us, mqtt_config.log_level)
+    mqtt_config.host = HOST
+    mqtt_config.port = PORT
+    mqtt_config.engine = STREAMS_ENGINE
+    mqtt_config.stream_threshold = 10000
+    mqtt_config.write_coalesce_us = 300000
+    mqtt_config.log_level = "WARNING"
+    try:
+        big, received = asyncio.run(stream_during_coalesce_window())
+    finally:
+        (mqtt_config.host, mqtt_config.port, mqtt_config.engine, mqtt_config.stream_threshold,
+         mqtt_config.write_coalesce_us, mqtt_config.log_level) = saved
+        mqtt_server.server_loop = None
+    assert received[0] == ("t/small", b"first")
+    assert received[1] == ("t/big", big)
+    assert received[2] == ("t/small", b"second")